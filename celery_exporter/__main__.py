@@ -7,21 +7,44 @@ import time
 
 import click
 
-from .core import CeleryExporter
-from .utils import generate_broker_use_ssl, get_transport_scheme
+from .celery_exporter import TaskNames
+from .core import CeleryExporter, ExporterGroup
+from .utils import (
+    EventBuffer,
+    generate_broker_use_ssl,
+    get_transport_scheme,
+    parse_buckets,
+)
 
 LOG_FORMAT = "[%(asctime)s] %(name)s:%(levelname)s: %(message)s"
 
 
+def _buckets(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_buckets(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @click.command(context_settings={"auto_envvar_prefix": "CELERY_EXPORTER"})
 @click.option(
     "--broker-url",
     "-b",
     type=str,
+    multiple=True,
     show_default=True,
     show_envvar=True,
-    default="redis://redis:6379/0",
-    help="URL to the Celery broker.",
+    default=["redis://redis:6379/0"],
+    help="URL to the Celery broker, repeat it to monitor several brokers.",
+)
+@click.option(
+    "--brokers-file",
+    type=click.Path(exists=True, dir_okay=False, readable=True),
+    show_envvar=True,
+    help="JSON file listing the brokers to monitor, as objects with a broker_url, "
+    "a namespace and optionally transport_options. Overrides --broker-url.",
 )
 @click.option(
     "--listen-address",
@@ -41,14 +64,184 @@ LOG_FORMAT = "[%(asctime)s] %(name)s:%(levelname)s: %(message)s"
     default="10000",
     help="Tasks cache size.",
 )
+@click.option(
+    "--max-tasks-bytes",
+    type=click.IntRange(min=0),
+    show_default=True,
+    show_envvar=True,
+    default=0,
+    help="Memory budget of the tasks cache, in bytes, 0 for none.",
+)
+@click.option(
+    "--task-ttl",
+    type=click.FloatRange(min=0),
+    show_default=True,
+    show_envvar=True,
+    default=0,
+    help="Seconds after which unfinished tasks are dropped from the cache, 0 for never.",
+)
+@click.option(
+    "--checkpoint-file",
+    type=click.Path(dir_okay=False, writable=True),
+    show_envvar=True,
+    help="File the tasks in memory are checkpointed to, and restored from on start.",
+)
+@click.option(
+    "--checkpoint-interval",
+    type=click.IntRange(min=1),
+    show_default=True,
+    show_envvar=True,
+    default=60,
+    help="Seconds between checkpoints of the tasks in memory.",
+)
+@click.option(
+    "--task-name-allow",
+    type=str,
+    multiple=True,
+    show_envvar=True,
+    help="Regular expression of the task names reported under their own label, "
+    "the others being reported as 'other'. Can be repeated.",
+)
+@click.option(
+    "--task-name-deny",
+    type=str,
+    multiple=True,
+    show_envvar=True,
+    help="Regular expression of the task names reported as 'other'. Can be repeated.",
+)
+@click.option(
+    "--task-name-group",
+    type=(str, str),
+    multiple=True,
+    show_envvar=True,
+    help="Regular expression and label, reporting the matching task names under "
+    "the label, which can refer to the groups of the expression as $1. Can be "
+    "repeated, the first matching one applies.",
+)
+@click.option(
+    "--top-task-names",
+    type=click.IntRange(min=0),
+    show_default=True,
+    show_envvar=True,
+    default=0,
+    help="Number of the busiest task names reported under their own label, the "
+    "others being reported as 'other', 0 for all.",
+)
+@click.option(
+    "--runtime-buckets",
+    type=str,
+    callback=_buckets,
+    show_envvar=True,
+    help="Bounds of the task runtime histogram buckets, listed as in '0.1,1,10' or "
+    "laid out as 'exp:START:FACTOR:COUNT' or 'lin:START:WIDTH:COUNT'.",
+)
+@click.option(
+    "--latency-buckets",
+    type=str,
+    callback=_buckets,
+    show_envvar=True,
+    help="Bounds of the task latency histogram buckets, as --runtime-buckets.",
+)
+@click.option(
+    "--sketch-accuracy",
+    type=click.FloatRange(min=0, max=0.5),
+    show_default=True,
+    show_envvar=True,
+    default=0,
+    help="Relative accuracy of quantile sketches replacing the task timing "
+    "histograms by summaries, 0 for histograms.",
+)
+@click.option(
+    "--ingestion-processes",
+    type=click.IntRange(min=1),
+    show_default=True,
+    show_envvar=True,
+    default=1,
+    help="Number of processes parsing and processing the events, each handling a shard of the tasks with an even share of the tasks cache.",
+)
+@click.option(
+    "--event-buffer-size",
+    type=click.IntRange(min=1),
+    show_default=True,
+    show_envvar=True,
+    default=65536,
+    help="Number of events buffered between their reception and their processing.",
+)
+@click.option(
+    "--overflow-policy",
+    type=click.Choice(EventBuffer.POLICIES),
+    show_default=True,
+    show_envvar=True,
+    default="drop-oldest",
+    help="Events dropped when the buffer is full: the oldest ones, or at random "
+    "to keep a uniform sample of the events.",
+)
+@click.option(
+    "--sample-rate",
+    type=click.FloatRange(min=0, max=1),
+    show_default=True,
+    show_envvar=True,
+    default=1.0,
+    help="Fraction of the tasks tracked, rounded to a power of two, the events "
+    "of the sampled tasks counting for the others.",
+)
+@click.option(
+    "--sample-max-lag",
+    type=click.FloatRange(min=0),
+    show_default=True,
+    show_envvar=True,
+    default=0,
+    help="Seconds after their reception past which events are processed at a "
+    "lower sample rate, until they catch up, 0 for a fixed rate.",
+)
+@click.option(
+    "--redis-consumer",
+    is_flag=True,
+    show_envvar=True,
+    help="Read the events of Redis brokers straight from their pub/sub channel.",
+)
+@click.option(
+    "--config-ttl",
+    type=click.IntRange(min=1),
+    show_default=True,
+    show_envvar=True,
+    default=60,
+    help="Seconds between refreshes of the workers routing configuration.",
+)
+@click.option(
+    "--scrape-cache-seconds",
+    type=click.FloatRange(min=0),
+    show_default=True,
+    show_envvar=True,
+    default=1.0,
+    help="Seconds a rendering of the metrics is served before being refreshed.",
+)
+@click.option(
+    "--http-server",
+    type=click.Choice(["threaded", "asyncio"]),
+    show_default=True,
+    show_envvar=True,
+    default="threaded",
+    help="Implementation of the HTTP server exposing the metrics.",
+)
 @click.option(
     "--namespace",
     "-n",
     type=str,
+    multiple=True,
+    show_default=True,
+    show_envvar=True,
+    default=["celery"],
+    help="Namespace for metrics, repeat it once per --broker-url.",
+)
+@click.option(
+    "--control-workers",
+    type=click.IntRange(min=1),
     show_default=True,
     show_envvar=True,
-    default="celery",
-    help="Namespace for metrics.",
+    default=4,
+    help="Threads shared by the brokers to monitor the workers and the queues, "
+    "when monitoring several brokers.",
 )
 @click.option(
     "--transport-options",
@@ -104,9 +297,31 @@ LOG_FORMAT = "[%(asctime)s] %(name)s:%(levelname)s: %(message)s"
 )
 def main(
     broker_url,
+    brokers_file,
     listen_address,
     max_tasks,
+    max_tasks_bytes,
+    task_ttl,
+    checkpoint_file,
+    checkpoint_interval,
+    task_name_allow,
+    task_name_deny,
+    task_name_group,
+    top_task_names,
+    runtime_buckets,
+    latency_buckets,
+    sketch_accuracy,
+    ingestion_processes,
+    event_buffer_size,
+    overflow_policy,
+    sample_rate,
+    sample_max_lag,
+    redis_consumer,
+    config_ttl,
+    scrape_cache_seconds,
+    http_server,
     namespace,
+    control_workers,
     transport_options,
     enable_events,
     use_ssl,
@@ -138,24 +353,99 @@ def main(
             )
             sys.exit(1)
 
-    broker_use_ssl = generate_broker_use_ssl(
-        use_ssl,
-        get_transport_scheme(broker_url),
-        ssl_verify,
-        ssl_ca_certs,
-        ssl_certfile,
-        ssl_keyfile,
-    )
-
-    celery_exporter = CeleryExporter(
-        broker_url,
-        listen_address,
-        max_tasks,
-        namespace,
-        transport_options,
-        enable_events,
-        broker_use_ssl,
-    )
+    if brokers_file:
+        try:
+            with open(brokers_file) as f:
+                brokers = [
+                    (b["broker_url"], b["namespace"], b.get("transport_options"))
+                    for b in json.load(f)
+                ]
+        except (ValueError, KeyError, TypeError):
+            logging.error("Error parsing brokers from '{}'".format(brokers_file))
+            sys.exit(1)
+    elif len(broker_url) == len(namespace):
+        brokers = [(b, n, None) for b, n in zip(broker_url, namespace)]
+    else:
+        logging.error("Give one --namespace per --broker-url")
+        sys.exit(1)
+
+    task_names = dict()
+    if task_name_allow:
+        task_names["allow"] = list(task_name_allow)
+    if task_name_deny:
+        task_names["deny"] = list(task_name_deny)
+    if task_name_group:
+        task_names["groups"] = list(task_name_group)
+    if top_task_names:
+        task_names["top_k"] = top_task_names
+    if not sample_rate > 0:
+        logging.error("Give a --sample-rate above 0")
+        sys.exit(1)
+
+    try:
+        TaskNames(**task_names)
+    except ValueError as e:
+        logging.error("Invalid task names options: {}".format(e))
+        sys.exit(1)
+
+    exporters = []
+    for url, ns, options in brokers:
+        broker_use_ssl = generate_broker_use_ssl(
+            use_ssl,
+            get_transport_scheme(url),
+            ssl_verify,
+            ssl_ca_certs,
+            ssl_certfile,
+            ssl_keyfile,
+        )
+        if checkpoint_file and len(brokers) > 1:
+            checkpoint_path = "{}.{}".format(checkpoint_file, ns)
+        else:
+            checkpoint_path = checkpoint_file
+
+        exporters.append(
+            CeleryExporter(
+                url,
+                listen_address,
+                max_tasks,
+                ns,
+                transport_options if options is None else options,
+                enable_events,
+                broker_use_ssl,
+                ingestion_processes,
+                config_ttl,
+                scrape_cache_seconds,
+                http_server,
+                task_ttl or None,
+                max_tasks_bytes or None,
+                checkpoint_path,
+                checkpoint_interval,
+                task_names or None,
+                runtime_buckets,
+                latency_buckets,
+                sketch_accuracy or None,
+                event_buffer_size,
+                overflow_policy,
+                sample_rate if sample_rate < 1 else None,
+                sample_max_lag or None,
+                redis_consumer,
+            )
+        )
+
+    if len(exporters) == 1:
+        celery_exporter = exporters[0]
+    else:
+        try:
+            celery_exporter = ExporterGroup(
+                exporters,
+                listen_address,
+                scrape_cache_seconds,
+                http_server,
+                control_workers,
+            )
+        except ValueError as e:
+            logging.error(str(e))
+            sys.exit(1)
 
     celery_exporter.start()
 
@@ -164,6 +454,7 @@ def main(
         Shutdown is called if the process receives a TERM/INT signal.
         """
         logging.info("Shutting down")
+        celery_exporter.shutdown()
         sys.exit(0)
 
     signal.signal(signal.SIGINT, shutdown)
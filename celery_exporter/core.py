@@ -1,16 +1,19 @@
 import logging
 
 import celery
-import prometheus_client
 
+from .exposition import ExpositionCache, start_asyncio_http_server, start_http_server
 from .monitor import (
-    EnableEventsThread,
+    ControlPlane,
+    PeriodicJobs,
+    QueueLengthThread,
+    ShardedIngestionThread,
     TaskThread,
-    WorkerMonitoringThread,
     setup_metrics,
 )
+from .utils import ConfigCache
 
-__all__ = ("CeleryExporter",)
+__all__ = ("CeleryExporter", "ExporterGroup")
 
 
 class CeleryExporter:
@@ -23,43 +26,226 @@ class CeleryExporter:
         transport_options=None,
         enable_events=False,
         broker_use_ssl=None,
+        ingestion_processes=1,
+        config_ttl=60,
+        scrape_cache_seconds=1.0,
+        http_server="threaded",
+        task_ttl=None,
+        max_tasks_bytes=None,
+        checkpoint_path=None,
+        checkpoint_interval=60,
+        task_names=None,
+        runtime_buckets=None,
+        latency_buckets=None,
+        sketch_accuracy=None,
+        event_buffer_size=None,
+        overflow_policy="drop-oldest",
+        sample_rate=None,
+        sample_max_lag=None,
+        redis_consumer=False,
     ):
         self._listen_address = listen_address
         self._max_tasks = max_tasks
+        self._task_ttl = task_ttl
+        self._max_tasks_bytes = max_tasks_bytes
+        self._checkpoint_path = checkpoint_path
+        self._checkpoint_interval = checkpoint_interval
+        self._task_names = task_names
+        self._runtime_buckets = runtime_buckets
+        self._latency_buckets = latency_buckets
+        self._sketch_accuracy = sketch_accuracy
+        self._event_buffer_size = event_buffer_size
+        self._overflow_policy = overflow_policy
+        self._sample_rate = sample_rate
+        self._sample_max_lag = sample_max_lag
+        self._redis_consumer = redis_consumer
         self._namespace = namespace
         self._enable_events = enable_events
+        self._ingestion_processes = ingestion_processes
+        self._http_server = http_server
+        self._task_thread = None
 
         self._app = celery.Celery(broker=broker_url, broker_use_ssl=broker_use_ssl)
         self._app.conf.broker_transport_options = transport_options or {}
+        self._config_cache = ConfigCache(self._app, ttl=config_ttl)
+        self._exposition_cache = ExpositionCache(max_age=scrape_cache_seconds)
+
+    @property
+    def namespace(self):
+        return self._namespace
 
     def start(self):
+        self.start_ingestion()
+        self._start_httpd()
+        self.start_monitoring()
 
-        setup_metrics(self._app, self._namespace)
+    def start_ingestion(self):
+        """
+        Sets up the ingestion of the events, starting the ingestion
+        processes if any.
+        """
+        if self._ingestion_processes > 1:
+            # the processes share the memory budget of the tasks, as their
+            # shards hold as many tasks
+            processes = self._ingestion_processes
+            t = ShardedIngestionThread(
+                app=self._app,
+                namespace=self._namespace,
+                max_tasks_in_memory=max(1, self._max_tasks // processes),
+                processes=processes,
+                config_cache=self._config_cache,
+                task_ttl=self._task_ttl,
+                max_bytes=self._max_tasks_bytes and self._max_tasks_bytes // processes,
+                checkpoint_path=self._checkpoint_path,
+                checkpoint_interval=self._checkpoint_interval,
+                task_names=self._task_names,
+                runtime_buckets=self._runtime_buckets,
+                latency_buckets=self._latency_buckets,
+                sketch_accuracy=self._sketch_accuracy,
+                event_buffer_size=self._event_buffer_size,
+                overflow_policy=self._overflow_policy,
+                sample_rate=self._sample_rate,
+                sample_max_lag=self._sample_max_lag,
+                redis_consumer=self._redis_consumer,
+            )
+            t.start_processes()
+        else:
+            t = TaskThread(
+                app=self._app,
+                namespace=self._namespace,
+                max_tasks_in_memory=self._max_tasks,
+                config_cache=self._config_cache,
+                task_ttl=self._task_ttl,
+                max_bytes=self._max_tasks_bytes,
+                checkpoint_path=self._checkpoint_path,
+                checkpoint_interval=self._checkpoint_interval,
+                task_names=self._task_names,
+                runtime_buckets=self._runtime_buckets,
+                latency_buckets=self._latency_buckets,
+                sketch_accuracy=self._sketch_accuracy,
+                event_buffer_size=self._event_buffer_size,
+                overflow_policy=self._overflow_policy,
+                sample_rate=self._sample_rate,
+                sample_max_lag=self._sample_max_lag,
+                redis_consumer=self._redis_consumer,
+            )
 
-        self._start_httpd()
+        self._task_thread = t
 
-        t = TaskThread(
-            app=self._app,
-            namespace=self._namespace,
-            max_tasks_in_memory=self._max_tasks,
-        )
+        setup_metrics(self._namespace, self._config_cache.get())
+
+    def start_monitoring(self, jobs=None):
+        """
+        Starts ingesting the events and monitoring the workers and the
+        queues. The periodic monitoring runs on jobs, a PeriodicJobs shared
+        by several exporters, when given, or on threads of its own.
+        """
+        t = self._task_thread
         t.daemon = True
         t.start()
 
-        w = WorkerMonitoringThread(app=self._app, namespace=self._namespace)
-        w.daemon = True
-        w.start()
+        periodic = [
+            ControlPlane(
+                app=self._app,
+                namespace=self._namespace,
+                config_cache=self._config_cache,
+                state=t.state,
+                enable_events=self._enable_events,
+            ),
+            QueueLengthThread(
+                app=self._app,
+                namespace=self._namespace,
+                config_cache=self._config_cache,
+            ),
+        ]
 
-        if self._enable_events:
-            e = EnableEventsThread(app=self._app)
-            e.daemon = True
-            e.start()
+        for p in periodic:
+            if jobs is None:
+                p.daemon = True
+                p.start()
+            else:
+                jobs.schedule(p.step)
 
-    def _start_httpd(self):  # pragma: no cover
+    def shutdown(self):
+        """
+        Checkpoints the state of the ingestion, if enabled, before exiting.
         """
-        Starts the exposing HTTPD using the addr provided in a separate
-        thread.
+        if self._task_thread is not None:
+            self._task_thread.shutdown()
+
+    def ready(self):
         """
-        host, port = self._listen_address.split(":")
-        logging.info("Starting HTTPD on {}:{}".format(host, port))
-        prometheus_client.start_http_server(int(port), host)
+        Tells whether the workers config was fetched at least once and the
+        events receiver has read from the broker.
+        """
+        return (
+            self._config_cache.refreshed.is_set()
+            and self._task_thread is not None
+            and self._task_thread.connected.is_set()
+        )
+
+    def _start_httpd(self):  # pragma: no cover
+        _start_httpd(
+            self._listen_address, self._http_server, self._exposition_cache, self.ready
+        )
+
+
+class ExporterGroup:
+    """
+    Runs a CeleryExporter per broker in a single process, sharing the HTTP
+    endpoint, the metrics registry, where each exporter has a namespace of
+    its own, and a pool of threads running their periodic monitoring.
+    """
+
+    def __init__(
+        self,
+        exporters,
+        listen_address,
+        scrape_cache_seconds=1.0,
+        http_server="threaded",
+        control_workers=4,
+    ):
+        namespaces = [e.namespace for e in exporters]
+        if len(set(namespaces)) != len(namespaces):
+            raise ValueError(
+                "Each broker needs a namespace of its own, got {}".format(namespaces)
+            )
+        self._exporters = exporters
+        self._listen_address = listen_address
+        self._http_server = http_server
+        self._exposition_cache = ExpositionCache(max_age=scrape_cache_seconds)
+        self._jobs = PeriodicJobs(workers=control_workers)
+
+    def start(self):
+        for exporter in self._exporters:
+            exporter.start_ingestion()
+        self._start_httpd()
+        self._jobs.daemon = True
+        self._jobs.start()
+        for exporter in self._exporters:
+            exporter.start_monitoring(self._jobs)
+
+    def shutdown(self):
+        for exporter in self._exporters:
+            exporter.shutdown()
+
+    def ready(self):
+        return all(exporter.ready() for exporter in self._exporters)
+
+    def _start_httpd(self):  # pragma: no cover
+        _start_httpd(
+            self._listen_address, self._http_server, self._exposition_cache, self.ready
+        )
+
+
+def _start_httpd(listen_address, http_server, cache, ready):  # pragma: no cover
+    """
+    Starts the exposing HTTPD using the addr provided in a separate
+    thread.
+    """
+    host, port = listen_address.split(":")
+    logging.info("Starting {} HTTPD on {}:{}".format(http_server, host, port))
+    if http_server == "asyncio":
+        start_asyncio_http_server(int(port), host, cache, ready)
+    else:
+        start_http_server(int(port), host, cache, ready)
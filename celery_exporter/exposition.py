@@ -0,0 +1,278 @@
+import asyncio
+import gzip
+import logging
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import prometheus_client
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+
+from .metrics import RENDER_TIME
+
+__all__ = ("ExpositionCache", "start_http_server", "start_asyncio_http_server")
+
+
+class ExpositionCache:
+    """
+    Renders the text exposition of a registry at most once every max_age
+    seconds, keeping a gzip-encoded copy of it, so that concurrent scrapers
+    are all served the same pre-rendered bytes.
+    """
+
+    def __init__(self, registry=prometheus_client.REGISTRY, max_age=1.0):
+        self._registry = registry
+        self._lock = threading.Lock()
+        # (rendered_at, output, gzipped), swapped as a whole
+        self._rendering = None
+        self.max_age = max_age
+
+    def peek(self, accept_gzip=False):
+        """
+        Returns the latest rendering of the registry if it is younger than
+        max_age, None otherwise. It never blocks.
+        """
+        rendering = self._rendering
+        if rendering is None or time.monotonic() - rendering[0] >= self.max_age:
+            return None
+        return rendering[2] if accept_gzip else rendering[1]
+
+    def get(self, accept_gzip=False):
+        """
+        Returns the latest rendering of the registry, re-rendering it first
+        if it is older than max_age. Scrapers arriving while a rendering is
+        in progress wait for it rather than rendering on their own.
+        """
+        with self._lock:
+            output = self.peek(accept_gzip)
+            if output is None:
+                rendered_at = time.monotonic()
+                with RENDER_TIME.time():
+                    output = generate_latest(self._registry)
+                    gzipped = gzip.compress(output, compresslevel=6)
+                self._rendering = (rendered_at, output, gzipped)
+                output = gzipped if accept_gzip else output
+            return output
+
+
+def _route(path, ready):
+    """
+    Maps a request path to the kind of response to serve: the health
+    endpoints or, for any other path, the metrics.
+    """
+    path = path.split("?", 1)[0]
+    if path == "/healthz":
+        return HTTPStatus.OK, b"ok\n"
+    if path == "/ready":
+        if ready is None or ready():
+            return HTTPStatus.OK, b"ready\n"
+        return HTTPStatus.SERVICE_UNAVAILABLE, b"not ready\n"
+    return None
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    cache = None
+    ready = None
+
+    def do_GET(self):
+        route = _route(self.path, self.ready)
+        if route is not None:
+            status, output = route
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+            return
+
+        accept_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        output = self.cache.get(accept_gzip)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.send_header("Content-Length", str(len(output)))
+        if accept_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """
+        Silences the per-request logging of BaseHTTPRequestHandler.
+        """
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, addr="", cache=None, ready=None):
+    """
+    Starts an HTTP server serving the exposition cache on a daemon thread,
+    like prometheus_client.start_http_server does for the whole registry.
+    ready is an optional callable telling whether /ready should succeed.
+    """
+    handler = type(
+        "MetricsHandler",
+        (_MetricsHandler,),
+        {"cache": cache or ExpositionCache(), "ready": staticmethod(ready)},
+    )
+    httpd = _ThreadingHTTPServer((addr, port), handler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    return httpd
+
+
+class AsyncHTTPServer:
+    """
+    Minimal HTTP/1.1 server running on its own asyncio loop, serving the
+    same endpoints as start_http_server. Connections are kept alive for
+    keepalive_seconds between requests, fresh renderings of the exposition
+    cache are served straight from the loop and stale ones are rendered on
+    an executor, so that the loop never waits on the registry.
+    """
+
+    keepalive_seconds = 75
+    max_header_bytes = 16 * 1024
+
+    def __init__(self, cache=None, ready=None):
+        self._cache = cache or ExpositionCache()
+        self._ready = ready
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self.log = logging.getLogger("http-server")
+
+    @property
+    def server_address(self):
+        return self._server.sockets[0].getsockname()
+
+    def start(self, port, addr=""):
+        """
+        Binds the server and starts serving on a daemon thread.
+        """
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(
+                self._handle, addr or None, port, limit=self.max_header_bytes
+            )
+        )
+        t = threading.Thread(target=self._loop.run_forever, name="http-server")
+        t.daemon = True
+        t.start()
+
+    def shutdown(self):
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), self.keepalive_seconds
+                    )
+                except (
+                    asyncio.TimeoutError,
+                    asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError,
+                    ConnectionError,
+                ):
+                    break
+                keep_alive = await self._respond(head, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        except Exception:  # pragma: no cover
+            self.log.exception("Error while serving a request")
+        finally:
+            writer.close()
+
+    async def _respond(self, head, writer):
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, path, version = lines[0].split(" ")
+        except ValueError:
+            self._write(writer, HTTPStatus.BAD_REQUEST, b"", keep_alive=False)
+            return False
+
+        headers = dict()
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name:
+                headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+
+        if method not in ("GET", "HEAD"):
+            # The request body is left unread, close rather than parse it as
+            # the next request.
+            self._write(writer, HTTPStatus.METHOD_NOT_ALLOWED, b"", False)
+            return False
+
+        route = _route(path, self._ready)
+        if route is not None:
+            status, body = route
+            self._write(writer, status, body, keep_alive, method=method)
+            return keep_alive
+
+        accept_gzip = "gzip" in headers.get("accept-encoding", "")
+        body = self._cache.peek(accept_gzip)
+        if body is None:
+            body = await self._loop.run_in_executor(None, self._cache.get, accept_gzip)
+        extra = [("Vary", "Accept-Encoding")]
+        if accept_gzip:
+            extra.append(("Content-Encoding", "gzip"))
+        self._write(
+            writer,
+            HTTPStatus.OK,
+            body,
+            keep_alive,
+            content_type=CONTENT_TYPE_LATEST,
+            headers=extra,
+            method=method,
+        )
+        return keep_alive
+
+    @staticmethod
+    def _write(
+        writer,
+        status,
+        body,
+        keep_alive,
+        content_type="text/plain; charset=utf-8",
+        headers=(),
+        method="GET",
+    ):
+        head = [
+            "HTTP/1.1 {} {}".format(status.value, status.phrase),
+            "Content-Type: {}".format(content_type),
+            "Content-Length: {}".format(len(body)),
+            "Connection: {}".format("keep-alive" if keep_alive else "close"),
+        ]
+        head.extend("{}: {}".format(name, value) for name, value in headers)
+        writer.write("\r\n".join(head).encode("latin-1") + b"\r\n\r\n")
+        if method != "HEAD":
+            writer.write(body)
+
+
+def start_asyncio_http_server(port, addr="", cache=None, ready=None):
+    """
+    Starts an AsyncHTTPServer serving the exposition cache on a daemon
+    thread. ready is an optional callable telling whether /ready should
+    succeed.
+    """
+    server = AsyncHTTPServer(cache, ready)
+    server.start(port, addr)
+    return server
@@ -1,18 +1,665 @@
+import collections
+import threading
+import time
+from itertools import chain
+
+import celery.states
 import prometheus_client
+from prometheus_client.core import (
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    HistogramMetricFamily,
+    SummaryMetricFamily,
+)
+from prometheus_client.utils import floatToGoString
+
+BUCKETS = prometheus_client.Histogram.DEFAULT_BUCKETS
+RETRY_BUCKETS = (0, 1, 2, 3, 5, 10)
+# as the native sketches
+SKETCH_QUANTILES = (0.5, 0.9, 0.99)
+SKETCH_MAX_BINS = 2048
+
+
+class TaskMetricsCollector:
+    """
+    Exposes the task counters, the runtime, latency, broker wait and end to
+    end histograms, or summaries when sketching, and the retries histograms,
+    aggregated natively by CeleryState, reading a snapshot out of it at
+    scrape time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = dict()
+        # task routes by namespace, replaced as a whole when they change
+        self._seeds = dict()
+        # zero-valued series of the seeded tasks, by namespace and label
+        self._seeded = dict()
+
+    def track(self, namespace, state):
+        """
+        Exposes the metrics aggregated by state under namespace, replacing
+        any state previously tracked for it.
+        """
+        with self._lock:
+            self._states[namespace] = state
+            if namespace in self._seeds:
+                self._seeded[namespace] = _seed(state, self._seeds[namespace])
+
+    def seed(self, namespace, routes):
+        """
+        Exposes zero-valued series for the tasks of routes, mapping task
+        names to their queue, so that data is available even before their
+        first event is received. Tasks seeded before and missing from
+        routes are retired. The task names are folded into their label
+        here, by the state tracked for namespace, rather than on scrapes.
+        Returns the numbers of tasks added, including the rerouted ones,
+        and retired.
+        """
+        with self._lock:
+            known = self._seeds.get(namespace, {})
+            added = sum(1 for name, queue in routes.items() if known.get(name) != queue)
+            retired = len(known.keys() - routes.keys())
+            if added or retired:
+                self._seeds[namespace] = dict(routes)
+                self._seeded[namespace] = _seed(self._states.get(namespace), routes)
+        return added, retired
+
+    def describe(self):
+        return self._families()
+
+    def collect(self):
+        (
+            tasks,
+            runtime,
+            latency,
+            up,
+            active,
+            processed,
+            loadavg,
+            events,
+            lag,
+            in_memory,
+            evicted,
+            expired,
+            dropped,
+            malformed,
+            sample_rate,
+            runtime_summary,
+            latency_summary,
+            broker_wait,
+            end_to_end,
+            retries,
+            broker_wait_summary,
+            end_to_end_summary,
+        ) = self._families()
+        now = time.time()
+        with self._lock:
+            states = dict(self._states)
+            seeds = dict(self._seeded)
+
+        for namespace in set(states) | set(seeds):
+            state = states.get(namespace)
+            if state is not None:
+                snapshot, summaries = state.snapshot(), state.summaries()
+                runtime_bounds = _bounds(state.buckets)
+                latency_bounds = _bounds(state.latency_buckets)
+                retry_bounds = _bounds(state.retry_buckets)
+                sketching = state.sketch_accuracy is not None
+                workers = state.workers(now)
+                stats = state.stats()
+            else:
+                snapshot, summaries = ([],) * 6, ([],) * 4
+                runtime_bounds = latency_bounds = _bounds(BUCKETS)
+                retry_bounds = _bounds(RETRY_BUCKETS)
+                sketching = False
+                workers = []
+                stats = None
+            (
+                tasks_snap,
+                runtime_snap,
+                latency_snap,
+                broker_wait_snap,
+                end_to_end_snap,
+                retries_snap,
+            ) = snapshot
+            (
+                runtime_quantiles,
+                latency_quantiles,
+                broker_wait_quantiles,
+                end_to_end_quantiles,
+            ) = summaries
+
+            seeded = seeds.get(namespace, {})
+            top = state.top_task_names() if state is not None else None
+            counts, latencies = dict(), dict()
+            for label in seeded if top is None else seeded.keys() & set(top):
+                seeded_counts, seeded_latencies = seeded[label]
+                counts.update(seeded_counts)
+                if not sketching:
+                    latencies.update(seeded_latencies)
+            counts.update(
+                ((name, st, queue), cnt) for name, st, queue, cnt in tasks_snap
+            )
+            latencies.update(
+                ((name, queue), (cumulative, total))
+                for name, queue, cumulative, total in latency_snap
+            )
+
+            zeros = [0] * len(latency_bounds)
+
+            for (name, st, queue), cnt in counts.items():
+                tasks.add_metric([namespace, name, st, queue], cnt)
+            for family, histograms, bounds in (
+                (runtime, runtime_snap, runtime_bounds),
+                (broker_wait, broker_wait_snap, latency_bounds),
+                (end_to_end, end_to_end_snap, runtime_bounds),
+                (retries, retries_snap, retry_bounds),
+            ):
+                for name, queue, cumulative, total in histograms:
+                    family.add_metric(
+                        [namespace, name, queue], list(zip(bounds, cumulative)), total
+                    )
+            for (name, queue), (cumulative, total) in latencies.items():
+                latency.add_metric(
+                    [namespace, name, queue],
+                    list(zip(latency_bounds, cumulative or zeros)),
+                    total,
+                )
+            for family, series in (
+                (runtime_summary, runtime_quantiles),
+                (latency_summary, latency_quantiles),
+                (broker_wait_summary, broker_wait_quantiles),
+                (end_to_end_summary, end_to_end_quantiles),
+            ):
+                for name, queue, quantiles, cnt, total in series:
+                    _add_summary(
+                        family, [namespace, name, queue], quantiles, cnt, total
+                    )
+
+            for hostname, _, alive, active_tasks, processed_tasks, load, _ in workers:
+                up.add_metric([namespace, hostname], int(alive))
+                if active_tasks is not None:
+                    active.add_metric([namespace, hostname], active_tasks)
+                if processed_tasks is not None:
+                    processed.add_metric([namespace, hostname], processed_tasks)
+                if load is not None:
+                    for period, value in zip(("1m", "5m", "15m"), load):
+                        loadavg.add_metric([namespace, hostname, period], value)
+
+            if stats is not None:
+                (
+                    event_counts,
+                    lag_buckets,
+                    lags,
+                    size,
+                    capacity,
+                    evictions,
+                    expirations,
+                    dropped_events,
+                    malformed_bodies,
+                    rate,
+                ) = stats
+                for kind, cnt in event_counts:
+                    events.add_metric([namespace, kind], cnt)
+                lag_bounds = [floatToGoString(b) for b in lag_buckets] + ["+Inf"]
+                for stage, cumulative, total in lags:
+                    lag.add_metric(
+                        [namespace, stage], list(zip(lag_bounds, cumulative)), total
+                    )
+                in_memory.add_metric([namespace, "size"], size)
+                in_memory.add_metric([namespace, "capacity"], capacity)
+                evicted.add_metric([namespace], evictions)
+                expired.add_metric([namespace], expirations)
+                dropped.add_metric([namespace], dropped_events)
+                malformed.add_metric([namespace], malformed_bodies)
+                sample_rate.add_metric([namespace], rate)
+
+        yield tasks
+        yield runtime
+        yield latency
+        yield up
+        yield active
+        yield processed
+        yield loadavg
+        yield events
+        yield lag
+        yield in_memory
+        yield evicted
+        yield expired
+        yield dropped
+        yield malformed
+        yield sample_rate
+        yield runtime_summary
+        yield latency_summary
+        yield broker_wait
+        yield end_to_end
+        yield retries
+        yield broker_wait_summary
+        yield end_to_end_summary
+
+    @staticmethod
+    def _families():
+        return [
+            CounterMetricFamily(
+                "celery_tasks_total",
+                "Number of task events.",
+                labels=["namespace", "name", "state", "queue"],
+            ),
+            HistogramMetricFamily(
+                "celery_tasks_runtime_seconds",
+                "Task runtime.",
+                labels=["namespace", "name", "queue"],
+            ),
+            HistogramMetricFamily(
+                "celery_tasks_latency_seconds",
+                "Time between a task is received and started.",
+                labels=["namespace", "name", "queue"],
+            ),
+            GaugeMetricFamily(
+                "celery_worker_up",
+                "Whether the worker is alive according to its heartbeats.",
+                labels=["namespace", "hostname"],
+            ),
+            GaugeMetricFamily(
+                "celery_worker_tasks_active",
+                "Number of tasks the worker is executing.",
+                labels=["namespace", "hostname"],
+            ),
+            CounterMetricFamily(
+                "celery_worker_tasks_processed_total",
+                "Number of tasks processed by the worker.",
+                labels=["namespace", "hostname"],
+            ),
+            GaugeMetricFamily(
+                "celery_worker_load_average",
+                "Load average of the worker host.",
+                labels=["namespace", "hostname", "period"],
+            ),
+            CounterMetricFamily(
+                "celery_exporter_events_total",
+                "Number of events ingested by the exporter.",
+                labels=["namespace", "type"],
+            ),
+            HistogramMetricFamily(
+                "celery_exporter_event_lag_seconds",
+                "Delay of the events through the broker, from their timestamp "
+                "to their reception, and through the exporter, from their "
+                "reception to their processing.",
+                labels=["namespace", "stage"],
+            ),
+            GaugeMetricFamily(
+                "celery_exporter_tasks_in_memory",
+                "Number of tasks tracked in memory, and how many can be.",
+                labels=["namespace", "kind"],
+            ),
+            CounterMetricFamily(
+                "celery_exporter_tasks_evicted_total",
+                "Number of tasks evicted from memory before their end.",
+                labels=["namespace"],
+            ),
+            CounterMetricFamily(
+                "celery_exporter_tasks_expired_total",
+                "Number of tasks expired from memory, not ended within their TTL.",
+                labels=["namespace"],
+            ),
+            CounterMetricFamily(
+                "celery_exporter_events_dropped_total",
+                "Number of events dropped by the exporter, received faster than "
+                "processed.",
+                labels=["namespace"],
+            ),
+            CounterMetricFamily(
+                "celery_exporter_events_malformed_total",
+                "Number of event messages whose body could not be parsed.",
+                labels=["namespace"],
+            ),
+            GaugeMetricFamily(
+                "celery_exporter_sample_rate",
+                "Fraction of the tasks tracked, the task metrics being scaled "
+                "up accordingly.",
+                labels=["namespace"],
+            ),
+            SummaryMetricFamily(
+                "celery_tasks_runtime_summary_seconds",
+                "Task runtime quantiles, when sketching.",
+                labels=["namespace", "name", "queue"],
+            ),
+            SummaryMetricFamily(
+                "celery_tasks_latency_summary_seconds",
+                "Quantiles of the time between a task is received and started, "
+                "when sketching.",
+                labels=["namespace", "name", "queue"],
+            ),
+            HistogramMetricFamily(
+                "celery_tasks_broker_wait_seconds",
+                "Time between a task is sent and first received by a worker.",
+                labels=["namespace", "name", "queue"],
+            ),
+            HistogramMetricFamily(
+                "celery_tasks_end_to_end_seconds",
+                "Time between a task is sent and succeeds or fails.",
+                labels=["namespace", "name", "queue"],
+            ),
+            HistogramMetricFamily(
+                "celery_tasks_retries",
+                "Number of retries of the tasks which succeeded or failed.",
+                labels=["namespace", "name", "queue"],
+            ),
+            SummaryMetricFamily(
+                "celery_tasks_broker_wait_summary_seconds",
+                "Quantiles of the time between a task is sent and first received "
+                "by a worker, when sketching.",
+                labels=["namespace", "name", "queue"],
+            ),
+            SummaryMetricFamily(
+                "celery_tasks_end_to_end_summary_seconds",
+                "Quantiles of the time between a task is sent and succeeds or "
+                "fails, when sketching.",
+                labels=["namespace", "name", "queue"],
+            ),
+        ]
+
+
+def _bounds(buckets):
+    bounds = [floatToGoString(b) for b in buckets if b != float("inf")]
+    bounds.append("+Inf")
+    return bounds
+
+
+def _seed(state, routes):
+    """
+    Returns the zero-valued task counters and latency histograms of the
+    tasks of routes, by the label their name is folded into by state.
+    """
+    seeded = dict()
+    for name, queue in routes.items():
+        label = name if state is None else state.fold_task_name(name)
+        if label is None:
+            continue
+        counts, latencies = seeded.setdefault(label, (dict(), dict()))
+        for st in celery.states.ALL_STATES:
+            counts[(label, st, queue)] = 0
+        latencies[(label, queue)] = (None, 0)
+    return seeded
+
+
+def _sketch_quantiles(gamma, bins, zeros, count):
+    """
+    Returns the SKETCH_QUANTILES of a sketch of bins of width gamma, given as
+    a mapping of their indexes to their counts, as the native sketches do,
+    merging the lowest bins past SKETCH_MAX_BINS.
+    """
+    bins = sorted(bins.items())
+    while len(bins) > SKETCH_MAX_BINS:
+        _, lowest = bins.pop(0)
+        bins[0] = (bins[0][0], bins[0][1] + lowest)
+    return [
+        (q, _sketch_quantile(gamma, bins, zeros, count, q)) for q in SKETCH_QUANTILES
+    ]
+
+
+def _sketch_quantile(gamma, bins, zeros, count, q):
+    if not count:
+        return float("nan")
+    rank = int(q * (count - 1))
+    if rank < zeros:
+        return 0.0
+    seen = zeros
+    for index, cnt in bins:
+        seen += cnt
+        if seen > rank:
+            # the middle of the bin, relatively to its bounds
+            return 2 * gamma ** index / (gamma + 1)
+    return float("nan")
+
+
+def _add_summary(family, labels, quantiles, count, total):
+    """
+    Adds a summary with quantiles to family, which SummaryMetricFamily
+    only supports with counts and sums.
+    """
+    family.add_metric(labels, count, total)
+    values = dict(zip(family._labelnames, labels))
+    for quantile, value in quantiles:
+        family.add_sample(
+            family.name, dict(values, quantile=floatToGoString(quantile)), value
+        )
+
+
+class ShardedState:
+    """
+    Merges the latest snapshots published by the shards of a sharded
+    ingestion, exposing them like a single CeleryState. Every shard tracks
+    the workers from all their events, but only sees the task events of its
+    own tasks, and counts in its stats the events no other shard counts.
+    The replies to the pings are left for the ingestion to hand over to
+    the shards, every shard tracking the workers alike.
+    """
+
+    def __init__(
+        self,
+        shards,
+        buckets,
+        task_names=None,
+        latency_buckets=None,
+        sketch_accuracy=None,
+        retry_buckets=RETRY_BUCKETS,
+    ):
+        self._lock = threading.Lock()
+        self._task_names = task_names
+        # tasks, runtime, latency, broker wait, end to end and retries
+        self._snapshots = [([],) * 6] * shards
+        # sketches of the runtime, latency, broker wait and end to end
+        self._sketches = [([],) * 4] * shards
+        self._stats = [None] * shards
+        self._workers = [[]] * shards
+        self._dropped = 0  # events dropped before reaching the shards
+        self._pings = []  # (hostnames, now) of the pings not handed over yet
+        self.buckets = [b for b in buckets if b != float("inf")]
+        self.latency_buckets = [
+            b for b in latency_buckets or buckets if b != float("inf")
+        ]
+        self.sketch_accuracy = sketch_accuracy
+        self.retry_buckets = [b for b in retry_buckets if b != float("inf")]
 
-TASKS = prometheus_client.Counter(
-    "celery_tasks_total",
-    "Number of task events.",
-    ["namespace", "name", "state", "queue"],
+    def update(self, shard, snapshot, workers, stats=None, sketches=None):
+        with self._lock:
+            self._snapshots[shard] = snapshot
+            self._sketches[shard] = sketches or ([],) * 4
+            self._stats[shard] = stats
+            self._workers[shard] = workers
+
+    def record_dropped(self, count):
+        with self._lock:
+            self._dropped += count
+
+    def workers(self, now):
+        with self._lock:
+            shards_workers = list(self._workers)
+        # a worker emits task events if any shard saw one of them lately
+        emitting = {
+            hostname
+            for workers in shards_workers
+            for hostname, *_, worker_emitting in workers
+            if worker_emitting
+        }
+        return [worker[:-1] + (worker[0] in emitting,) for worker in shards_workers[0]]
+
+    def workers_stale(self, now):
+        workers = self.workers(now)
+        return not workers or any(
+            online and not alive for _, online, alive, *_ in workers
+        )
+
+    def alive_workers(self, now):
+        return sum(1 for _, _, alive, *_ in self.workers(now) if alive)
+
+    def silent_workers(self, now):
+        return [
+            hostname
+            for hostname, _, alive, *_, emitting in self.workers(now)
+            if alive and not emitting
+        ]
+
+    def workers_pinged(self, hostnames, now):
+        with self._lock:
+            self._pings.append((list(hostnames), now))
+
+    def take_pings(self):
+        """
+        Returns the pings recorded since the last call, for the shards to
+        apply them to their workers.
+        """
+        with self._lock:
+            pings, self._pings = self._pings, []
+        return pings
+
+    def fold_task_name(self, name):
+        if self._task_names is None:
+            return name
+        return self._task_names.label(name)
+
+    def top_task_names(self):
+        if self._task_names is None or self._task_names.top_k is None:
+            return None
+        # each shard keeps the busiest names of its own tasks, none is seeded
+        return []
+
+    def stats(self):
+        with self._lock:
+            shards_stats = list(self._stats)
+            routing_dropped = self._dropped
+        if shards_stats[0] is None:
+            return None
+
+        # each event is counted by a single shard, the counts add up
+        reported = [s for s in shards_stats if s is not None]
+        events = collections.Counter()
+        lags = collections.OrderedDict()
+        for shard_events, _, shard_lags, *_ in reported:
+            events.update(dict(shard_events))
+            for name, cumulative, total in shard_lags:
+                merged = lags.setdefault(name, [[0] * len(cumulative), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], cumulative)]
+                merged[1] += total
+        size, capacity, evictions, expirations, dropped, malformed = [
+            sum(counts) for counts in zip(*(s[3:9] for s in reported))
+        ]
+        # the shards hold as many tasks, their rates average to the overall one
+        sample_rate = sum(s[9] for s in reported) / len(reported)
+        return (
+            list(events.items()),
+            shards_stats[0][1],
+            [(name, cumulative, total) for name, (cumulative, total) in lags.items()],
+            size,
+            capacity,
+            evictions,
+            expirations,
+            dropped + routing_dropped,
+            malformed,
+            sample_rate,
+        )
+
+    def snapshot(self):
+        with self._lock:
+            snapshots = list(self._snapshots)
+
+        tasks = collections.Counter()
+        histograms = [dict() for _ in snapshots[0][1:]]
+        for tasks_snap, *histograms_snaps in snapshots:
+            for name, state, queue, cnt in tasks_snap:
+                tasks[(name, state, queue)] += cnt
+            for merged, snap in zip(histograms, histograms_snaps):
+                self._merge_histograms(merged, snap)
+
+        return ([key + (cnt,) for key, cnt in tasks.items()],) + tuple(
+            [key + tuple(value) for key, value in merged.items()]
+            for merged in histograms
+        )
+
+    def summaries(self):
+        """
+        Merges the sketches of the shards, adding up their bins as a single
+        sketch seeing all the tasks would have counted them, and returns
+        their quantiles.
+        """
+        if not self.sketch_accuracy:
+            return ([],) * 4
+        with self._lock:
+            sketches = list(self._sketches)
+        gamma = (1 + self.sketch_accuracy) / (1 - self.sketch_accuracy)
+
+        merged = []
+        for shards_sketches in zip(*sketches):
+            series = dict()
+            for name, queue, bins, zeros, cnt, total in chain.from_iterable(
+                shards_sketches
+            ):
+                sketch = series.setdefault(
+                    (name, queue), [collections.Counter(), 0, 0, 0.0]
+                )
+                sketch[0].update(dict(bins))
+                sketch[1] += zeros
+                sketch[2] += cnt
+                sketch[3] += total
+            merged.append(
+                [
+                    (
+                        name,
+                        queue,
+                        _sketch_quantiles(gamma, bins, zeros, cnt),
+                        cnt,
+                        total,
+                    )
+                    for (name, queue), (bins, zeros, cnt, total) in series.items()
+                ]
+            )
+        return tuple(merged)
+
+    @staticmethod
+    def _merge_histograms(merged, histograms):
+        for name, queue, cumulative, total in histograms:
+            current = merged.get((name, queue))
+            if current is None:
+                merged[(name, queue)] = [list(cumulative), total]
+            else:
+                current[0] = [a + b for a, b in zip(current[0], cumulative)]
+                current[1] += total
+
+
+TASK_METRICS = TaskMetricsCollector()
+prometheus_client.REGISTRY.register(TASK_METRICS)
+
+WORKERS = prometheus_client.Gauge(
+    "celery_workers", "Number of alive workers", ["namespace"]
 )
-TASKS_RUNTIME = prometheus_client.Histogram(
-    "celery_tasks_runtime_seconds", "Task runtime.", ["namespace", "name", "queue"]
+
+QUEUE_LENGTH = prometheus_client.Gauge(
+    "celery_queue_length",
+    "Number of messages waiting in the queue",
+    ["namespace", "queue"],
 )
-LATENCY = prometheus_client.Histogram(
-    "celery_tasks_latency_seconds",
-    "Time between a task is received and started.",
-    ["namespace", "name", "queue"],
+
+BATCH_PROCESSING_TIME = prometheus_client.Histogram(
+    "celery_exporter_batch_processing_seconds",
+    "Time spent processing a batch of events",
+    ["namespace"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0),
 )
-WORKERS = prometheus_client.Gauge(
-    "celery_workers", "Number of alive workers", ["namespace"]
+
+GET_CONFIG_TIME = prometheus_client.Histogram(
+    "celery_exporter_get_config_seconds",
+    "Time spent fetching the workers config",
+    ["namespace"],
+)
+
+PING_TIME = prometheus_client.Histogram(
+    "celery_exporter_ping_seconds", "Time spent pinging the workers", ["namespace"]
+)
+
+RENDER_TIME = prometheus_client.Histogram(
+    "celery_exporter_scrape_render_seconds",
+    "Time spent rendering the metrics for scrapes",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
 )
@@ -1,128 +1,855 @@
 import collections
+import heapq
 import logging
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
 import threading
 import time
-from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 
-import celery
-import celery.states
+from celery.events.receiver import EventReceiver
+from celery.utils.time import utcoffset
 
-from .celery_exporter import CeleryState
-from .metrics import LATENCY, TASKS, TASKS_RUNTIME, WORKERS
-from .utils import get_config
+from .celery_exporter import CeleryState, EventRouter, TaskNames
+from .metrics import (
+    BATCH_PROCESSING_TIME,
+    BUCKETS,
+    GET_CONFIG_TIME,
+    PING_TIME,
+    QUEUE_LENGTH,
+    RETRY_BUCKETS,
+    TASK_METRICS,
+    WORKERS,
+    ShardedState,
+)
+from .utils import (
+    Backoff,
+    ControlChannel,
+    EventBuffer,
+    QueueSampler,
+    RedisEventConsumer,
+)
+
+
+class RawEventReceiver(EventReceiver):
+    """
+    EventReceiver passing handler the raw JSON bodies of the event messages
+    as (body, local_received) tuples, for CeleryState.process_batch to parse
+    only the fields it needs instead of kombu decoding whole dicts. Messages
+    of any other content type, or compressed, are decoded and passed as
+    event dicts.
+    """
+
+    def __init__(self, channel, handler, **kwargs):
+        super(RawEventReceiver, self).__init__(
+            channel, handlers={"*": handler}, **kwargs
+        )
+        self._handler = handler
+
+    def get_consumers(self, Consumer, channel):
+        return [
+            Consumer(
+                queues=[self.queue],
+                on_message=self._on_message,
+                no_ack=True,
+                accept=self.accept,
+            )
+        ]
+
+    def _on_message(self, message):
+        if message.content_type != "application/json" or message.headers.get(
+            "compression"
+        ):
+            self._receive(message.decode(), message)
+            return
+        body = message.body
+        if isinstance(body, str):
+            body = body.encode(message.content_encoding or "utf-8")
+        elif not isinstance(body, bytes):
+            body = bytes(body)
+        self._handler((body, time.time()))
 
 
 class TaskThread(threading.Thread):
     """
     MonitorThread is the thread that will collect the data that is later
-    exposed from Celery using its eventing system.
+    exposed from Celery using its eventing system. The connected event is
+    set once the receiver has read from the broker, until the connection
+    fails.
+
+    With a checkpoint_path, the tasks in memory are restored from it on
+    start and written to it every checkpoint_interval seconds, so that a
+    restart does not lose track of the tasks in flight. task_names holds
+    the keyword arguments of the TaskNames bounding the task name labels.
+    Runtimes and latencies are counted in histograms over runtime_buckets
+    and latency_buckets, or in sketches of relative sketch_accuracy.
+
+    The receiver only buffers the raw bodies of the event messages,
+    processed in batches by a thread of their own so that a slow update
+    never stalls the consumption from the broker. Past event_buffer_size
+    buffered messages, some are dropped as per overflow_policy, one of
+    EventBuffer.POLICIES.
+
+    With a sample_rate below 1, only that fraction of the tasks is tracked,
+    picked by uuid, their events counting for the tasks left out. With a
+    sample_max_lag, the rate is lowered while the events are processed
+    later than that many seconds after their reception.
+
+    With redis_consumer, the events of a Redis broker are read by a
+    RedisEventConsumer rather than the kombu event loop. Failed connections
+    are retried after a Backoff delay.
+
+    With a state, the events are processed into it rather than into a
+    CeleryState built from the options above.
     """
 
-    def __init__(self, app, namespace, max_tasks_in_memory, *args, **kwargs):
+    batch_size = 512
+    event_buffer_size = 65536
+    flush_interval_seconds = 1
+
+    def __init__(
+        self,
+        app,
+        namespace,
+        max_tasks_in_memory,
+        *args,
+        shard_index=0,
+        shard_count=1,
+        config_cache=None,
+        task_ttl=None,
+        max_bytes=None,
+        checkpoint_path=None,
+        checkpoint_interval=60,
+        task_names=None,
+        runtime_buckets=None,
+        latency_buckets=None,
+        sketch_accuracy=None,
+        event_buffer_size=None,
+        overflow_policy="drop-oldest",
+        sample_rate=None,
+        sample_max_lag=None,
+        redis_consumer=False,
+        state=None,
+        **kwargs
+    ):
         self._app = app
         self._namespace = namespace
+        self._config_cache = config_cache
+        self._checkpoint_path = checkpoint_path
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_lock = threading.Lock()
         self.log = logging.getLogger("task-thread")
-        self._state = CeleryState(max_tasks_in_memory=max_tasks_in_memory)
-        self._known_states = set()
-        self._known_states_names = set()
-        self._tasks_started = dict()
+        self._state = state or CeleryState(
+            max_tasks_in_memory=max_tasks_in_memory,
+            buckets=runtime_buckets or BUCKETS,
+            shard_index=shard_index,
+            shard_count=shard_count,
+            task_ttl=task_ttl,
+            max_bytes=max_bytes,
+            task_names=TaskNames(**task_names) if task_names else None,
+            latency_buckets=latency_buckets or BUCKETS,
+            sketch_accuracy=sketch_accuracy,
+            retry_buckets=RETRY_BUCKETS,
+            sample_rate=sample_rate,
+            sample_max_lag=sample_max_lag,
+        )
+        TASK_METRICS.track(namespace, self._state)
+        self._buffer = EventBuffer(
+            event_buffer_size or self.event_buffer_size, overflow_policy
+        )
+        self._redis_consumer = redis_consumer
+        self._backoff = Backoff()
+        self._reading = False
+        self._last_checkpoint = time.monotonic()
+        self.connected = threading.Event()
+        if checkpoint_path:
+            self._restore()
         super(TaskThread, self).__init__(*args, **kwargs)
 
+    @property
+    def state(self):
+        return self._state
+
     def run(self):  # pragma: no cover
+        threading.Thread(
+            target=self._process_events, name="event-processing", daemon=True
+        ).start()
         self._monitor()
 
-    def _process_event(self, evt):
-        (name, queue, latency) = self._state.latency(evt)
-        if latency is not None:
-            LATENCY.labels(namespace=self._namespace, name=name, queue=queue).observe(
-                latency
-            )
-        (name, state, runtime, queue) = self._state.collect(evt)
+    def shutdown(self):
+        self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Atomically replaces the checkpoint file with the current state.
+        """
+        if not self._checkpoint_path:
+            return
+        with self._checkpoint_lock:
+            self._last_checkpoint = time.monotonic()
+            data = self._state.checkpoint()
+            tmp_path = self._checkpoint_path + ".tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self._checkpoint_path)
+            except OSError:
+                self.log.exception("Error while writing the checkpoint")
+
+    def _restore(self):
+        try:
+            with open(self._checkpoint_path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    loaded = self._state.restore(data)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            self.log.exception("Error while restoring the checkpoint")
+            return
+        self.log.info("Restored %d tasks from the checkpoint", loaded)
+
+    def _setup_metrics(self):
+        config = self._config_cache.get() if self._config_cache else {}
+        setup_metrics(self._namespace, config)
 
-        if name is not None:
-            if runtime is not None:
-                TASKS_RUNTIME.labels(
-                    namespace=self._namespace, name=name, queue=queue
-                ).observe(runtime)
+    def _process_batch(self, events):
+        with BATCH_PROCESSING_TIME.labels(namespace=self._namespace).time():
+            self._state.process_batch(events, utcoffset=utcoffset())
 
-            TASKS.labels(
-                namespace=self._namespace, name=name, state=state, queue=queue
-            ).inc()
+    def _on_event(self, evt):
+        self._buffer.push(evt)
+
+    def _on_iteration(self):
+        # Called before each read: from the second on, the previous read
+        # went through.
+        if self._reading:
+            self._on_read()
+        self._reading = True
+
+    def _on_read(self):
+        if not self.connected.is_set():
+            self.connected.set()
+            self._backoff.reset()
+
+    def _drain(self, timeout=None):
+        """
+        Processes a batch of the buffered events, waiting up to timeout
+        seconds for one, and counts the events dropped meanwhile. Returns
+        the number of events processed.
+        """
+        batch = self._buffer.pop(self.batch_size, timeout)
+        dropped = self._buffer.take_dropped()
+        if dropped:
+            self._state.record_dropped(dropped)
+        if batch:
+            self._process_batch(batch)
+        return len(batch)
+
+    def _process_events(self):  # pragma: no cover
+        while True:
+            self._drain(self.flush_interval_seconds)
+            if (
+                self._checkpoint_path
+                and time.monotonic() - self._last_checkpoint
+                >= self._checkpoint_interval
+            ):
+                self.checkpoint()
 
     def _monitor(self):  # pragma: no cover
         while True:
             try:
                 with self._app.connection() as conn:
-                    recv = self._app.events.Receiver(
-                        conn, handlers={"*": self._process_event}
-                    )
-                    setup_metrics(self._app, self._namespace)
+                    recv = RawEventReceiver(conn, self._on_event, app=self._app)
+                    recv.on_iteration = self._on_iteration
+                    self._reading = False
+                    self._setup_metrics()
                     self.log.info("Start capturing events...")
-                    recv.capture(limit=None, timeout=None, wakeup=True)
+                    if self._redis_consumer and conn.transport.driver_type == "redis":
+                        self._consume_redis(recv)
+                    else:
+                        recv.capture(limit=None, timeout=None, wakeup=True)
             except Exception:
                 self.log.exception("Connection failed")
-                setup_metrics(self._app, self._namespace)
-                time.sleep(5)
+                self.connected.clear()
+                self._setup_metrics()
+                time.sleep(self._backoff.next())
 
+    def _consume_redis(self, recv):  # pragma: no cover
+        consumer = RedisEventConsumer(
+            recv.channel, recv.exchange.name, recv._on_message, recv.routing_key
+        )
+        consumer.subscribe()
+        try:
+            recv.wakeup_workers(channel=recv.channel)
+            while True:
+                consumer.drain(self.flush_interval_seconds)
+                self._on_read()
+        finally:
+            consumer.close()
+
+
+class ShardTaskThread(TaskThread):
+    """
+    TaskThread of an ingestion process, processing the batches of events
+    the parent process routes to its shard through events_conn rather than
+    consuming them from the broker. Its metrics are exposed by the parent
+    process instead.
+    """
+
+    def __init__(self, events_conn, *args, **kwargs):
+        self._events_conn = events_conn
+        super(ShardTaskThread, self).__init__(None, *args, **kwargs)
+
+    def _setup_metrics(self):
+        pass
+
+    def _monitor(self):  # pragma: no cover
+        while True:
+            try:
+                events, routes, pings = self._events_conn.recv()
+            except EOFError:
+                return
+            if routes:
+                self._state.learn_routes(routes)
+            for hostnames, now in pings:
+                self._state.workers_pinged(hostnames, now)
+            if events:
+                self._process_batch(events)
+
+
+class IngestionProcess(multiprocessing.get_context("spawn").Process):
+    """
+    Process tracking the tasks of one shard from the events the parent
+    process routes to it through events_conn, periodically sending the
+    snapshot of its CeleryState back through conn. It checkpoints its
+    state when terminated, or once the parent closes events_conn.
+
+    It is spawned rather than forked, starting from a fresh interpreter
+    that inherits neither the threads, their locks included, nor the
+    connections of the parent, so that it can be restarted at any time.
+    """
+
+    publish_interval_seconds = 1
+
+    def __init__(
+        self,
+        namespace,
+        max_tasks_in_memory,
+        shard_index,
+        shard_count,
+        events_conn,
+        conn,
+        task_ttl=None,
+        max_bytes=None,
+        checkpoint_path=None,
+        checkpoint_interval=60,
+        task_names=None,
+        runtime_buckets=None,
+        latency_buckets=None,
+        sketch_accuracy=None,
+        sample_rate=None,
+        sample_max_lag=None,
+    ):
+        self._namespace = namespace
+        self._max_tasks_in_memory = max_tasks_in_memory
+        self._shard_index = shard_index
+        self._shard_count = shard_count
+        self._events_conn = events_conn
+        self._conn = conn
+        self._task_ttl = task_ttl
+        self._max_bytes = max_bytes
+        self._checkpoint_path = checkpoint_path
+        self._checkpoint_interval = checkpoint_interval
+        self._task_names = task_names
+        self._runtime_buckets = runtime_buckets
+        self._latency_buckets = latency_buckets
+        self._sketch_accuracy = sketch_accuracy
+        self._sample_rate = sample_rate
+        self._sample_max_lag = sample_max_lag
+        super(IngestionProcess, self).__init__(
+            name="ingestion-{}".format(shard_index), daemon=True
+        )
+
+    def run(self):  # pragma: no cover
+        t = ShardTaskThread(
+            events_conn=self._events_conn,
+            namespace=self._namespace,
+            max_tasks_in_memory=self._max_tasks_in_memory,
+            shard_index=self._shard_index,
+            shard_count=self._shard_count,
+            task_ttl=self._task_ttl,
+            max_bytes=self._max_bytes,
+            checkpoint_path=self._checkpoint_path,
+            checkpoint_interval=self._checkpoint_interval,
+            task_names=self._task_names,
+            runtime_buckets=self._runtime_buckets,
+            latency_buckets=self._latency_buckets,
+            sketch_accuracy=self._sketch_accuracy,
+            sample_rate=self._sample_rate,
+            sample_max_lag=self._sample_max_lag,
+        )
+        t.daemon = True
+        t.start()
+
+        def shutdown(signum, frame):
+            t.shutdown()
+            sys.exit(0)
+
+        signal.signal(signal.SIGTERM, shutdown)
+
+        while t.is_alive():
+            time.sleep(self.publish_interval_seconds)
+            self._conn.send(
+                (
+                    t.state.snapshot(),
+                    t.state.sketches(),
+                    t.state.workers(time.time()),
+                    t.state.stats(),
+                )
+            )
+        t.shutdown()
+
+
+class ShardedIngestionThread(TaskThread):
+    """
+    TaskThread handing the events it receives over to one IngestionProcess
+    per shard rather than processing them itself. An EventRouter splits
+    each batch of raw bodies before they are parsed, sending each process
+    the events of its own tasks along with all the worker events and the
+    routes of all the tasks, so that the processes parse the stream in
+    parallel, each its own share of it. The replies to the pings of the
+    workers go to every process as well, even while no event comes in.
+    The snapshots the processes publish are merged into a ShardedState
+    exposed under namespace, and processes that die are restarted, the
+    events routed to them meanwhile being dropped. With a checkpoint_path,
+    each process checkpoints its shard to that path suffixed by the shard
+    index.
+    """
+
+    def __init__(
+        self,
+        app,
+        namespace,
+        max_tasks_in_memory,
+        processes,
+        *args,
+        config_cache=None,
+        task_ttl=None,
+        max_bytes=None,
+        checkpoint_path=None,
+        checkpoint_interval=60,
+        task_names=None,
+        runtime_buckets=None,
+        latency_buckets=None,
+        sketch_accuracy=None,
+        event_buffer_size=None,
+        overflow_policy="drop-oldest",
+        sample_rate=None,
+        sample_max_lag=None,
+        redis_consumer=False,
+        **kwargs
+    ):
+        self._max_tasks_in_memory = max_tasks_in_memory
+        self._processes = processes
+        self._task_ttl = task_ttl
+        self._max_bytes = max_bytes
+        self._shards_checkpoint_path = checkpoint_path
+        self._task_names = task_names
+        self._runtime_buckets = runtime_buckets
+        self._latency_buckets = latency_buckets
+        self._sketch_accuracy = sketch_accuracy
+        self._sample_rate = sample_rate
+        self._sample_max_lag = sample_max_lag
+        self._stopping = False
+        self._router = EventRouter(processes)
+        self._events_conns = [None] * processes  # sending the events by shard
+        self._shards = dict()  # shard and process by snapshot connection
+        super(ShardedIngestionThread, self).__init__(
+            app,
+            namespace,
+            max_tasks_in_memory,
+            *args,
+            config_cache=config_cache,
+            checkpoint_interval=checkpoint_interval,
+            event_buffer_size=event_buffer_size,
+            overflow_policy=overflow_policy,
+            redis_consumer=redis_consumer,
+            state=ShardedState(
+                processes,
+                runtime_buckets or BUCKETS,
+                task_names=TaskNames(**task_names) if task_names else None,
+                latency_buckets=latency_buckets or BUCKETS,
+                sketch_accuracy=sketch_accuracy,
+            ),
+            **kwargs
+        )
+        self.log = logging.getLogger("sharded-ingestion-thread")
+
+    def start_processes(self):
+        """
+        Starts the ingestion processes.
+        """
+        for shard in range(self._processes):
+            self._start_process(shard)
+
+    def shutdown(self, timeout=10):
+        """
+        Terminates the ingestion processes, letting them checkpoint.
+        """
+        self._stopping = True
+        processes = [process for _, process in list(self._shards.values())]
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout)
+
+    def run(self):  # pragma: no cover
+        threading.Thread(
+            target=self._supervise, name="shard-supervision", daemon=True
+        ).start()
+        super(ShardedIngestionThread, self).run()
+
+    def _process_batch(self, events):
+        with BATCH_PROCESSING_TIME.labels(namespace=self._namespace).time():
+            batches, routes = self._router.route(events)
+            self._send(batches, routes, self._state.take_pings())
+
+    def _drain(self, timeout=None):
+        processed = super(ShardedIngestionThread, self)._drain(timeout)
+        pings = self._state.take_pings()
+        if pings:
+            self._send([[]] * self._processes, [], pings)
+        return processed
+
+    def _send(self, batches, routes, pings):
+        for shard, batch in enumerate(batches):
+            if not batch and not routes and not pings:
+                continue
+            try:
+                self._events_conns[shard].send((batch, routes, pings))
+            except OSError:
+                # the process died, until it is restarted
+                self._state.record_dropped(len(batch))
+
+    def _supervise(self):  # pragma: no cover
+        while not self._stopping:
+            ready = multiprocessing.connection.wait(list(self._shards))
+            for conn in ready:
+                shard, process = self._shards[conn]
+                try:
+                    snapshot, sketches, workers, stats = conn.recv()
+                except EOFError:
+                    if self._stopping:
+                        return
+                    self.log.error(
+                        "Ingestion process %d exited with %s, restarting",
+                        shard,
+                        process.exitcode,
+                    )
+                    del self._shards[conn]
+                    conn.close()
+                    process.join()
+                    self._start_process(shard)
+                else:
+                    self._state.update(shard, snapshot, workers, stats, sketches)
+
+    def _start_process(self, shard):
+        events_recv, events_send = multiprocessing.Pipe(duplex=False)
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        process = IngestionProcess(
+            namespace=self._namespace,
+            max_tasks_in_memory=self._max_tasks_in_memory,
+            shard_index=shard,
+            shard_count=self._processes,
+            events_conn=events_recv,
+            conn=send_conn,
+            task_ttl=self._task_ttl,
+            max_bytes=self._max_bytes,
+            checkpoint_path=self._shards_checkpoint_path
+            and "{}.{}".format(self._shards_checkpoint_path, shard),
+            checkpoint_interval=self._checkpoint_interval,
+            task_names=self._task_names,
+            runtime_buckets=self._runtime_buckets,
+            latency_buckets=self._latency_buckets,
+            sketch_accuracy=self._sketch_accuracy,
+            sample_rate=self._sample_rate,
+            sample_max_lag=self._sample_max_lag,
+        )
+        process.start()
+        events_recv.close()
+        send_conn.close()
+        previous, self._events_conns[shard] = self._events_conns[shard], events_send
+        if previous is not None:
+            previous.close()
+        self._shards[recv_conn] = (shard, process)
+
+
+class ControlPlane(threading.Thread):
+    """
+    Sends the control commands of an exporter to the workers on a common
+    tick, broadcasting them together over one ControlChannel: a ping when
+    the heartbeats tracked by state go stale, the inspects of the routing
+    table every config_cache.ttl seconds, and with enable_events, the
+    enable_events command to the alive workers that sent no task event
+    lately. The latter goes to all the workers along with the refreshes of
+    the routing table, and while no worker is known, to reach the workers
+    the events don't tell of. Idle workers send no task event either, so a
+    worker is sent enable_events at most every enable_events_interval_seconds
+    besides the refreshes. The pings and the inspects are timed until
+    their latest reply, a broadcast to all the workers lasting the whole
+    reply timeout.
+    """
 
-class WorkerMonitoringThread(threading.Thread):
-    celery_ping_timeout_seconds = 5
     periodicity_seconds = 5
+    reply_timeout_seconds = 2
+    enable_events_interval_seconds = 300
 
-    def __init__(self, app, namespace, *args, **kwargs):
+    def __init__(
+        self,
+        app,
+        namespace,
+        config_cache=None,
+        *args,
+        state=None,
+        enable_events=False,
+        **kwargs
+    ):
         self._app = app
         self._namespace = namespace
-        self.log = logging.getLogger("workers-thread")
-        super(WorkerMonitoringThread, self).__init__(*args, **kwargs)
+        self._config_cache = config_cache
+        self._state = state
+        self._enable_events = enable_events
+        self._channel = ControlChannel(app)
+        self._config_due = 0  # monotonic time of the next config refresh
+        # monotonic time enable_events was last sent, by hostname, None for all
+        self._events_enabled = dict()
+        self.log = logging.getLogger("control-plane")
+        super(ControlPlane, self).__init__(*args, **kwargs)
 
     def run(self):  # pragma: no cover
         while True:
-            self.update_workers_count()
-            time.sleep(self.periodicity_seconds)
+            time.sleep(self.step())
 
-    def update_workers_count(self):
+    def step(self):
         try:
-            WORKERS.labels(namespace=self._namespace).set(
-                len(self._app.control.ping(timeout=self.celery_ping_timeout_seconds))
+            self.tick()
+        except Exception:
+            self.log.exception("Error while sending control commands")
+            self._channel.close()
+        return self.periodicity_seconds
+
+    def tick(self):
+        now = time.time()
+        refresh = (
+            self._config_cache is not None and time.monotonic() >= self._config_due
+        )
+        ping = self._state is None or self._state.workers_stale(now)
+
+        commands = collections.OrderedDict()
+        if ping:
+            commands["ping"] = ({}, None, True)
+        if refresh:
+            commands["registered"] = ({"taskinfoitems": []}, None, True)
+            commands["conf"] = ({"with_defaults": False}, None, True)
+        if self._enable_events:
+            destination = self._silent_workers(now, refresh)
+            if destination is None or destination:
+                commands["enable_events"] = ({}, destination, False)
+
+        # replies by command, along with the seconds until the latest of them
+        replies = dict()
+        if commands:
+            replies = dict(
+                zip(
+                    commands,
+                    self._channel.broadcast(
+                        [(command,) + c for command, c in commands.items()],
+                        timeout=self.reply_timeout_seconds,
+                    ),
+                )
             )
-        except Exception:  # pragma: no cover
-            self.log.exception("Error while pinging workers")
 
+        if "enable_events" in commands:
+            self._events_sent(commands["enable_events"][1])
 
-class EnableEventsThread(threading.Thread):
-    periodicity_seconds = 5
+        if ping:
+            pongs, elapsed = replies["ping"]
+            PING_TIME.labels(namespace=self._namespace).observe(elapsed)
+            if self._state is not None:
+                hostnames = [
+                    h for reply in pongs if isinstance(reply, dict) for h in reply
+                ]
+                self._state.workers_pinged(hostnames, time.time())
+            count = len(pongs)
+        else:
+            count = self._state.alive_workers(now)
+        WORKERS.labels(namespace=self._namespace).set(count)
+
+        if refresh:
+            (registered, registered_time), (conf, conf_time) = (
+                replies["registered"],
+                replies["conf"],
+            )
+            GET_CONFIG_TIME.labels(namespace=self._namespace).observe(
+                max(registered_time, conf_time)
+            )
+            registered_tasks = [
+                tasks for reply in registered for tasks in reply.values()
+            ]
+            confs = {h: c for reply in conf for h, c in reply.items()}
+            config = self._config_cache.update(registered_tasks, confs)
+            setup_metrics(self._namespace, config)
+            self._config_due = time.monotonic() + self._config_cache.ttl
+
+    def _silent_workers(self, now, everyone):
+        """
+        Returns the workers to send enable_events to, None standing for all
+        of them.
+        """
+        if everyone:
+            return None
+        due = time.monotonic() - self.enable_events_interval_seconds
+        sent_to_all = self._events_enabled.get(None, float("-inf"))
+        if self._state is None or not self._state.alive_workers(now):
+            return None if sent_to_all <= due else []
+        return [
+            hostname
+            for hostname in self._state.silent_workers(now)
+            if self._events_enabled.get(hostname, sent_to_all) <= due
+        ]
+
+    def _events_sent(self, destination):
+        sent = time.monotonic()
+        if destination is None:
+            self._events_enabled = {None: sent}
+        else:
+            self._events_enabled.update(dict.fromkeys(destination, sent))
 
-    def __init__(self, app, *args, **kwargs):  # pragma: no cover
+
+class QueueLengthThread(threading.Thread):
+    """
+    Periodically samples the depth of the queues the tasks are routed to,
+    over a connection taken from the app pool and held across samples.
+    """
+
+    periodicity_seconds = 15
+
+    def __init__(self, app, namespace, config_cache, *args, **kwargs):
         self._app = app
-        self.log = logging.getLogger("enable-events-thread")
-        super(EnableEventsThread, self).__init__(*args, **kwargs)
+        self._namespace = namespace
+        self._config_cache = config_cache
+        self._connection = None
+        self._sampler = None
+        self._queues = set()
+        self.log = logging.getLogger("queue-length-thread")
+        super(QueueLengthThread, self).__init__(*args, **kwargs)
 
     def run(self):  # pragma: no cover
         while True:
-            try:
-                self.enable_events()
-            except Exception:
-                self.log.exception("Error while trying to enable events")
-            time.sleep(self.periodicity_seconds)
+            time.sleep(self.step())
+
+    def step(self):
+        self.update_queue_lengths()
+        return self.periodicity_seconds
+
+    def update_queue_lengths(self):
+        queues = sorted(set(self._config_cache.get().values()))
+        try:
+            if self._sampler is None:
+                self._connection = self._app.pool.acquire(block=True)
+                self._sampler = QueueSampler(self._connection)
+            lengths = self._sampler.lengths(queues)
+        except Exception:
+            self.log.exception("Error while sampling queue lengths")
+            self._reset()
+            return
+
+        for queue, length in lengths.items():
+            QUEUE_LENGTH.labels(namespace=self._namespace, queue=queue).set(length)
+        for queue in self._queues - set(lengths):
+            QUEUE_LENGTH.remove(self._namespace, queue)
+        self._queues = set(lengths)
+
+    def _reset(self):
+        """
+        Gives the connection back to the pool after dropping its state, so
+        that it reconnects on its next use.
+        """
+        if self._sampler is not None:
+            self._sampler.close()
+            self._sampler = None
+        if self._connection is not None:
+            self._connection.collect()
+            self._connection.release()
+            self._connection = None
 
-    def enable_events(self):
-        self._app.control.enable_events()
 
+class PeriodicJobs(threading.Thread):
+    """
+    Runs the steps of periodic threads, like ControlPlane.step,
+    on a shared pool of worker threads instead of a thread each, so that
+    many exporters can share a handful of threads. A step returns the
+    seconds to wait before running it again.
+    """
 
-def setup_metrics(app, namespace):
+    def __init__(self, workers=4, *args, **kwargs):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="periodic-job"
+        )
+        self._cond = threading.Condition()
+        self._jobs = []  # heap of (due, seq, step)
+        self._seq = count()
+        self.log = logging.getLogger("periodic-jobs")
+        super(PeriodicJobs, self).__init__(*args, **kwargs)
+
+    def schedule(self, step, delay=0):
+        with self._cond:
+            heapq.heappush(
+                self._jobs, (time.monotonic() + delay, next(self._seq), step)
+            )
+            self._cond.notify()
+
+    def run(self):  # pragma: no cover
+        while True:
+            with self._cond:
+                while not self._jobs or self._jobs[0][0] > time.monotonic():
+                    timeout = (
+                        self._jobs[0][0] - time.monotonic() if self._jobs else None
+                    )
+                    self._cond.wait(timeout)
+                _, _, step = heapq.heappop(self._jobs)
+            self._executor.submit(self._run_step, step)
+
+    def _run_step(self, step):
+        try:
+            delay = step()
+        except Exception:
+            self.log.exception("Error while running %r", step)
+            delay = 5
+        self.schedule(step, delay)
+
+
+def setup_metrics(namespace, config):
     """
     This initializes the available metrics with default values so that
-    even before the first event is received, data can be exposed.
+    even before the first event is received, data can be exposed, from
+    config, the routing table of the workers. Only the tasks that appeared
+    or disappeared since the last call are seeded or retired, and an empty
+    config, as when no worker replied, leaves the seeded tasks as they are.
     """
     WORKERS.labels(namespace=namespace)
-    config = get_config(app)
-
-    if not config:  # pragma: no cover
-        for metric in TASKS.collect():
-            for name, labels, cnt, timestamp, exemplar in metric.samples:
-                TASKS.labels(**labels)
-    else:
-        for task, queue in config.items():
-            LATENCY.labels(namespace=namespace, name=task, queue=queue)
-            for state in celery.states.ALL_STATES:
-                TASKS.labels(namespace=namespace, name=task, state=state, queue=queue)
+    if not config:
+        return
+
+    added, retired = TASK_METRICS.seed(namespace, config)
+    if added or retired:
+        logging.getLogger("setup-metrics").debug(
+            "Seeded %d tasks and retired %d in %s", added, retired, namespace
+        )
@@ -1,47 +1,482 @@
+import json
+import random
+import socket
 import ssl
+import threading
+import time
 from itertools import chain
 from urllib.parse import urlparse
 
+from kombu import Consumer, Producer, Queue
+from kombu.utils.uuid import uuid
+
 CELERY_DEFAULT_QUEUE = "celery"
 CELERY_MISSING_DATA = "undefined"
 
 
-def _gen_wildcards(name):
-    chunked = name.split(".")
-    res = [name]
-    for elem in reversed(chunked):
-        chunked.pop()
-        res.append(".".join(chunked + ["*"]))
-    return res
+class RouteIndex:
+    """
+    Prefix trie over the keys of task_routes, resolving the queue of a task
+    in a single walk over the dotted segments of its name. Exact names take
+    precedence over wildcards, and longer wildcards over shorter ones, the
+    same as probing the name and then its wildcards, from "a.b.*" to "*".
+    """
+
+    __slots__ = ("_root",)
+
+    def __init__(self, routes):
+        self._root = _RouteNode()
+        for key, route in routes.items():
+            if not isinstance(route, dict) or "queue" not in route:
+                continue
+            if key == "*":
+                self._root.wildcard = route["queue"]
+            elif key.endswith(".*"):
+                self._node(key[:-2]).wildcard = route["queue"]
+            else:
+                self._node(key).exact = route["queue"]
+
+    def _node(self, path):
+        node = self._root
+        for segment in path.split("."):
+            node = node.children.setdefault(segment, _RouteNode())
+        return node
+
+    def resolve(self, task_name):
+        """
+        Returns the queue task_name is routed to, or None if no route
+        matches it.
+        """
+        *parents, last = task_name.split(".")
+        node = self._root
+        queue = node.wildcard
+        for segment in parents:
+            node = node.children.get(segment)
+            if node is None:
+                return queue
+            if node.wildcard is not None:
+                queue = node.wildcard
+        node = node.children.get(last)
+        if node is not None and node.exact is not None:
+            return node.exact
+        return queue
+
 
+class _RouteNode:
+    __slots__ = ("children", "exact", "wildcard")
+
+    def __init__(self):
+        self.children = dict()
+        self.exact = None
+        self.wildcard = None
+
+
+def resolve_routes(registered_tasks, confs):
+    """
+    Returns the queue of every registered task: the first queue, in workers
+    order, a task is explicitly routed to outside of the default queues,
+    otherwise the queue the last worker resolves it to.
+    """
+    default_queues = set()
+    resolvers = []  # (default queue, RouteIndex), one per distinct conf
+    indexes = dict()
+    for conf in confs.values():
+        default = conf.get("task_default_queue", CELERY_DEFAULT_QUEUE)
+        routes = conf.get("task_routes")
+        if not isinstance(routes, dict):
+            routes = dict()
+        key = (default, json.dumps(routes, sort_keys=True, default=repr))
+        if key not in indexes:
+            indexes[key] = (default, RouteIndex(routes))
+            resolvers.append(indexes[key])
+        default_queues.add(default)
+        last = indexes[key]
 
-def get_config(app):
     res = dict()
-    try:
-        registered_tasks = app.control.inspect().registered_tasks().values()
-        confs = app.control.inspect().conf()
-    except Exception:  # pragma: no cover
+    if not resolvers:
         return res
 
-    default_queues = []
     for task_name in set(chain.from_iterable(registered_tasks)):
-        for conf in confs.values():
-            default = conf.get("task_default_queue", CELERY_DEFAULT_QUEUE)
-            default_queues.append(default)
-            if task_name in res and res[task_name] not in default_queues:
+        for default, index in resolvers:
+            queue = index.resolve(task_name)
+            if queue is not None and queue not in default_queues:
+                res[task_name] = queue
                 break
+        else:
+            default, index = last
+            queue = index.resolve(task_name)
+            res[task_name] = default if queue is None else queue
+    return res
+
+
+class ConfigCache:
+    """
+    Caches the task routing table of the workers, so that readers never
+    wait on the inspect broadcasts. It is meant to be updated every ttl
+    seconds from the replies to the inspect commands, by a ControlPlane,
+    and keeps serving the last known table when an update fails or gets no
+    reply. The refreshed event is set after the first update some worker
+    replied to.
+    """
+
+    def __init__(self, app, ttl=60):
+        self._app = app
+        self._lock = threading.Lock()
+        self._config = dict()
+        self.refreshed = threading.Event()
+        self.ttl = ttl
+
+    def get(self):
+        with self._lock:
+            return dict(self._config)
+
+    def update(self, registered_tasks, confs):
+        """
+        Resolves the routing table from the tasks registered by the workers
+        and their configuration, as replied to the inspect commands, and
+        returns it. Without any reply, the last known table is kept.
+        """
+        if not registered_tasks and not confs:
+            return self.get()
+        config = resolve_routes(registered_tasks, confs)
+        with self._lock:
+            self._config = config
+        self.refreshed.set()
+        return dict(config)
+
+
+class ControlChannel:
+    """
+    Broadcasts control commands to the workers over a single connection
+    taken from the app pool and held across broadcasts. The commands of a
+    broadcast are all sent at once, and their replies collected together
+    from the one reply queue of the channel.
+    """
+
+    def __init__(self, app):
+        self._app = app
+        self._connection = None
+        self._consumer = None
+        self._mailbox = None
+        self._oid = uuid()
+        self._replies = dict()  # by ticket, of the commands being collected
+        self._replied = dict()  # time of the latest reply, by ticket
+
+    def broadcast(self, commands, timeout=1.0):
+        """
+        Sends commands, a list of (command, arguments, destination, reply)
+        where a destination of None stands for all the workers. Returns the
+        replies to each command sent with reply, otherwise None, collected
+        for up to timeout seconds or until every destination replied, along
+        with the seconds until the latest of them, or until the end of the
+        collection if none came.
+        """
+        if self._connection is None:
+            self._open()
+        tickets = [uuid() if reply else None for _, _, _, reply in commands]
+        self._replies = {ticket: [] for ticket in tickets if ticket}
+        start = time.monotonic()
+        producer = Producer(self._connection.default_channel)
+        for (command, arguments, destination, _), ticket in zip(commands, tickets):
+            message = {
+                "method": command,
+                "arguments": arguments,
+                "destination": destination,
+                "pattern": None,
+                "matcher": None,
+            }
+            if ticket:
+                message.update(
+                    ticket=ticket,
+                    reply_to={
+                        "exchange": self._mailbox.reply_exchange.name,
+                        "routing_key": self._oid,
+                    },
+                )
+            producer.publish(
+                message,
+                exchange=self._mailbox.exchange.name,
+                declare=[self._mailbox.exchange],
+                headers={
+                    "clock": self._app.clock.forward(),
+                    "expires": time.time() + timeout,
+                },
+                serializer=self._mailbox.serializer,
+                retry=True,
+            )
+
+        limits = {
+            ticket: len(destination) if destination is not None else None
+            for (_, _, destination, _), ticket in zip(commands, tickets)
+            if ticket
+        }
+        deadline = time.monotonic() + timeout
+        while any(
+            limit is None or len(self._replies[ticket]) < limit
+            for ticket, limit in limits.items()
+        ):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self._connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                break
+        end = time.monotonic()
+        replies, self._replies = self._replies, dict()
+        replied, self._replied = self._replied, dict()
+        return [
+            (
+                (replies[ticket], replied.get(ticket, end) - start)
+                if ticket
+                else (None, None)
+            )
+            for ticket in tickets
+        ]
+
+    def _open(self):
+        self._connection = self._app.pool.acquire(block=True)
+        self._mailbox = self._app.control.mailbox(self._connection)
+        queue = Queue(
+            "{}.{}".format(self._oid, self._mailbox.reply_exchange.name),
+            exchange=self._mailbox.reply_exchange,
+            routing_key=self._oid,
+            durable=False,
+            auto_delete=True,
+            expires=self._mailbox.reply_queue_expires,
+            message_ttl=self._mailbox.reply_queue_ttl,
+        )
+        self._consumer = Consumer(
+            self._connection.default_channel,
+            [queue],
+            callbacks=[self._on_reply],
+            accept=self._mailbox.accept,
+            no_ack=True,
+        )
+        self._consumer.consume()
+
+    def _on_reply(self, body, message):
+        replies = self._replies.get(message.headers.get("ticket"))
+        if replies is not None:
+            replies.append(body)
+            self._replied[message.headers["ticket"]] = time.monotonic()
+
+    def close(self):
+        """
+        Gives the connection back to the pool after dropping its state, so
+        that it reconnects on its next use.
+        """
+        if self._connection is not None:
+            self._connection.collect()
+            self._connection.release()
+            self._connection = None
+            self._consumer = None
+
+
+class EventBuffer:
+    """
+    Bounded ring buffer handing the events over from the thread receiving
+    them to the one processing them, its capacity slots allocated upfront.
+    When full, the "drop-oldest" policy overwrites the oldest event, while
+    "sample" keeps a uniform sample of the events received until it is
+    drained, replacing buffered events at random.
+    """
+
+    POLICIES = ("drop-oldest", "sample")
+
+    def __init__(self, capacity, policy="drop-oldest"):
+        if capacity < 1:
+            raise ValueError("Invalid event buffer capacity {}".format(capacity))
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown overflow policy {!r}".format(policy))
+        self._slots = [None] * capacity
+        self._head = 0  # slot of the oldest event
+        self._size = 0
+        self._overflow = 0  # events received while full, since last drained
+        self._dropped = 0
+        self._sample = policy == "sample"
+        self._random = random.Random()
+        self._not_empty = threading.Condition(threading.Lock())
 
-            task_wildcard_names = _gen_wildcards(task_name)
-            if "task_routes" in conf:
-                routes = conf["task_routes"]
-                res[task_name] = default
-                for i in task_wildcard_names:
-                    if i in routes and "queue" in routes[i]:
-                        res[task_name] = routes[i]["queue"]
-                        break
+    def __len__(self):
+        with self._not_empty:
+            return self._size
+
+    def push(self, evt):
+        with self._not_empty:
+            capacity = len(self._slots)
+            if self._size < capacity:
+                self._slots[(self._head + self._size) % capacity] = evt
+                self._size += 1
+                self._not_empty.notify()
+                return
+            self._dropped += 1
+            if not self._sample:
+                self._slots[self._head] = evt
+                self._head = (self._head + 1) % capacity
+                return
+            self._overflow += 1
+            slot = self._random.randrange(capacity + self._overflow)
+            if slot < capacity:
+                self._slots[(self._head + slot) % capacity] = evt
+
+    def pop(self, max_events, timeout=None):
+        """
+        Removes and returns up to max_events of the oldest events, waiting
+        up to timeout seconds for one if empty.
+        """
+        with self._not_empty:
+            if not self._size:
+                self._not_empty.wait(timeout)
+            count = min(self._size, max_events)
+            capacity = len(self._slots)
+            start, end = self._head, self._head + count
+            if end <= capacity:
+                events = self._slots[start:end]
+                self._slots[start:end] = [None] * count
             else:
-                res[task_name] = default
-    return res
+                events = self._slots[start:] + self._slots[: end - capacity]
+                self._slots[start:] = [None] * (capacity - start)
+                self._slots[: end - capacity] = [None] * (end - capacity)
+            self._head = end % capacity
+            self._size -= count
+            if not self._size:
+                self._overflow = 0
+            return events
+
+    def take_dropped(self):
+        """
+        Returns the number of events dropped since the last call.
+        """
+        with self._not_empty:
+            dropped, self._dropped = self._dropped, 0
+            return dropped
+
+
+class QueueSampler:
+    """
+    Samples the number of messages waiting in queues over a single channel
+    of connection, reused across samples. On Redis all the lengths are read
+    in one pipelined round-trip, other transports are asked with a passive
+    queue_declare per queue. Queues missing on the broker are reported empty.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._channel = None
+
+    def lengths(self, queues):
+        queues = list(queues)
+        if self._channel is None:
+            self._channel = self._connection.channel()
+        if self._connection.transport.driver_type == "redis":
+            return _redis_queue_lengths(self._channel, queues)
+
+        lengths = dict()
+        for queue in queues:
+            try:
+                ok = self._channel.queue_declare(queue, passive=True)
+            except self._connection.channel_errors:
+                # a failed passive declare closes the channel on AMQP
+                lengths[queue] = 0
+                self.close()
+                self._channel = self._connection.channel()
+            else:
+                lengths[queue] = ok.message_count
+        return lengths
+
+    def close(self):
+        if self._channel is not None:
+            try:
+                self._channel.close()
+            except Exception:  # pragma: no cover
+                pass
+            self._channel = None
+
+
+def _redis_queue_lengths(channel, queues):
+    """
+    Sums the lengths of the lists backing every priority of the queues.
+    """
+    steps = channel.priority_steps
+    pipe = channel.client.pipeline(transaction=False)
+    for queue in queues:
+        for priority in steps:
+            pipe.llen(channel._q_for_pri(queue, priority))
+    counts = pipe.execute()
+    return {
+        queue: sum(counts[i * len(steps) : (i + 1) * len(steps)])
+        for i, queue in enumerate(queues)
+    }
+
+
+class RedisEventConsumer:
+    """
+    Consumes the events of a Redis broker straight from the pub/sub channel
+    kombu emulates the fanout exchange with, instead of polling it through
+    the kombu event loop. Each drain waits for a message, then reads the
+    ones already received without waiting, up to batch_size of them, and
+    passes them all to on_message as kombu messages.
+    """
+
+    batch_size = 512
+
+    def __init__(self, channel, exchange, on_message, routing_key="#"):
+        self._channel = channel
+        self._on_message = on_message
+        self._pubsub = None
+        self.topic = channel._get_publish_topic(exchange, routing_key.replace("#", "*"))
+
+    def subscribe(self):
+        self._pubsub = self._channel.client.pubsub()
+        self._pubsub.psubscribe(self.topic)
+
+    def drain(self, timeout):
+        """
+        Reads the messages received, waiting up to timeout seconds for the
+        first one, and returns the number of messages read.
+        """
+        count = 0
+        message = self._pubsub.get_message(timeout=timeout)
+        while message is not None:
+            if message["type"] in ("message", "pmessage"):
+                payload = json.loads(message["data"])
+                self._on_message(self._channel.message_to_python(payload))
+                count += 1
+                if count >= self.batch_size:
+                    break
+            message = self._pubsub.get_message(timeout=0)
+        return count
+
+    def close(self):
+        if self._pubsub is not None:
+            try:
+                self._pubsub.close()
+            except Exception:  # pragma: no cover
+                pass
+            self._pubsub = None
+
+
+class Backoff:
+    """
+    Delays between reconnection attempts, doubling from initial up to
+    maximum seconds. Each delay is shortened by a random fraction of up to
+    jitter, so that exporters restarted together don't reconnect in step.
+    """
+
+    def __init__(self, initial=1, maximum=60, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self._delay = initial
+        self._random = random.Random()
+
+    def next(self):
+        delay, self._delay = self._delay, min(self._delay * 2, self.maximum)
+        return delay * (1 - self.jitter * self._random.random())
+
+    def reset(self):
+        self._delay = self.initial
 
 
 def get_transport_scheme(broker_url):
@@ -76,3 +511,35 @@ def generate_broker_use_ssl(
         f"{prefix}ca_certs": ssl_ca_certs,
         f"{prefix}cert_reqs": verify_map.get(ssl_verify),
     }
+
+
+def parse_buckets(spec):
+    """
+    Parses the bounds of histogram buckets, either listed as in
+    "0.1,0.5,1", or laid out as "exp:START:FACTOR:COUNT" for COUNT bounds
+    growing by FACTOR from START, or "lin:START:WIDTH:COUNT" for COUNT
+    bounds WIDTH apart from START.
+    """
+    kind, _, params = spec.partition(":")
+    if kind not in ("exp", "lin"):
+        bounds = [float(b) for b in spec.split(",")]
+    else:
+        try:
+            start, step, count = params.split(":")
+            start, step, count = float(start), float(step), int(count)
+        except ValueError:
+            raise ValueError(f"Invalid buckets layout: {spec}")
+        if count < 1:
+            raise ValueError(f"Invalid buckets count: {count}")
+        if kind == "exp":
+            if start <= 0 or step <= 1:
+                raise ValueError(f"Invalid exponential buckets: {spec}")
+            bounds = [start * step ** i for i in range(count)]
+        else:
+            if step <= 0:
+                raise ValueError(f"Invalid linear buckets: {spec}")
+            bounds = [start + step * i for i in range(count)]
+
+    if any(a >= b for a, b in zip(bounds, bounds[1:])):
+        raise ValueError(f"Buckets are not in increasing order: {spec}")
+    return bounds
@@ -1,14 +1,97 @@
 use lru::LruCache;
-use std::collections::HashMap;
+use regex::{Regex, RegexSet};
+use serde::de::{self, Deserialize, Deserializer};
+use std::borrow::Cow;
+use std::collections::hash_map::DefaultHasher;
+use std::collections::{BTreeMap, BTreeSet, HashMap, HashSet, VecDeque};
 use std::fmt;
+use std::hash::{Hash, Hasher};
+use std::mem::size_of;
+use std::sync::Mutex;
+use std::time::{SystemTime, UNIX_EPOCH};
 
+use pyo3::buffer::{PyBuffer, ReadOnlyCell};
+use pyo3::exceptions::PyValueError;
 use pyo3::prelude::*;
-use pyo3::types::PyDict;
+use pyo3::types::{PyBytes, PyDict, PyList};
 
 static CELERY_MISSING_DATA: &'static str = "undefined";
+const MISSING: u32 = 0; // interned id of CELERY_MISSING_DATA
+static OTHER_LABEL: &'static str = "other";
+const OTHER: u32 = 1; // interned id of OTHER_LABEL
+const MISSING_UUID: u128 = 0;
 
 type CollectOutcome = (Option<String>, Option<String>, Option<f64>, Option<String>); // name, state, runtime, queue
 type LatencyOutcome = (Option<String>, Option<String>, Option<f64>);
+type TasksSnapshot = Vec<(String, &'static str, String, u64)>; // name, state, queue, count
+type HistogramsSnapshot = Vec<(String, String, Vec<u64>, f64)>; // name, queue, cumulative buckets, sum
+type Snapshot = (
+    TasksSnapshot,
+    HistogramsSnapshot,
+    HistogramsSnapshot,
+    HistogramsSnapshot,
+    HistogramsSnapshot,
+    HistogramsSnapshot,
+); // tasks, runtime, latency, broker wait, end to end, retries
+type SummariesSnapshot = Vec<(String, String, Vec<(f64, f64)>, u64, f64)>; // name, queue, quantiles, count, sum
+type Summaries = (
+    SummariesSnapshot,
+    SummariesSnapshot,
+    SummariesSnapshot,
+    SummariesSnapshot,
+); // runtime, latency, broker wait, end to end
+type SketchesSnapshot = Vec<(String, String, Vec<(i32, u64)>, u64, u64, f64)>; // name, queue, bins, zeros, count, sum
+type Sketches = (
+    SketchesSnapshot,
+    SketchesSnapshot,
+    SketchesSnapshot,
+    SketchesSnapshot,
+); // runtime, latency, broker wait, end to end
+
+type WorkersSnapshot = Vec<(
+    String,
+    bool,
+    bool,
+    Option<u64>,
+    Option<u64>,
+    Option<(f64, f64, f64)>,
+    bool,
+)>; // hostname, online, alive, active, processed, loadavg, sending task events
+
+type StatsSnapshot = (
+    Vec<(String, u64)>,
+    Vec<f64>,
+    Vec<(&'static str, Vec<u64>, f64)>,
+    usize,
+    usize,
+    u64,
+    u64,
+    u64,
+    u64,
+    f64,
+); // events by type, lag bounds, lag histograms by stage, tasks in memory, capacity, evictions, expirations, dropped, malformed, sample rate
+
+const HEARTBEAT_FREQ: f64 = 2.0; // celery's default worker heartbeat interval
+const HEARTBEAT_EXPIRE_WINDOW: f64 = 3.0; // in heartbeat intervals, as celery.events.state
+const WORKER_FORGET_SECONDS: f64 = 3600.0;
+const TASK_EVENTS_WINDOW: f64 = 30.0; // seconds a worker counts as sending task events after one
+
+static DEFAULT_BUCKETS: [f64; 14] = [
+    0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0,
+];
+
+static DEFAULT_RETRY_BUCKETS: [f64; 6] = [0.0, 1.0, 2.0, 3.0, 5.0, 10.0];
+
+const MAX_SAMPLE_SHIFT: u8 = 10; // sampling down to one task in 1024
+const SAMPLE_ADJUST_SECONDS: f64 = 1.0;
+
+static SKETCH_QUANTILES: [f64; 3] = [0.5, 0.9, 0.99];
+const SKETCH_MAX_BINS: usize = 2048;
+const SKETCH_MIN_VALUE: f64 = 1e-9; // smaller values are counted as zeros
+
+static LAG_BUCKETS: [f64; 12] = [
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0,
+];
 
 fn is_task_event(kind: &str) -> bool {
     if kind.contains("task") {
@@ -17,60 +100,625 @@ fn is_task_event(kind: &str) -> bool {
     false
 }
 
-#[derive(Clone)]
+fn is_worker_event(kind: &str) -> bool {
+    match kind {
+        "worker-online" | "worker-heartbeat" | "worker-offline" => true,
+        _ => false,
+    }
+}
+
+/// Packs a task id into 128 bits. Canonical UUIDs are parsed as such, any
+/// other custom task id is hashed into 128 bits instead.
+fn parse_uuid(id: &str) -> u128 {
+    let mut value: u128 = 0;
+    let mut digits = 0;
+    for c in id.chars() {
+        if c == '-' {
+            continue;
+        }
+        match c.to_digit(16) {
+            Some(d) if digits < 32 => {
+                value = (value << 4) | d as u128;
+                digits += 1;
+            }
+            _ => return hash_uuid(id),
+        }
+    }
+    if digits != 32 {
+        return hash_uuid(id);
+    }
+    value
+}
+
+fn hash_uuid(id: &str) -> u128 {
+    let mut high = DefaultHasher::new();
+    id.hash(&mut high);
+    let mut low = DefaultHasher::new();
+    (id, CELERY_MISSING_DATA).hash(&mut low);
+    ((high.finish() as u128) << 64) | low.finish() as u128
+}
+
+/// The slice of the task id space a CeleryState is responsible for, so that
+/// all the events of a task are processed by the same shard.
+struct Shard {
+    index: u32,
+    count: u32,
+}
+
+impl Shard {
+    fn owns(&self, uuid: u128) -> bool {
+        shard_of(uuid, self.count) == self.index
+    }
+
+    /// Whether the ingestion stats of this shard count evt: those of the
+    /// shard owning its task for a task event, of the first one otherwise.
+    fn counts<L>(&self, evt: &Event<L>) -> bool {
+        match evt {
+            Event::Task(task) => self.owns(task.uuid),
+            Event::Worker(_) => self.index == 0,
+        }
+    }
+}
+
+/// The index of the shard owning the task uuid out of count.
+fn shard_of(uuid: u128, count: u32) -> u32 {
+    if count == 1 {
+        return 0;
+    }
+    (uuid_hash(uuid) % count as u64) as u32
+}
+
+/// splitmix64 finalizer of a task uuid, spreading custom task ids evenly as
+/// well.
+fn uuid_hash(uuid: u128) -> u64 {
+    let mut h = (uuid as u64) ^ ((uuid >> 64) as u64);
+    h = (h ^ (h >> 30)).wrapping_mul(0xbf58476d1ce4e5b9);
+    h = (h ^ (h >> 27)).wrapping_mul(0x94d049bb133111eb);
+    h ^ (h >> 31)
+}
+
+/// Deterministic sampling of the tasks by the hash of their uuid, keeping
+/// one task in 2^shift, those whose hash starts with shift zero bits: the
+/// tasks sampled at a rate are sampled at any higher one, and the sampling
+/// is independent of the sharding, which uses the low bits.
+///
+/// With a max_lag, the rate halves whenever events are processed later
+/// than that after their reception, and doubles back, up to the configured
+/// rate, once they are processed in less than half of it, at most once per
+/// SAMPLE_ADJUST_SECONDS of event time.
+struct Sampler {
+    shift: u8,
+    min_shift: u8, // of the configured rate
+    max_lag: Option<f64>,
+    adjusted: f64, // clock of the latest adjustment
+}
+
+impl Sampler {
+    fn new(rate: f64, max_lag: Option<f64>) -> Self {
+        let shift = (-rate.log2()).round().max(0.0).min(MAX_SAMPLE_SHIFT as f64) as u8;
+        Self {
+            shift,
+            min_shift: shift,
+            max_lag,
+            adjusted: f64::NEG_INFINITY,
+        }
+    }
+
+    fn samples(&self, uuid: u128) -> bool {
+        self.shift == 0 || uuid_hash(uuid) >> (64 - self.shift as u32) == 0
+    }
+
+    fn rate(&self) -> f64 {
+        1.0 / (1u64 << self.shift) as f64
+    }
+
+    fn adapt(&mut self, lag: f64, clock: f64) {
+        let max_lag = match self.max_lag {
+            Some(max_lag) => max_lag,
+            None => return,
+        };
+        if clock - self.adjusted < SAMPLE_ADJUST_SECONDS {
+            return;
+        }
+        if lag > max_lag && self.shift < MAX_SAMPLE_SHIFT {
+            self.shift += 1;
+            self.adjusted = clock;
+        } else if lag < max_lag / 2.0 && self.shift > self.min_shift {
+            self.shift -= 1;
+            self.adjusted = clock;
+        }
+    }
+}
+
+/// A task tracked in the LRU, keyed by its 128-bit uuid. The times it was
+/// sent and received are kept as offsets from its first event, NaN until
+/// seen. Its events count for 2^shift, the sampling shift it was first
+/// seen with.
+#[derive(Clone, Copy)]
 struct Task {
-    uuid: String,
-    name: String,
+    name: u32,
     local_received: f64,
-    runtime: Option<f64>,
     state: TaskState,
+    shift: u8,
+    retries: u16,
+    sent: f32,
+    received: f32,
 }
 
-impl Default for Task {
-    fn default() -> Self {
+impl Task {
+    fn new(name: u32, local_received: f64, state: TaskState) -> Self {
         Self {
-            uuid: CELERY_MISSING_DATA.to_string(),
-            name: CELERY_MISSING_DATA.to_string(),
-            local_received: 0.0,
-            runtime: None,
-            state: TaskState::UNDEFINED,
+            name,
+            local_received,
+            state,
+            shift: 0,
+            retries: 0,
+            sent: f32::NAN,
+            received: f32::NAN,
+        }
+    }
+
+    /// Time of an offset, None if unset.
+    fn at(&self, offset: f32) -> Option<f64> {
+        if offset.is_nan() {
+            None
+        } else {
+            Some(self.local_received + offset as f64)
+        }
+    }
+
+    /// Records a non terminal event of the task. Returns the time it waited
+    /// in the broker when first received after being sent.
+    fn mark(&mut self, state: TaskState, local_received: f64) -> Option<f64> {
+        let offset = (local_received - self.local_received) as f32;
+        let mut broker_wait = None;
+        match state {
+            TaskState::PENDING if self.sent.is_nan() => self.sent = offset,
+            TaskState::RECEIVED => {
+                if self.received.is_nan() {
+                    broker_wait = self.at(self.sent).map(|sent| local_received - sent);
+                }
+                // a retried task is received again, its latency counts from there
+                self.received = offset;
+            }
+            TaskState::RETRY => self.retries = self.retries.saturating_add(1),
+            _ => {}
         }
+        self.state = state;
+        broker_wait
     }
 }
 
-impl Task {
-    fn update_from_event(&mut self, evt: &PyDict) -> PyResult<()> {
-        let kind: String = evt
-            .get_item("type")
-            .expect("Invalid Event: missing type")
-            .extract()?;
-        let splitted = kind.split("-");
-        let state = splitted.collect::<Vec<&str>>()[1];
-        let uuid = evt.get_item("uuid");
-        let name = evt.get_item("name");
-
-        if is_task_event(&kind) {
-            if let Some(u) = uuid {
-                self.uuid = u.to_string();
-            }
-            self.state = TaskState::from_event(state);
-            self.local_received = evt
-                .get_item("local_received")
-                .expect("Invalid Event: missing local_received")
-                .extract()?;
-            match name {
-                Some(n) => self.name = n.extract()?,
-                None => {}
-            }
-            if let Some(r) = evt.get_item("runtime") {
-                self.runtime = Some(r.extract()?);
+/// Approximate memory taken by a task in memory: its LRU node, the hash map
+/// slot pointing at it, its entries in the time wheel, up to two as the
+/// wheel is compacted past twice the LRU capacity, and allocator overhead.
+const TASK_ENTRY_BYTES: usize = size_of::<u128>()
+    + size_of::<Task>()
+    + 2 * size_of::<usize>()
+    + 2 * size_of::<usize>()
+    + 2 * size_of::<u128>()
+    + 16;
+
+/// Expires the tasks tracked for longer than a TTL. Tasks are bucketed by
+/// the second they were first seen, so that expiring only walks the due
+/// buckets instead of the whole LRU. The entries of the tasks ended or
+/// evicted meanwhile are left in place until compacted.
+struct TimeWheel {
+    ttl: f64,
+    slots: VecDeque<(i64, Vec<u128>)>,
+    entries: usize,
+}
+
+impl TimeWheel {
+    fn new(ttl: f64) -> Self {
+        Self {
+            ttl,
+            slots: VecDeque::new(),
+            entries: 0,
+        }
+    }
+
+    fn insert(&mut self, uuid: u128, at: f64) {
+        let slot = at.floor() as i64;
+        self.entries += 1;
+        match self.slots.back_mut() {
+            // late events join the latest slot, expiring a bit later
+            Some((last, uuids)) if *last >= slot => uuids.push(uuid),
+            _ => self.slots.push_back((slot, vec![uuid])),
+        }
+    }
+
+    /// Keeps only the entries for which keep, given the uuid and the slot,
+    /// returns true.
+    fn compact<F: Fn(u128, i64) -> bool>(&mut self, keep: F) {
+        for (slot, uuids) in self.slots.iter_mut() {
+            let slot = *slot;
+            uuids.retain(|uuid| keep(*uuid, slot));
+            uuids.shrink_to_fit();
+        }
+        self.slots.retain(|(_, uuids)| !uuids.is_empty());
+        self.entries = self.slots.iter().map(|(_, uuids)| uuids.len()).sum();
+    }
+
+    /// Removes and returns the tasks of the slots older than the TTL.
+    fn due(&mut self, now: f64) -> Vec<u128> {
+        let cutoff = (now - self.ttl).floor() as i64;
+        let mut due = Vec::new();
+        while let Some((slot, _)) = self.slots.front() {
+            if *slot >= cutoff {
+                break;
+            }
+            if let Some((_, uuids)) = self.slots.pop_front() {
+                self.entries -= uuids.len();
+                due.extend(uuids);
             }
         }
-        Ok(())
+        due
+    }
+}
+
+/// The fields of a task event needed to update the state, labelled either
+/// by the strings borrowed from the event dict or by their interned ids.
+struct TaskEvent<L> {
+    uuid: u128,
+    name: Option<L>,
+    queue: Option<L>,
+    hostname: Option<L>, // of the worker, left out of task-sent events
+    state: TaskState,
+    local_received: f64,
+    runtime: Option<f64>,
+}
+
+impl<'a> TaskEvent<&'a str> {
+    /// Copies the needed fields out of a task event dict.
+    fn from_dict(evt: &'a PyDict, kind: &'a str) -> PyResult<Self> {
+        let uuid = match evt.get_item("uuid") {
+            Some(u) => parse_uuid(u.str()?.to_str()?),
+            None => MISSING_UUID,
+        };
+        let name = match evt.get_item("name") {
+            Some(n) => Some(n.extract()?),
+            None => None,
+        };
+        let queue = match evt.get_item("queue") {
+            Some(q) => Some(q.extract()?),
+            None => None,
+        };
+        let runtime = match evt.get_item("runtime") {
+            Some(r) => Some(r.extract()?),
+            None => None,
+        };
+        let hostname = match evt.get_item("hostname") {
+            Some(h) if kind != "task-sent" => Some(h.extract()?),
+            _ => None,
+        };
+        Ok(TaskEvent {
+            uuid,
+            name,
+            queue,
+            hostname,
+            state: TaskState::from_event(kind.splitn(2, "-").nth(1).unwrap_or("")),
+            local_received: local_received(evt)?,
+            runtime,
+        })
+    }
+
+    /// Borrows the needed fields of a task event parsed from its raw body.
+    fn from_raw(evt: &'a RawEvent, local_received: f64) -> Self {
+        TaskEvent {
+            uuid: evt
+                .uuid
+                .as_ref()
+                .map_or(MISSING_UUID, |u| parse_uuid(u.as_str())),
+            name: evt.name.as_ref().map(RawStr::as_str),
+            queue: evt.queue.as_ref().map(RawStr::as_str),
+            hostname: match evt.kind.as_str() {
+                "task-sent" => None,
+                _ => evt.hostname.as_ref().map(RawStr::as_str),
+            },
+            state: TaskState::from_event(evt.kind.as_str().splitn(2, "-").nth(1).unwrap_or("")),
+            local_received,
+            runtime: evt.runtime,
+        }
+    }
+
+    fn intern(&self, labels: &mut Interner, names: &mut NameFolder) -> TaskEvent<u32> {
+        TaskEvent {
+            uuid: self.uuid,
+            name: self.name.map(|n| names.label(n, labels)),
+            queue: self.queue.map(|q| labels.intern(q)),
+            hostname: self.hostname.map(|h| labels.intern(h)),
+            state: self.state,
+            local_received: self.local_received,
+            runtime: self.runtime,
+        }
+    }
+}
+
+/// The fields of a worker-online, worker-heartbeat or worker-offline event.
+struct WorkerEvent<L> {
+    hostname: L,
+    online: bool,
+    freq: Option<f64>,
+    active: Option<u64>,
+    processed: Option<u64>,
+    loadavg: Option<(f64, f64, f64)>,
+    local_received: f64,
+}
+
+impl<'a> WorkerEvent<&'a str> {
+    /// Copies the needed fields out of a worker event dict.
+    fn from_dict(evt: &'a PyDict, kind: &'a str) -> PyResult<Self> {
+        let loadavg: Option<Vec<f64>> = match evt.get_item("loadavg") {
+            Some(l) => Some(l.extract()?),
+            None => None,
+        };
+        Ok(WorkerEvent {
+            hostname: match evt.get_item("hostname") {
+                Some(h) => h.extract()?,
+                None => CELERY_MISSING_DATA,
+            },
+            online: kind != "worker-offline",
+            freq: match evt.get_item("freq") {
+                Some(f) => Some(f.extract()?),
+                None => None,
+            },
+            active: match evt.get_item("active") {
+                Some(a) => Some(a.extract()?),
+                None => None,
+            },
+            processed: match evt.get_item("processed") {
+                Some(p) => Some(p.extract()?),
+                None => None,
+            },
+            loadavg: match loadavg.as_deref() {
+                Some([one, five, fifteen, ..]) => Some((*one, *five, *fifteen)),
+                _ => None,
+            },
+            local_received: local_received(evt)?,
+        })
+    }
+
+    /// Borrows the needed fields of a worker event parsed from its raw body.
+    fn from_raw(evt: &'a RawEvent, local_received: f64) -> Self {
+        WorkerEvent {
+            hostname: evt
+                .hostname
+                .as_ref()
+                .map_or(CELERY_MISSING_DATA, RawStr::as_str),
+            online: evt.kind.as_str() != "worker-offline",
+            freq: evt.freq,
+            active: evt.active,
+            processed: evt.processed,
+            loadavg: match evt.loadavg.as_deref() {
+                Some([one, five, fifteen, ..]) => Some((*one, *five, *fifteen)),
+                _ => None,
+            },
+            local_received,
+        }
+    }
+
+    fn intern(&self, labels: &mut Interner) -> WorkerEvent<u32> {
+        WorkerEvent {
+            hostname: labels.intern(self.hostname),
+            online: self.online,
+            freq: self.freq,
+            active: self.active,
+            processed: self.processed,
+            loadavg: self.loadavg,
+            local_received: self.local_received,
+        }
+    }
+}
+
+enum Event<L> {
+    Task(TaskEvent<L>),
+    Worker(WorkerEvent<L>),
+}
+
+impl<'a> Event<&'a str> {
+    /// Parses the events CeleryState handles, returning `None` for any
+    /// other kind of event.
+    fn from_dict(evt: &'a PyDict, kind: &'a str) -> PyResult<Option<Self>> {
+        if is_task_event(kind) {
+            Ok(Some(Event::Task(TaskEvent::from_dict(evt, kind)?)))
+        } else if is_worker_event(kind) {
+            Ok(Some(Event::Worker(WorkerEvent::from_dict(evt, kind)?)))
+        } else {
+            Ok(None)
+        }
+    }
+
+    /// Same as `from_dict`, for an event parsed from its raw body.
+    fn from_raw(evt: &'a RawEvent, local_received: f64) -> Option<Self> {
+        let kind = evt.kind.as_str();
+        if is_task_event(kind) {
+            Some(Event::Task(TaskEvent::from_raw(evt, local_received)))
+        } else if is_worker_event(kind) {
+            Some(Event::Worker(WorkerEvent::from_raw(evt, local_received)))
+        } else {
+            None
+        }
+    }
+
+    fn intern(&self, labels: &mut Interner, names: &mut NameFolder) -> Event<u32> {
+        match self {
+            Event::Task(t) => Event::Task(t.intern(labels, names)),
+            Event::Worker(w) => Event::Worker(w.intern(labels)),
+        }
+    }
+}
+
+impl<L> Event<L> {
+    fn local_received(&self) -> f64 {
+        match self {
+            Event::Task(t) => t.local_received,
+            Event::Worker(w) => w.local_received,
+        }
+    }
+}
+
+fn event_type(evt: &PyDict) -> PyResult<&str> {
+    evt.get_item("type")
+        .expect("Invalid Event: missing type")
+        .extract()
+}
+
+fn local_received(evt: &PyDict) -> PyResult<f64> {
+    evt.get_item("local_received")
+        .expect("Invalid Event: missing local_received")
+        .extract()
+}
+
+/// A string of a raw event, borrowed from the message body unless it holds
+/// escapes.
+struct RawStr<'a>(Cow<'a, str>);
+
+impl<'a> RawStr<'a> {
+    fn as_str(&self) -> &str {
+        &self.0
+    }
+}
+
+impl<'de: 'a, 'a> Deserialize<'de> for RawStr<'a> {
+    fn deserialize<D: Deserializer<'de>>(deserializer: D) -> Result<Self, D::Error> {
+        struct Visitor;
+
+        impl<'de> de::Visitor<'de> for Visitor {
+            type Value = RawStr<'de>;
+
+            fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+                f.write_str("a string")
+            }
+
+            fn visit_borrowed_str<E: de::Error>(self, v: &'de str) -> Result<Self::Value, E> {
+                Ok(RawStr(Cow::Borrowed(v)))
+            }
+
+            fn visit_str<E: de::Error>(self, v: &str) -> Result<Self::Value, E> {
+                Ok(RawStr(Cow::Owned(v.to_owned())))
+            }
+        }
+
+        deserializer.deserialize_str(Visitor)
+    }
+}
+
+/// The fields of an event read straight from the JSON body of its message,
+/// with no Python object created for it. All the other fields, args and
+/// kwargs included, are skipped over without being copied.
+#[derive(serde::Deserialize)]
+struct RawEvent<'a> {
+    #[serde(rename = "type", borrow)]
+    kind: RawStr<'a>,
+    #[serde(borrow)]
+    uuid: Option<RawStr<'a>>,
+    #[serde(borrow)]
+    name: Option<RawStr<'a>>,
+    #[serde(borrow)]
+    queue: Option<RawStr<'a>>,
+    runtime: Option<f64>,
+    timestamp: Option<f64>,
+    utcoffset: Option<f64>,
+    #[serde(borrow)]
+    hostname: Option<RawStr<'a>>,
+    freq: Option<f64>,
+    active: Option<u64>,
+    processed: Option<u64>,
+    loadavg: Option<Vec<f64>>,
+}
+
+/// Parses the body of an event message, either a single event or, as sent
+/// since celery 4, a list of them.
+fn parse_body<'a, T: Deserialize<'a>>(body: &'a [u8]) -> serde_json::Result<Vec<T>> {
+    match body.iter().find(|b| !b.is_ascii_whitespace()) {
+        Some(b'[') => serde_json::from_slice(body),
+        _ => serde_json::from_slice(body).map(|evt| vec![evt]),
+    }
+}
+
+/// The fields of an event an EventRouter reads from its raw body to route
+/// it, all the others being skipped over.
+#[derive(serde::Deserialize)]
+struct RoutedEvent<'a> {
+    #[serde(rename = "type", borrow)]
+    kind: RawStr<'a>,
+    #[serde(borrow)]
+    uuid: Option<RawStr<'a>>,
+    #[serde(borrow)]
+    name: Option<RawStr<'a>>,
+    #[serde(borrow)]
+    queue: Option<RawStr<'a>>,
+}
+
+impl<'a> RawEvent<'a> {
+    /// The timestamp of the event moved to the local UTC offset `here`, in
+    /// hours, as done by the celery event receiver.
+    fn timestamp(&self, here: f64) -> Option<f64> {
+        match (self.timestamp, self.utcoffset) {
+            (Some(timestamp), Some(offset)) => Some(timestamp - (offset - here) * 3600.0),
+            (timestamp, _) => timestamp,
+        }
+    }
+}
+
+/// An item of a batch: an event dict, or the raw body of an event message
+/// along with its reception time.
+enum Received<'a> {
+    Dict(&'a PyDict),
+    Raw(Vec<RawEvent<'a>>, f64),
+}
+
+/// A worker known from its events, or from replying to a ping.
+struct Worker {
+    online: bool,
+    freq: f64,
+    last_seen: f64,
+    active: Option<u64>,
+    processed: Option<u64>,
+    loadavg: Option<(f64, f64, f64)>,
+    task_event: f64, // reception time of the latest task event it sent
+}
+
+impl Worker {
+    fn new() -> Self {
+        Self {
+            online: true,
+            freq: HEARTBEAT_FREQ,
+            last_seen: 0.0,
+            active: None,
+            processed: None,
+            loadavg: None,
+            task_event: f64::NEG_INFINITY,
+        }
+    }
+
+    /// Whether the worker is online and its last heartbeat is within the
+    /// expire window, the same way celery.events.state reckons it.
+    fn alive(&self, now: f64) -> bool {
+        self.online && now - self.last_seen <= self.freq * HEARTBEAT_EXPIRE_WINDOW
+    }
+
+    /// Whether the worker sent a task event lately, telling that its task
+    /// events are enabled.
+    fn emitting(&self, now: f64) -> bool {
+        now - self.task_event <= TASK_EVENTS_WINDOW
     }
 }
 
-#[derive(Debug, Copy, Clone)]
+/// Result of collecting a task event: the labels it is counted under, the
+/// runtime it reported and the timings it completed, if any.
+struct Outcome {
+    name: u32,
+    state: TaskState,
+    queue: u32,
+    runtime: Option<f64>,
+    broker_wait: Option<f64>,
+    end_to_end: Option<f64>,
+    retries: Option<u16>,
+}
+
+#[derive(Debug, Copy, Clone, PartialEq, Eq, Hash)]
 enum TaskState {
     PENDING,
     RECEIVED,
@@ -83,13 +731,26 @@ enum TaskState {
     UNDEFINED,
 }
 impl fmt::Display for TaskState {
-    // UEUE Solution
     fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
-        write!(f, "{:?}", self)
+        f.write_str(self.as_str())
     }
 }
 
 impl TaskState {
+    fn from_u8(value: u8) -> Self {
+        match value {
+            0 => TaskState::PENDING,
+            1 => TaskState::RECEIVED,
+            2 => TaskState::STARTED,
+            3 => TaskState::FAILURE,
+            4 => TaskState::RETRY,
+            5 => TaskState::SUCCESS,
+            6 => TaskState::REVOKED,
+            7 => TaskState::REJECTED,
+            _ => TaskState::UNDEFINED,
+        }
+    }
+
     fn from_event(evt_kind: &str) -> Self {
         match evt_kind {
             "sent" => TaskState::PENDING,
@@ -103,131 +764,1902 @@ impl TaskState {
             _ => TaskState::UNDEFINED,
         }
     }
+
+    fn as_str(&self) -> &'static str {
+        match self {
+            TaskState::PENDING => "PENDING",
+            TaskState::RECEIVED => "RECEIVED",
+            TaskState::STARTED => "STARTED",
+            TaskState::FAILURE => "FAILURE",
+            TaskState::RETRY => "RETRY",
+            TaskState::SUCCESS => "SUCCESS",
+            TaskState::REVOKED => "REVOKED",
+            TaskState::REJECTED => "REJECTED",
+            TaskState::UNDEFINED => "UNDEFINED",
+        }
+    }
+}
+
+/// Checkpoints of the tasks in memory and of the task routes, laid out as:
+///
+/// - header: magic, version and the number of labels, routes and tasks,
+///   as little-endian u32s
+/// - labels: u32 length and UTF-8 bytes of each interned string, by id
+/// - routes: u32 task name id and u32 queue id pairs
+/// - tasks: fixed-size records of u128 uuid, u32 name id, u8 state, u8
+///   sampling shift, u16 retries, f64 local_received and the f32 sent and
+///   received offsets, least recently used first
+const CHECKPOINT_MAGIC: &[u8; 4] = b"CXCP";
+const CHECKPOINT_VERSION: u32 = 2;
+const CHECKPOINT_TASK_BYTES: usize = 40;
+
+struct Checkpoint {
+    labels: Vec<String>,
+    routes: Vec<(u32, u32)>,
+    tasks: Vec<(u128, Task)>,
+}
+
+impl Checkpoint {
+    fn encode(labels: &[String], routes: &[(u32, u32)], tasks: &[(u128, Task)]) -> Vec<u8> {
+        let mut data = Vec::with_capacity(
+            20 + labels.iter().map(|l| 4 + l.len()).sum::<usize>()
+                + routes.len() * 8
+                + tasks.len() * CHECKPOINT_TASK_BYTES,
+        );
+        data.extend_from_slice(CHECKPOINT_MAGIC);
+        for n in &[
+            CHECKPOINT_VERSION,
+            labels.len() as u32,
+            routes.len() as u32,
+            tasks.len() as u32,
+        ] {
+            data.extend_from_slice(&n.to_le_bytes());
+        }
+        for label in labels {
+            data.extend_from_slice(&(label.len() as u32).to_le_bytes());
+            data.extend_from_slice(label.as_bytes());
+        }
+        for (name, queue) in routes {
+            data.extend_from_slice(&name.to_le_bytes());
+            data.extend_from_slice(&queue.to_le_bytes());
+        }
+        for (uuid, task) in tasks {
+            data.extend_from_slice(&uuid.to_le_bytes());
+            data.extend_from_slice(&task.name.to_le_bytes());
+            data.extend_from_slice(&[task.state as u8, task.shift]);
+            data.extend_from_slice(&task.retries.to_le_bytes());
+            data.extend_from_slice(&task.local_received.to_le_bytes());
+            data.extend_from_slice(&task.sent.to_le_bytes());
+            data.extend_from_slice(&task.received.to_le_bytes());
+        }
+        data
+    }
+
+    /// Decodes a checkpoint straight out of a buffer, which may be memory
+    /// mapped, validating every label id it refers to.
+    fn decode(cells: &[ReadOnlyCell<u8>]) -> PyResult<Self> {
+        let mut reader = CheckpointReader { cells, pos: 0 };
+        let mut magic = [0u8; 4];
+        reader.fill(&mut magic)?;
+        if &magic != CHECKPOINT_MAGIC {
+            return Err(PyValueError::new_err("Not a checkpoint"));
+        }
+        let version = reader.u32()?;
+        if version != CHECKPOINT_VERSION {
+            return Err(PyValueError::new_err(format!(
+                "Unsupported checkpoint version {}",
+                version
+            )));
+        }
+        let (n_labels, n_routes, n_tasks) = (reader.u32()?, reader.u32()?, reader.u32()?);
+
+        let mut labels = Vec::with_capacity(n_labels as usize);
+        for _ in 0..n_labels {
+            let mut label = vec![0u8; reader.u32()? as usize];
+            reader.fill(&mut label)?;
+            labels.push(
+                String::from_utf8(label)
+                    .map_err(|_| PyValueError::new_err("Invalid label in checkpoint"))?,
+            );
+        }
+        let label = |id: u32| -> PyResult<u32> {
+            if id < n_labels {
+                Ok(id)
+            } else {
+                Err(PyValueError::new_err("Unknown label in checkpoint"))
+            }
+        };
+
+        let mut routes = Vec::with_capacity(n_routes as usize);
+        for _ in 0..n_routes {
+            routes.push((label(reader.u32()?)?, label(reader.u32()?)?));
+        }
+
+        let mut tasks = Vec::with_capacity(n_tasks as usize);
+        for _ in 0..n_tasks {
+            let mut uuid = [0u8; 16];
+            reader.fill(&mut uuid)?;
+            let name = label(reader.u32()?)?;
+            let mut state = [0u8; 4];
+            reader.fill(&mut state)?;
+            let mut local_received = [0u8; 8];
+            reader.fill(&mut local_received)?;
+            let mut task = Task::new(
+                name,
+                f64::from_le_bytes(local_received),
+                TaskState::from_u8(state[0]),
+            );
+            task.shift = state[1].min(MAX_SAMPLE_SHIFT);
+            task.retries = u16::from_le_bytes([state[2], state[3]]);
+            task.sent = reader.f32()?;
+            task.received = reader.f32()?;
+            tasks.push((u128::from_le_bytes(uuid), task));
+        }
+        Ok(Checkpoint {
+            labels,
+            routes,
+            tasks,
+        })
+    }
+}
+
+struct CheckpointReader<'a> {
+    cells: &'a [ReadOnlyCell<u8>],
+    pos: usize,
+}
+
+impl<'a> CheckpointReader<'a> {
+    fn fill(&mut self, buf: &mut [u8]) -> PyResult<()> {
+        let end = self.pos + buf.len();
+        if end > self.cells.len() {
+            return Err(PyValueError::new_err("Truncated checkpoint"));
+        }
+        for (b, cell) in buf.iter_mut().zip(&self.cells[self.pos..end]) {
+            *b = cell.get();
+        }
+        self.pos = end;
+        Ok(())
+    }
+
+    fn u32(&mut self) -> PyResult<u32> {
+        let mut buf = [0u8; 4];
+        self.fill(&mut buf)?;
+        Ok(u32::from_le_bytes(buf))
+    }
+
+    fn f32(&mut self) -> PyResult<f32> {
+        let mut buf = [0u8; 4];
+        self.fill(&mut buf)?;
+        Ok(f32::from_le_bytes(buf))
+    }
+}
+
+/// Maps task names and queues to small integer ids, so that each distinct
+/// string is allocated once no matter how many tasks and series use it.
+struct Interner {
+    ids: HashMap<String, u32>,
+    strings: Vec<String>,
+}
+
+impl Interner {
+    fn new() -> Self {
+        let mut interner = Self {
+            ids: HashMap::new(),
+            strings: Vec::new(),
+        };
+        interner.intern(CELERY_MISSING_DATA);
+        interner.intern(OTHER_LABEL);
+        interner
+    }
+
+    fn intern(&mut self, s: &str) -> u32 {
+        if let Some(id) = self.ids.get(s) {
+            return *id;
+        }
+        let id = self.strings.len() as u32;
+        self.strings.push(s.to_string());
+        self.ids.insert(s.to_string(), id);
+        id
+    }
+
+    fn resolve(&self, id: u32) -> String {
+        self.strings[id as usize].clone()
+    }
 }
 
+/// Bounds the task names used as labels: names matching a deny pattern, or
+/// none of the allow patterns when given, are reported as OTHER_LABEL, the
+/// others are renamed by the first group whose pattern they match, and with
+/// top_k only the top_k busiest of the resulting names are kept, the rest
+/// being reported as OTHER_LABEL too.
 #[pyclass]
-struct CeleryState {
-    event_count: i32,
-    task_count: i32,
-    queue_by_task: HashMap<String, String>,
-    tasks: LruCache<String, Task>,
+#[derive(Clone, Default)]
+struct TaskNames {
+    allow: Option<RegexSet>,
+    deny: Option<RegexSet>,
+    groups: Vec<(Regex, String)>, // pattern, label expanding its captures
+    top_k: Option<usize>,
 }
 
 #[pymethods]
-impl CeleryState {
+impl TaskNames {
     #[new]
-    fn new(max_tasks_in_memory: usize) -> Self {
-        CeleryState {
-            event_count: 0,
-            task_count: 0,
-            queue_by_task: HashMap::new(),
-            tasks: LruCache::new(max_tasks_in_memory),
+    #[args(allow = "None", deny = "None", groups = "None", top_k = "None")]
+    fn new(
+        allow: Option<Vec<&str>>,
+        deny: Option<Vec<&str>>,
+        groups: Option<Vec<(&str, &str)>>,
+        top_k: Option<usize>,
+    ) -> PyResult<Self> {
+        let invalid = |e: regex::Error| PyValueError::new_err(e.to_string());
+        if top_k == Some(0) {
+            return Err(PyValueError::new_err("Invalid top_k 0"));
         }
+        Ok(TaskNames {
+            allow: match allow {
+                Some(patterns) => Some(RegexSet::new(patterns).map_err(invalid)?),
+                None => None,
+            },
+            deny: match deny {
+                Some(patterns) => Some(RegexSet::new(patterns).map_err(invalid)?),
+                None => None,
+            },
+            groups: groups
+                .unwrap_or_default()
+                .into_iter()
+                .map(|(pattern, label)| {
+                    Ok((Regex::new(pattern).map_err(invalid)?, label.to_string()))
+                })
+                .collect::<PyResult<_>>()?,
+            top_k,
+        })
     }
 
-    fn collect(&mut self, evt: &PyDict) -> PyResult<CollectOutcome> {
-        let kind: String = evt
-            .get_item("type")
-            .expect("Invalid Event: missing type")
-            .extract()?;
-
-        if !is_task_event(&kind) {
-            return Ok((None, None, None, None));
+    /// Returns the label the events of the task name are always reported
+    /// under, None if they are, or with top_k may be, reported as other.
+    fn label(&self, name: &str) -> Option<String> {
+        match self.top_k {
+            Some(_) => None,
+            None => self.fold(name),
         }
+    }
 
-        let mut task = Task::default();
-        task.update_from_event(evt)?;
+    #[getter]
+    fn top_k(&self) -> Option<usize> {
+        self.top_k
+    }
+}
 
-        match task.state {
-            TaskState::SUCCESS | TaskState::FAILURE | TaskState::REVOKED => {
-                let name: String = self.tasks.pop(&task.uuid).unwrap_or(task.clone()).name;
-                let queue: String = self
-                    .queue_by_task
-                    .get(&name)
-                    .unwrap_or(&CELERY_MISSING_DATA.to_string())
-                    .into();
+impl TaskNames {
+    fn is_passthrough(&self) -> bool {
+        self.allow.is_none() && self.deny.is_none() && self.groups.is_empty()
+    }
 
-                return Ok((
-                    Some(name),
-                    Some(task.state.to_string()),
-                    task.runtime,
-                    Some(queue),
-                ));
+    /// Applies the allow and deny lists and the groups to name, returning
+    /// None when it is reported as other.
+    fn fold(&self, name: &str) -> Option<String> {
+        if let Some(deny) = &self.deny {
+            if deny.is_match(name) {
+                return None;
             }
-            _ => {
-                self.event(&task);
-
-                let task_mut = self.tasks.get_mut(&task.uuid).unwrap();
-                task_mut.state = task.state;
-                let name: String = task_mut.name.clone();
-                match evt.get_item("queue") {
-                    Some(q) => {
-                        self.queue_by_task.insert(name.to_string(), q.extract()?);
-                    }
-                    None => {}
-                }
-
-                let queue: String = self
-                    .queue_by_task
-                    .get(&name)
-                    .unwrap_or(&CELERY_MISSING_DATA.to_string())
-                    .into();
-                return Ok((Some(name), Some(task.state.to_string()), None, Some(queue)));
+        }
+        if let Some(allow) = &self.allow {
+            if !allow.is_match(name) {
+                return None;
+            }
+        }
+        for (pattern, label) in self.groups.iter() {
+            if let Some(captures) = pattern.captures(name) {
+                let mut grouped = String::new();
+                captures.expand(label, &mut grouped);
+                return Some(grouped);
             }
         }
+        Some(name.to_string())
     }
+}
+
+/// Candidate names tracked by TopK per name kept.
+const TOP_K_CANDIDATES: usize = 4;
+/// Names whose TaskNames outcome is cached, the cache is reset when full.
+const NAME_CACHE_CAPACITY: usize = 16384;
+
+struct Candidate {
+    name: String,
+    count: u64,
+    error: u64,         // count inherited from the name it replaced
+    label: Option<u32>, // interned id, while kept as a label of its own
+}
 
-    fn latency(&mut self, evt: &PyDict) -> PyResult<LatencyOutcome> {
-        let kind: String = evt
-            .get_item("type")
-            .expect("Invalid Event: missing type")
-            .extract()?;
+/// Space-saving summary of the busiest task names: it counts the events of
+/// at most TOP_K_CANDIDATES * k names, a new name replacing the least busy
+/// unlabelled one and inheriting its count as error. The k busiest
+/// candidates are reported under their own label: a candidate takes the
+/// label of the least busy labelled one once its count, less its error,
+/// passes the count of the latter, so that one-off names never do.
+struct TopK {
+    k: usize,
+    candidates: Vec<Candidate>,
+    index: HashMap<String, usize>,
+    unlabelled: BTreeSet<(u64, usize)>, // by count
+    labelled: BTreeSet<(u64, usize)>,   // by count
+    changes: Vec<(u32, bool)>,          // names given or released a label since last drained
+}
 
-        if !is_task_event(&kind) {
-            return Ok((None, None, None));
+impl TopK {
+    fn new(k: usize) -> Self {
+        Self {
+            k,
+            candidates: Vec::new(),
+            index: HashMap::new(),
+            unlabelled: BTreeSet::new(),
+            labelled: BTreeSet::new(),
+            changes: Vec::new(),
         }
+    }
 
-        let mut task = Task::default();
-        task.update_from_event(evt)?;
-        match task.state {
-            TaskState::STARTED => {
-                let prev_evt = self.tasks.get(&task.uuid);
-                match prev_evt {
-                    Some(p) => match p.state {
-                        TaskState::RECEIVED => {
-                            let name: String = p.name.clone();
-                            let queue: String = self
-                                .queue_by_task
-                                .get(&name)
-                                .unwrap_or(&CELERY_MISSING_DATA.to_string())
-                                .into();
-                            let latency = task.local_received - p.local_received;
-
-                            return Ok((Some(name), Some(queue), Some(latency)));
-                        }
-                        _ => {}
-                    },
-                    None => {}
+    /// Counts an event of name, returning the id of the label it is reported under.
+    fn observe(&mut self, name: &str, labels: &mut Interner) -> u32 {
+        let i = match self.index.get(name) {
+            Some(i) => {
+                let i = *i;
+                let c = &mut self.candidates[i];
+                let by_count = match c.label {
+                    Some(_) => &mut self.labelled,
+                    None => &mut self.unlabelled,
+                };
+                by_count.remove(&(c.count, i));
+                c.count += 1;
+                by_count.insert((c.count, i));
+                i
+            }
+            None if self.candidates.len() < TOP_K_CANDIDATES * self.k => {
+                let i = self.candidates.len();
+                self.candidates.push(Candidate {
+                    name: name.to_string(),
+                    count: 1,
+                    error: 0,
+                    label: None,
+                });
+                self.index.insert(name.to_string(), i);
+                self.unlabelled.insert((1, i));
+                i
+            }
+            None => {
+                // at most k of the candidates are labelled, the others can be replaced
+                let (min, i) = *self.unlabelled.iter().next().unwrap();
+                self.unlabelled.remove(&(min, i));
+                let c = &mut self.candidates[i];
+                self.index.remove(&c.name);
+                c.name = name.to_string();
+                c.count = min + 1;
+                c.error = min;
+                self.index.insert(name.to_string(), i);
+                self.unlabelled.insert((min + 1, i));
+                i
+            }
+        };
+        let c = &self.candidates[i];
+        if c.label.is_none() {
+            if self.labelled.len() < self.k {
+                self.promote(i, labels);
+            } else {
+                let (lowest, j) = *self.labelled.iter().next().unwrap();
+                if c.count - c.error > lowest {
+                    self.demote(j);
+                    self.promote(i, labels);
                 }
             }
-            _ => {}
         }
-        return Ok((None, None, None));
+        self.candidates[i].label.unwrap_or(OTHER)
     }
-}
 
-impl CeleryState {
-    fn event(&mut self, task: &Task) {
-        self.event_count += 1;
+    fn promote(&mut self, i: usize, labels: &mut Interner) {
+        let c = &mut self.candidates[i];
+        let id = labels.intern(&c.name);
+        c.label = Some(id);
+        self.unlabelled.remove(&(c.count, i));
+        self.labelled.insert((c.count, i));
+        self.changes.push((id, true));
+    }
 
-        match self.tasks.get(&task.uuid) {
-            None => { self.tasks.put(task.uuid.to_string(), task.clone()); }
-            _ => {}
+    fn demote(&mut self, i: usize) {
+        let c = &mut self.candidates[i];
+        if let Some(id) = c.label.take() {
+            self.labelled.remove(&(c.count, i));
+            self.unlabelled.insert((c.count, i));
+            self.changes.push((id, false));
+        }
+    }
+
+    fn is_labelled(&self, name: &str) -> bool {
+        match self.index.get(name) {
+            Some(i) => self.candidates[*i].label.is_some(),
+            None => false,
+        }
+    }
+
+    fn labelled_names(&self) -> Vec<String> {
+        self.labelled
+            .iter()
+            .map(|(_, i)| self.candidates[*i].name.clone())
+            .collect()
+    }
+}
+
+/// Maps the task names of the events to the labels they are reported
+/// under according to TaskNames.
+struct NameFolder {
+    rules: TaskNames,
+    cache: HashMap<String, Option<String>>,
+    top: Option<TopK>,
+}
+
+impl NameFolder {
+    fn new(rules: TaskNames) -> Self {
+        Self {
+            top: rules.top_k.map(TopK::new),
+            rules,
+            cache: HashMap::new(),
+        }
+    }
+
+    /// Applies the static rules to name, their outcome being cached.
+    fn fold<'a>(
+        rules: &TaskNames,
+        cache: &'a mut HashMap<String, Option<String>>,
+        name: &'a str,
+    ) -> Option<&'a str> {
+        if rules.is_passthrough() {
+            return Some(name);
+        }
+        if !cache.contains_key(name) {
+            if cache.len() >= NAME_CACHE_CAPACITY {
+                cache.clear();
+            }
+            cache.insert(name.to_string(), rules.fold(name));
+        }
+        cache[name].as_deref()
+    }
+
+    fn label(&mut self, name: &str, labels: &mut Interner) -> u32 {
+        let NameFolder { rules, cache, top } = self;
+        let label = Self::fold(rules, cache, name);
+        match (label, top.as_mut()) {
+            (None, _) => OTHER,
+            (Some(label), Some(top)) => top.observe(label, labels),
+            (Some(label), None) => labels.intern(label),
+        }
+    }
+
+    /// Returns the names given or released a label since the last call.
+    fn changes(&mut self) -> Vec<(u32, bool)> {
+        match self.top.as_mut() {
+            Some(top) => top.changes.drain(..).collect(),
+            None => Vec::new(),
+        }
+    }
+}
+
+struct Histogram {
+    counts: Vec<u64>, // one per bound, plus +Inf
+    sum: f64,
+}
+
+impl Histogram {
+    fn new(bounds: &[f64]) -> Self {
+        Self {
+            counts: vec![0; bounds.len() + 1],
+            sum: 0.0,
+        }
+    }
+
+    fn observe(&mut self, bounds: &[f64], value: f64, weight: u64) {
+        self.counts[bounds.partition_point(|b| *b < value)] += weight;
+        self.sum += value * weight as f64;
+    }
+
+    fn merge(&mut self, other: &Histogram) {
+        for (c, o) in self.counts.iter_mut().zip(other.counts.iter()) {
+            *c += o;
+        }
+        self.sum += other.sum;
+    }
+
+    fn cumulative(&self) -> Vec<u64> {
+        self.counts
+            .iter()
+            .scan(0, |acc, c| {
+                *acc += c;
+                Some(*acc)
+            })
+            .collect()
+    }
+}
+
+/// Quantile sketch with a relative accuracy, as DDSketch: positive values
+/// are counted in bins of logarithmic width ln_gamma, at most
+/// SKETCH_MAX_BINS of them, the lowest bins being merged past that.
+struct Sketch {
+    bins: BTreeMap<i32, u64>,
+    zeros: u64,
+    count: u64,
+    sum: f64,
+}
+
+impl Sketch {
+    fn new() -> Self {
+        Self {
+            bins: BTreeMap::new(),
+            zeros: 0,
+            count: 0,
+            sum: 0.0,
+        }
+    }
+
+    fn observe(&mut self, ln_gamma: f64, value: f64, weight: u64) {
+        if value > SKETCH_MIN_VALUE {
+            *self
+                .bins
+                .entry((value.ln() / ln_gamma).ceil() as i32)
+                .or_insert(0) += weight;
+            self.collapse();
+        } else {
+            self.zeros += weight;
+        }
+        self.count += weight;
+        self.sum += value * weight as f64;
+    }
+
+    /// Adds the bins of other, of the same bin width, as if its values had
+    /// been observed by this sketch.
+    fn merge(&mut self, other: &Sketch) {
+        for (index, cnt) in other.bins.iter() {
+            *self.bins.entry(*index).or_insert(0) += cnt;
+        }
+        self.collapse();
+        self.zeros += other.zeros;
+        self.count += other.count;
+        self.sum += other.sum;
+    }
+
+    /// Merges the lowest bins past SKETCH_MAX_BINS into the next one.
+    fn collapse(&mut self) {
+        while self.bins.len() > SKETCH_MAX_BINS {
+            let (lowest, cnt) = self.bins.iter().next().map(|(i, c)| (*i, *c)).unwrap();
+            self.bins.remove(&lowest);
+            if let Some((_, next)) = self.bins.iter_mut().next() {
+                *next += cnt;
+            }
+        }
+    }
+
+    fn quantile(&self, ln_gamma: f64, q: f64) -> f64 {
+        if self.count == 0 {
+            return f64::NAN;
+        }
+        let rank = (q * (self.count - 1) as f64) as u64;
+        if rank < self.zeros {
+            return 0.0;
+        }
+        let mut seen = self.zeros;
+        for (index, cnt) in self.bins.iter() {
+            seen += cnt;
+            if seen > rank {
+                // the middle of the bin, relatively to its bounds
+                return 2.0 * (*index as f64 * ln_gamma).exp() / (ln_gamma.exp() + 1.0);
+            }
+        }
+        f64::NAN
+    }
+}
+
+/// A distribution keyed by interned name and queue IDs: histograms over
+/// fixed bounds or, given the bin width of a sketch, quantile sketches.
+struct Distribution {
+    bounds: Vec<f64>,
+    histograms: HashMap<(u32, u32), Histogram>,
+    sketches: HashMap<(u32, u32), Sketch>,
+}
+
+impl Distribution {
+    fn new(bounds: Vec<f64>) -> Self {
+        Self {
+            bounds,
+            histograms: HashMap::new(),
+            sketches: HashMap::new(),
+        }
+    }
+
+    fn observe(&mut self, ln_gamma: Option<f64>, key: (u32, u32), value: f64, weight: u64) {
+        if let Some(ln_gamma) = ln_gamma {
+            return self
+                .sketches
+                .entry(key)
+                .or_insert_with(Sketch::new)
+                .observe(ln_gamma, value, weight);
+        }
+        let bounds = &self.bounds;
+        self.histograms
+            .entry(key)
+            .or_insert_with(|| Histogram::new(bounds))
+            .observe(bounds, value, weight);
+    }
+
+    /// Merges the distributions of a task name into the ones of OTHER.
+    fn fold(&mut self, name: u32) {
+        let keys: Vec<(u32, u32)> = self
+            .histograms
+            .keys()
+            .filter(|(n, _)| *n == name)
+            .cloned()
+            .collect();
+        for (n, queue) in keys {
+            let h = self.histograms.remove(&(n, queue)).unwrap();
+            let bounds = &self.bounds;
+            self.histograms
+                .entry((OTHER, queue))
+                .or_insert_with(|| Histogram::new(bounds))
+                .merge(&h);
+        }
+        let keys: Vec<(u32, u32)> = self
+            .sketches
+            .keys()
+            .filter(|(n, _)| *n == name)
+            .cloned()
+            .collect();
+        for (n, queue) in keys {
+            let sketch = self.sketches.remove(&(n, queue)).unwrap();
+            self.sketches
+                .entry((OTHER, queue))
+                .or_insert_with(Sketch::new)
+                .merge(&sketch);
+        }
+    }
+}
+
+/// Task counters and distributions of the task timings, sketched with a
+/// sketch accuracy, and of the retries of the ended tasks.
+struct Metrics {
+    ln_gamma: Option<f64>, // sketches bin width, when sketching
+    tasks: HashMap<(u32, TaskState, u32), u64>,
+    runtime: Distribution,
+    latency: Distribution,     // from received to started
+    broker_wait: Distribution, // from sent to received
+    end_to_end: Distribution,  // from sent to succeeded or failed
+    retries: Distribution,
+}
+
+impl Metrics {
+    fn new(
+        runtime_bounds: Vec<f64>,
+        latency_bounds: Vec<f64>,
+        retry_bounds: Vec<f64>,
+        accuracy: Option<f64>,
+    ) -> Self {
+        Self {
+            ln_gamma: accuracy.map(|a| ((1.0 + a) / (1.0 - a)).ln()),
+            tasks: HashMap::new(),
+            runtime: Distribution::new(runtime_bounds.clone()),
+            latency: Distribution::new(latency_bounds.clone()),
+            broker_wait: Distribution::new(latency_bounds),
+            end_to_end: Distribution::new(runtime_bounds),
+            retries: Distribution::new(retry_bounds),
+        }
+    }
+
+    /// Counts an event and records the distributions it completed, as
+    /// weight events when sampling.
+    fn observe(&mut self, outcome: &Outcome, weight: u64) {
+        let (key, ln_gamma) = ((outcome.name, outcome.queue), self.ln_gamma);
+        *self
+            .tasks
+            .entry((outcome.name, outcome.state, outcome.queue))
+            .or_insert(0) += weight;
+        if let Some(runtime) = outcome.runtime {
+            self.runtime.observe(ln_gamma, key, runtime, weight);
+        }
+        if let Some(wait) = outcome.broker_wait {
+            self.broker_wait.observe(ln_gamma, key, wait, weight);
+        }
+        if let Some(elapsed) = outcome.end_to_end {
+            self.end_to_end.observe(ln_gamma, key, elapsed, weight);
+        }
+        if let Some(retries) = outcome.retries {
+            self.retries.observe(None, key, retries as f64, weight);
+        }
+    }
+
+    /// Folds the series of a task name into the ones of OTHER.
+    fn fold(&mut self, name: u32) {
+        let keys: Vec<(u32, TaskState, u32)> = self
+            .tasks
+            .keys()
+            .filter(|(n, _, _)| *n == name)
+            .cloned()
+            .collect();
+        for (n, state, queue) in keys {
+            let count = self.tasks.remove(&(n, state, queue)).unwrap();
+            *self.tasks.entry((OTHER, state, queue)).or_insert(0) += count;
+        }
+        for distribution in &mut [
+            &mut self.runtime,
+            &mut self.latency,
+            &mut self.broker_wait,
+            &mut self.end_to_end,
+            &mut self.retries,
+        ] {
+            distribution.fold(name);
+        }
+    }
+
+    fn bins(&self, distribution: &Distribution) -> Vec<(u32, u32, Vec<(i32, u64)>, u64, u64, f64)> {
+        distribution
+            .sketches
+            .iter()
+            .map(|((name, queue), sketch)| {
+                let bins = sketch.bins.iter().map(|(i, c)| (*i, *c)).collect();
+                (*name, *queue, bins, sketch.zeros, sketch.count, sketch.sum)
+            })
+            .collect()
+    }
+
+    fn summarize(&self, distribution: &Distribution) -> Vec<(u32, u32, Vec<(f64, f64)>, u64, f64)> {
+        let ln_gamma = self.ln_gamma.unwrap_or(1.0);
+        distribution
+            .sketches
+            .iter()
+            .map(|((name, queue), sketch)| {
+                let quantiles = SKETCH_QUANTILES
+                    .iter()
+                    .map(|q| (*q, sketch.quantile(ln_gamma, *q)))
+                    .collect();
+                (*name, *queue, quantiles, sketch.count, sketch.sum)
+            })
+            .collect()
+    }
+}
+
+/// Finite bounds of a histogram, defaults if none are given.
+fn histogram_bounds(buckets: Option<Vec<f64>>, defaults: &[f64]) -> PyResult<Vec<f64>> {
+    let mut bounds: Vec<f64> = buckets.unwrap_or_else(|| defaults.to_vec());
+    bounds.retain(|b| b.is_finite());
+    if bounds.windows(2).any(|w| !(w[0] < w[1])) {
+        return Err(PyValueError::new_err(format!(
+            "Buckets {:?} are not in increasing order",
+            bounds
+        )));
+    }
+    Ok(bounds)
+}
+
+/// Self-instrumentation of the ingestion: events seen by type, how late
+/// they are processed, how many tasks were evicted from the LRU, how many
+/// events were dropped before reaching the state and how many message
+/// bodies could not be parsed.
+struct Stats {
+    events: HashMap<u32, u64>,
+    broker_lag: Histogram,   // from the event timestamp to local_received
+    exporter_lag: Histogram, // from local_received to its processing
+    evictions: u64,
+    expirations: u64,
+    dropped: u64,
+    malformed: u64,
+}
+
+impl Stats {
+    fn new() -> Self {
+        Self {
+            events: HashMap::new(),
+            broker_lag: Histogram::new(&LAG_BUCKETS),
+            exporter_lag: Histogram::new(&LAG_BUCKETS),
+            evictions: 0,
+            expirations: 0,
+            dropped: 0,
+            malformed: 0,
+        }
+    }
+
+    fn observe_lag(&mut self, timestamp: f64, local_received: f64, now: f64) {
+        self.broker_lag
+            .observe(&LAG_BUCKETS, (local_received - timestamp).max(0.0), 1);
+        self.exporter_lag
+            .observe(&LAG_BUCKETS, (now - local_received).max(0.0), 1);
+    }
+}
+
+/// The bookkeeping of CeleryState, only ever updated under its lock and
+/// without holding the GIL.
+struct Inner {
+    event_count: i32,
+    task_count: i32,
+    queue_by_task: HashMap<u32, u32>,
+    tasks: LruCache<u128, Task>,
+    metrics: Metrics,
+    shard: Shard,
+    workers: HashMap<u32, Worker>,
+    stats: Stats,
+    wheel: Option<TimeWheel>,
+    clock: f64,             // latest local_received seen
+    released: HashSet<u32>, // names whose label was released, reported as other
+    sampler: Sampler,
+}
+
+/// Event-driven state of the Celery cluster. Fields are copied out of the
+/// events while holding the GIL, then the LRU and the metrics are updated
+/// under an internal lock with the GIL released, so the state can be
+/// shared by the ingestion and the scrape threads.
+///
+/// At most max_tasks_in_memory tasks are kept, fewer if they would take
+/// more than max_bytes, and tasks not ended within task_ttl seconds of
+/// their first event are expired.
+///
+/// Runtimes and latencies are counted in histograms over buckets and
+/// latency_buckets, defaulting to buckets, or with sketch_accuracy in
+/// quantile sketches of that relative accuracy exposed by summaries.
+///
+/// Task names are mapped to labels according to task_names, if given,
+/// while interning them, so that the metrics only ever see the bounded set
+/// of labels. The interning locks, names then labels, are never held along
+/// with inner.
+#[pyclass]
+struct CeleryState {
+    names: Mutex<NameFolder>,
+    labels: Mutex<Interner>,
+    inner: Mutex<Inner>,
+}
+
+#[pymethods]
+impl CeleryState {
+    #[new]
+    #[args(
+        buckets = "None",
+        shard_index = "0",
+        shard_count = "1",
+        task_ttl = "None",
+        max_bytes = "None",
+        task_names = "None",
+        latency_buckets = "None",
+        sketch_accuracy = "None",
+        retry_buckets = "None",
+        sample_rate = "None",
+        sample_max_lag = "None"
+    )]
+    fn new(
+        max_tasks_in_memory: usize,
+        buckets: Option<Vec<f64>>,
+        shard_index: u32,
+        shard_count: u32,
+        task_ttl: Option<f64>,
+        max_bytes: Option<usize>,
+        task_names: Option<PyRef<TaskNames>>,
+        latency_buckets: Option<Vec<f64>>,
+        sketch_accuracy: Option<f64>,
+        retry_buckets: Option<Vec<f64>>,
+        sample_rate: Option<f64>,
+        sample_max_lag: Option<f64>,
+    ) -> PyResult<Self> {
+        if shard_index >= shard_count {
+            return Err(PyValueError::new_err(format!(
+                "Invalid shard {} out of {}",
+                shard_index, shard_count
+            )));
+        }
+        if let Some(ttl) = task_ttl {
+            if !(ttl > 0.0) {
+                return Err(PyValueError::new_err(format!("Invalid task TTL {}", ttl)));
+            }
+        }
+        let capacity = match max_bytes {
+            Some(bytes) => max_tasks_in_memory.min(bytes / TASK_ENTRY_BYTES),
+            None => max_tasks_in_memory,
+        };
+        if capacity == 0 {
+            return Err(PyValueError::new_err(
+                "No task fits in memory, raise max_tasks_in_memory or max_bytes",
+            ));
+        }
+        if let Some(accuracy) = sketch_accuracy {
+            if !(accuracy > 0.0 && accuracy < 1.0) {
+                return Err(PyValueError::new_err(format!(
+                    "Invalid sketch accuracy {}",
+                    accuracy
+                )));
+            }
+        }
+        let sample_rate = sample_rate.unwrap_or(1.0);
+        if !(sample_rate > 0.0 && sample_rate <= 1.0) {
+            return Err(PyValueError::new_err(format!(
+                "Invalid sample rate {}",
+                sample_rate
+            )));
+        }
+        if let Some(max_lag) = sample_max_lag {
+            if !(max_lag > 0.0) {
+                return Err(PyValueError::new_err(format!(
+                    "Invalid sampling max lag {}",
+                    max_lag
+                )));
+            }
+        }
+        let runtime_bounds = histogram_bounds(buckets, &DEFAULT_BUCKETS)?;
+        let latency_bounds = match latency_buckets {
+            Some(_) => histogram_bounds(latency_buckets, &DEFAULT_BUCKETS)?,
+            None => runtime_bounds.clone(),
+        };
+        Ok(CeleryState {
+            names: Mutex::new(NameFolder::new(
+                task_names.map_or_else(TaskNames::default, |n| n.clone()),
+            )),
+            labels: Mutex::new(Interner::new()),
+            inner: Mutex::new(Inner {
+                event_count: 0,
+                task_count: 0,
+                queue_by_task: HashMap::new(),
+                tasks: LruCache::new(capacity),
+                metrics: Metrics::new(
+                    runtime_bounds,
+                    latency_bounds,
+                    histogram_bounds(retry_buckets, &DEFAULT_RETRY_BUCKETS)?,
+                    sketch_accuracy,
+                ),
+                shard: Shard {
+                    index: shard_index,
+                    count: shard_count,
+                },
+                workers: HashMap::new(),
+                stats: Stats::new(),
+                wheel: task_ttl.map(TimeWheel::new),
+                clock: 0.0,
+                released: HashSet::new(),
+                sampler: Sampler::new(sample_rate, sample_max_lag),
+            }),
+        })
+    }
+
+    /// Finite upper bounds of the runtime histograms.
+    #[getter]
+    fn buckets(&self) -> Vec<f64> {
+        self.inner.lock().unwrap().metrics.runtime.bounds.clone()
+    }
+
+    /// Finite upper bounds of the latency histograms.
+    #[getter]
+    fn latency_buckets(&self) -> Vec<f64> {
+        self.inner.lock().unwrap().metrics.latency.bounds.clone()
+    }
+
+    /// Fraction of the tasks currently sampled, a power of two.
+    #[getter]
+    fn sample_rate(&self) -> f64 {
+        self.inner.lock().unwrap().sampler.rate()
+    }
+
+    /// Finite upper bounds of the retries histograms.
+    #[getter]
+    fn retry_buckets(&self) -> Vec<f64> {
+        self.inner.lock().unwrap().metrics.retries.bounds.clone()
+    }
+
+    /// Relative accuracy of the quantile sketches, None for histograms.
+    #[getter]
+    fn sketch_accuracy(&self) -> Option<f64> {
+        let ln_gamma = self.inner.lock().unwrap().metrics.ln_gamma?;
+        let gamma = ln_gamma.exp();
+        Some((gamma - 1.0) / (gamma + 1.0))
+    }
+
+    fn collect(&self, py: Python, evt: &PyDict) -> PyResult<CollectOutcome> {
+        let (task, changes) = match self.parse(evt)? {
+            Some(parsed) => parsed,
+            None => return Ok((None, None, None, None)),
+        };
+        let outcome = py.allow_threads(|| {
+            let mut inner = self.inner.lock().unwrap();
+            inner.relabel(&changes);
+            inner.collect_task(&task, 0)
+        });
+        let labels = self.labels.lock().unwrap();
+        Ok((
+            Some(labels.resolve(outcome.name)),
+            Some(outcome.state.to_string()),
+            outcome.runtime,
+            Some(labels.resolve(outcome.queue)),
+        ))
+    }
+
+    fn latency(&self, py: Python, evt: &PyDict) -> PyResult<LatencyOutcome> {
+        let (task, changes) = match self.parse(evt)? {
+            Some(parsed) => parsed,
+            None => return Ok((None, None, None)),
+        };
+        let latency = py.allow_threads(|| {
+            let mut inner = self.inner.lock().unwrap();
+            inner.relabel(&changes);
+            inner.task_latency(&task)
+        });
+        match latency {
+            Some((name, queue, latency)) => {
+                let labels = self.labels.lock().unwrap();
+                Ok((
+                    Some(labels.resolve(name)),
+                    Some(labels.resolve(queue)),
+                    Some(latency),
+                ))
+            }
+            None => Ok((None, None, None)),
+        }
+    }
+
+    /// Processes a batch of events in a single call, computing latency and
+    /// collect outcomes together for each task event and recording them
+    /// into the native counters and histograms, and tracking workers from
+    /// their events. Returns the number of events processed.
+    ///
+    /// Besides event dicts, the batch may hold `(body, local_received)`
+    /// tuples of the raw JSON bodies of event messages, only the fields
+    /// needed being parsed out of them. Their timestamps are moved to the
+    /// local UTC offset `utcoffset`, in hours, and malformed bodies are
+    /// counted apart.
+    ///
+    /// The stats of a shard only count the task events of its own tasks and,
+    /// for the first shard, the other events, so that those of the shards
+    /// add up when an EventRouter hands some events to several of them.
+    #[args(events, utcoffset = "0.0")]
+    fn process_batch(&self, py: Python, events: &PyList, utcoffset: f64) -> PyResult<usize> {
+        let mut received: Vec<Received> = Vec::with_capacity(events.len());
+        let mut malformed = 0;
+        for evt in events.iter() {
+            if let Ok(evt) = evt.downcast::<PyDict>() {
+                received.push(Received::Dict(evt));
+                continue;
+            }
+            let (body, local_received): (&PyBytes, f64) = evt.extract()?;
+            match parse_body(body.as_bytes()) {
+                Ok(raw) => received.push(Received::Raw(raw, local_received)),
+                Err(_) => malformed += 1,
+            }
+        }
+        // the type of every event, along with its index among the parsed ones
+        let mut kinds: Vec<(&str, Option<usize>)> = Vec::with_capacity(events.len());
+        let mut timestamps: Vec<Option<f64>> = Vec::with_capacity(events.len());
+        let mut parsed: Vec<Event<&str>> = Vec::with_capacity(events.len());
+        for item in received.iter() {
+            match item {
+                Received::Dict(evt) => {
+                    let kind = event_type(evt)?;
+                    if let Some(parsed_evt) = Event::from_dict(evt, kind)? {
+                        kinds.push((kind, Some(parsed.len())));
+                        timestamps.push(match evt.get_item("timestamp") {
+                            Some(t) => Some(t.extract()?),
+                            None => None,
+                        });
+                        parsed.push(parsed_evt);
+                    } else {
+                        kinds.push((kind, None));
+                    }
+                }
+                Received::Raw(raw, local_received) => {
+                    for evt in raw {
+                        let kind = evt.kind.as_str();
+                        if let Some(parsed_evt) = Event::from_raw(evt, *local_received) {
+                            kinds.push((kind, Some(parsed.len())));
+                            timestamps.push(evt.timestamp(utcoffset));
+                            parsed.push(parsed_evt);
+                        } else {
+                            kinds.push((kind, None));
+                        }
+                    }
+                }
+            }
+        }
+        let (kinds, parsed, changes): (
+            Vec<(u32, Option<usize>)>,
+            Vec<Event<u32>>,
+            Vec<(u32, bool)>,
+        ) = {
+            let mut names = self.names.lock().unwrap();
+            let mut labels = self.labels.lock().unwrap();
+            (
+                kinds.iter().map(|(k, i)| (labels.intern(k), *i)).collect(),
+                parsed
+                    .iter()
+                    .map(|e| e.intern(&mut labels, &mut names))
+                    .collect(),
+                names.changes(),
+            )
+        };
+        let now = SystemTime::now()
+            .duration_since(UNIX_EPOCH)
+            .map_or(0.0, |d| d.as_secs_f64());
+
+        let lag = parsed
+            .iter()
+            .map(|evt| now - evt.local_received())
+            .fold(0.0, f64::max);
+
+        py.allow_threads(|| {
+            let mut inner = self.inner.lock().unwrap();
+            inner.relabel(&changes);
+            let clock = inner.clock;
+            inner.sampler.adapt(lag, clock);
+            inner.stats.malformed += malformed;
+            // the events handed to several shards are counted by one of them
+            let counted: Vec<bool> = parsed.iter().map(|evt| inner.shard.counts(evt)).collect();
+            let first = inner.shard.index == 0;
+            for (kind, i) in kinds {
+                if i.map_or(first, |i| counted[i]) {
+                    *inner.stats.events.entry(kind).or_insert(0) += 1;
+                }
+            }
+            for ((evt, timestamp), counted) in parsed.iter().zip(timestamps).zip(counted) {
+                if let (Some(timestamp), true) = (timestamp, counted) {
+                    inner
+                        .stats
+                        .observe_lag(timestamp, evt.local_received(), now);
+                }
+            }
+            for evt in parsed.iter() {
+                inner.clock = inner.clock.max(evt.local_received());
+                match evt {
+                    Event::Task(task) => inner.process(task),
+                    Event::Worker(worker) => inner.process_worker(worker),
+                }
+            }
+            inner.expire();
+        });
+        Ok(parsed.len())
+    }
+
+    /// Whether worker liveness can't be told from heartbeats alone: no
+    /// worker is known, or an online worker missed its heartbeats.
+    fn workers_stale(&self, py: Python, now: f64) -> bool {
+        py.allow_threads(|| {
+            let inner = self.inner.lock().unwrap();
+            inner.workers.is_empty() || inner.workers.values().any(|w| w.online && !w.alive(now))
+        })
+    }
+
+    /// Number of workers alive according to their heartbeats.
+    fn alive_workers(&self, py: Python, now: f64) -> usize {
+        py.allow_threads(|| {
+            let inner = self.inner.lock().unwrap();
+            inner.workers.values().filter(|w| w.alive(now)).count()
+        })
+    }
+
+    /// Marks the workers that replied to a ping as alive, and the online
+    /// workers that missed their heartbeats and did not reply as offline.
+    fn workers_pinged(&self, py: Python, hostnames: Vec<&str>, now: f64) {
+        let hostnames: Vec<u32> = {
+            let mut labels = self.labels.lock().unwrap();
+            hostnames.iter().map(|h| labels.intern(h)).collect()
+        };
+        py.allow_threads(|| {
+            let mut inner = self.inner.lock().unwrap();
+            for worker in inner.workers.values_mut() {
+                if worker.online && !worker.alive(now) {
+                    worker.online = false;
+                }
+            }
+            for hostname in hostnames {
+                let worker = inner.workers.entry(hostname).or_insert_with(Worker::new);
+                worker.online = true;
+                worker.last_seen = now;
+            }
+        })
+    }
+
+    /// Hostnames of the workers alive that sent no task event lately, their
+    /// task events being likely disabled.
+    fn silent_workers(&self, py: Python, now: f64) -> Vec<String> {
+        let hostnames: Vec<u32> = py.allow_threads(|| {
+            let inner = self.inner.lock().unwrap();
+            inner
+                .workers
+                .iter()
+                .filter(|(_, w)| w.alive(now) && !w.emitting(now))
+                .map(|(hostname, _)| *hostname)
+                .collect()
+        });
+        let labels = self.labels.lock().unwrap();
+        hostnames.into_iter().map(|h| labels.resolve(h)).collect()
+    }
+
+    /// Returns the known workers along with their latest heartbeat stats
+    /// and whether they send task events, forgetting the ones not seen for
+    /// an hour.
+    fn workers(&self, py: Python, now: f64) -> WorkersSnapshot {
+        py.allow_threads(|| {
+            let workers: Vec<(
+                u32,
+                bool,
+                bool,
+                Option<u64>,
+                Option<u64>,
+                Option<(f64, f64, f64)>,
+                bool,
+            )> = {
+                let mut inner = self.inner.lock().unwrap();
+                inner
+                    .workers
+                    .retain(|_, w| now - w.last_seen <= WORKER_FORGET_SECONDS);
+                inner
+                    .workers
+                    .iter()
+                    .map(|(hostname, w)| {
+                        (
+                            *hostname,
+                            w.online,
+                            w.alive(now),
+                            w.active,
+                            w.processed,
+                            w.loadavg,
+                            w.emitting(now),
+                        )
+                    })
+                    .collect()
+            };
+            let labels = self.labels.lock().unwrap();
+            workers
+                .into_iter()
+                .map(
+                    |(hostname, online, alive, active, processed, loadavg, emitting)| {
+                        (
+                            labels.resolve(hostname),
+                            online,
+                            alive,
+                            active,
+                            processed,
+                            loadavg,
+                            emitting,
+                        )
+                    },
+                )
+                .collect()
+        })
+    }
+
+    /// Returns the label the events of the task name are reported under,
+    /// None if they are reported as other.
+    fn task_label(&self, name: &str) -> Option<String> {
+        let mut names = self.names.lock().unwrap();
+        let NameFolder { rules, cache, top } = &mut *names;
+        let label = NameFolder::fold(rules, cache, name)?;
+        match top {
+            Some(top) if !top.is_labelled(label) => None,
+            _ => Some(label.to_string()),
+        }
+    }
+
+    /// Returns the label the task name is folded into by the allow and deny
+    /// lists and the groups, None if it is reported as other, regardless of
+    /// top_k.
+    fn fold_task_name(&self, name: &str) -> Option<String> {
+        let mut names = self.names.lock().unwrap();
+        let NameFolder { rules, cache, .. } = &mut *names;
+        NameFolder::fold(rules, cache, name).map(str::to_string)
+    }
+
+    /// Returns the names currently kept as labels of their own by top_k,
+    /// None without top_k.
+    fn top_task_names(&self) -> Option<Vec<String>> {
+        let names = self.names.lock().unwrap();
+        names.top.as_ref().map(TopK::labelled_names)
+    }
+
+    /// Learns the queues the tasks of a name are routed to from the (name,
+    /// queue) routes an EventRouter reported.
+    fn learn_routes(&self, py: Python, routes: Vec<(&str, &str)>) {
+        let routes: Vec<(u32, u32)> = {
+            let mut names = self.names.lock().unwrap();
+            let mut labels = self.labels.lock().unwrap();
+            let NameFolder { rules, cache, .. } = &mut *names;
+            routes
+                .iter()
+                .map(|(name, queue)| {
+                    let name =
+                        NameFolder::fold(rules, cache, name).map_or(OTHER, |l| labels.intern(l));
+                    (name, labels.intern(queue))
+                })
+                .collect()
+        };
+        py.allow_threads(|| {
+            let mut inner = self.inner.lock().unwrap();
+            inner.queue_by_task.extend(routes);
+        })
+    }
+
+    /// Serializes the tasks in memory and the task routes into a compact
+    /// binary checkpoint, to be given back to restore.
+    fn checkpoint(&self, py: Python) -> PyObject {
+        let data = py.allow_threads(|| {
+            let (routes, tasks) = {
+                let inner = self.inner.lock().unwrap();
+                let routes: Vec<(u32, u32)> =
+                    inner.queue_by_task.iter().map(|(n, q)| (*n, *q)).collect();
+                let mut tasks: Vec<(u128, Task)> =
+                    inner.tasks.iter().map(|(u, t)| (*u, *t)).collect();
+                tasks.reverse();
+                (routes, tasks)
+            };
+            // labels are only ever appended, the ids copied above stay valid
+            let labels = self.labels.lock().unwrap();
+            Checkpoint::encode(&labels.strings, &routes, &tasks)
+        });
+        PyBytes::new(py, &data).into()
+    }
+
+    /// Loads the tasks and the task routes of a checkpoint, from any object
+    /// exposing it as a buffer, like bytes or a memory map. Tasks owned by
+    /// other shards are skipped. Returns the number of tasks loaded.
+    fn restore(&self, py: Python, checkpoint: &PyAny) -> PyResult<usize> {
+        let buffer: PyBuffer<u8> = PyBuffer::get(checkpoint)?;
+        let cells = buffer
+            .as_slice(py)
+            .ok_or_else(|| PyValueError::new_err("Checkpoint buffer is not contiguous"))?;
+        let checkpoint = Checkpoint::decode(cells)?;
+
+        let ids: Vec<u32> = {
+            let mut labels = self.labels.lock().unwrap();
+            checkpoint.labels.iter().map(|l| labels.intern(l)).collect()
+        };
+
+        Ok(py.allow_threads(|| {
+            let mut inner = self.inner.lock().unwrap();
+            for (name, queue) in checkpoint.routes.iter() {
+                inner
+                    .queue_by_task
+                    .insert(ids[*name as usize], ids[*queue as usize]);
+            }
+            let mut loaded = 0;
+            for (uuid, task) in checkpoint.tasks.iter() {
+                if !inner.shard.owns(*uuid) {
+                    continue;
+                }
+                let task = Task {
+                    name: ids[task.name as usize],
+                    ..*task
+                };
+                inner.clock = inner.clock.max(task.local_received);
+                if inner.tasks.len() == inner.tasks.cap() && inner.tasks.peek(uuid).is_none() {
+                    inner.stats.evictions += 1;
+                }
+                if let Some(wheel) = inner.wheel.as_mut() {
+                    wheel.insert(*uuid, task.local_received);
+                }
+                inner.tasks.put(*uuid, task);
+                loaded += 1;
+            }
+            loaded
+        }))
+    }
+
+    /// Counts events dropped by the ingestion before reaching the state.
+    fn record_dropped(&self, count: u64) {
+        self.inner.lock().unwrap().stats.dropped += count;
+    }
+
+    /// Returns the ingestion stats: events seen by type, the bounds and
+    /// the cumulative buckets of the lag histograms, the number of tasks
+    /// in the LRU, its capacity, the number of tasks evicted and expired
+    /// from it, the number of events dropped, of message bodies that could
+    /// not be parsed, and the sample rate.
+    fn stats(&self, py: Python) -> StatsSnapshot {
+        py.allow_threads(|| {
+            let (events, lag, tasks, capacity, evictions, expirations, dropped, malformed, rate) = {
+                let inner = self.inner.lock().unwrap();
+                let stats = &inner.stats;
+                let events: Vec<(u32, u64)> = stats.events.iter().map(|(k, c)| (*k, *c)).collect();
+                let lag = vec![
+                    (
+                        "broker",
+                        stats.broker_lag.cumulative(),
+                        stats.broker_lag.sum,
+                    ),
+                    (
+                        "exporter",
+                        stats.exporter_lag.cumulative(),
+                        stats.exporter_lag.sum,
+                    ),
+                ];
+                (
+                    events,
+                    lag,
+                    inner.tasks.len(),
+                    inner.tasks.cap(),
+                    stats.evictions,
+                    stats.expirations,
+                    stats.dropped,
+                    stats.malformed,
+                    inner.sampler.rate(),
+                )
+            };
+            let labels = self.labels.lock().unwrap();
+            (
+                events
+                    .into_iter()
+                    .map(|(kind, cnt)| (labels.resolve(kind), cnt))
+                    .collect(),
+                LAG_BUCKETS.to_vec(),
+                lag,
+                tasks,
+                capacity,
+                evictions,
+                expirations,
+                dropped,
+                malformed,
+                rate,
+            )
+        })
+    }
+
+    /// Returns the quantiles, the count and the sum of the runtime, latency,
+    /// broker wait and end to end sketches, empty unless sketching.
+    fn summaries(&self, py: Python) -> Summaries {
+        py.allow_threads(|| {
+            let (runtime, latency, broker_wait, end_to_end) = {
+                let inner = self.inner.lock().unwrap();
+                let metrics = &inner.metrics;
+                (
+                    metrics.summarize(&metrics.runtime),
+                    metrics.summarize(&metrics.latency),
+                    metrics.summarize(&metrics.broker_wait),
+                    metrics.summarize(&metrics.end_to_end),
+                )
+            };
+            let labels = self.labels.lock().unwrap();
+            let resolve = |ss: Vec<(u32, u32, Vec<(f64, f64)>, u64, f64)>| -> SummariesSnapshot {
+                ss.into_iter()
+                    .map(|(name, queue, quantiles, count, sum)| {
+                        (
+                            labels.resolve(name),
+                            labels.resolve(queue),
+                            quantiles,
+                            count,
+                            sum,
+                        )
+                    })
+                    .collect()
+            };
+            (
+                resolve(runtime),
+                resolve(latency),
+                resolve(broker_wait),
+                resolve(end_to_end),
+            )
+        })
+    }
+
+    /// Returns the bins, the count of zeros, the count and the sum of the
+    /// runtime, latency, broker wait and end to end sketches, empty unless
+    /// sketching, for them to be merged with the sketches of other shards.
+    fn sketches(&self, py: Python) -> Sketches {
+        py.allow_threads(|| {
+            let (runtime, latency, broker_wait, end_to_end) = {
+                let inner = self.inner.lock().unwrap();
+                let metrics = &inner.metrics;
+                (
+                    metrics.bins(&metrics.runtime),
+                    metrics.bins(&metrics.latency),
+                    metrics.bins(&metrics.broker_wait),
+                    metrics.bins(&metrics.end_to_end),
+                )
+            };
+            let labels = self.labels.lock().unwrap();
+            let resolve =
+                |ss: Vec<(u32, u32, Vec<(i32, u64)>, u64, u64, f64)>| -> SketchesSnapshot {
+                    ss.into_iter()
+                        .map(|(name, queue, bins, zeros, count, sum)| {
+                            (
+                                labels.resolve(name),
+                                labels.resolve(queue),
+                                bins,
+                                zeros,
+                                count,
+                                sum,
+                            )
+                        })
+                        .collect()
+                };
+            (
+                resolve(runtime),
+                resolve(latency),
+                resolve(broker_wait),
+                resolve(end_to_end),
+            )
+        })
+    }
+
+    /// Returns a snapshot of the task counters and of the runtime, latency,
+    /// broker wait, end to end and retries histograms, with cumulative
+    /// bucket counts ending in +Inf.
+    fn snapshot(&self, py: Python) -> Snapshot {
+        py.allow_threads(|| {
+            let (tasks, runtime, latency, broker_wait, end_to_end, retries) = {
+                let inner = self.inner.lock().unwrap();
+                let tasks: Vec<(u32, TaskState, u32, u64)> = inner
+                    .metrics
+                    .tasks
+                    .iter()
+                    .map(|((name, state, queue), cnt)| (*name, *state, *queue, *cnt))
+                    .collect();
+                (
+                    tasks,
+                    histograms(&inner.metrics.runtime),
+                    histograms(&inner.metrics.latency),
+                    histograms(&inner.metrics.broker_wait),
+                    histograms(&inner.metrics.end_to_end),
+                    histograms(&inner.metrics.retries),
+                )
+            };
+
+            let labels = self.labels.lock().unwrap();
+            let resolve = |hs: Vec<(u32, u32, Vec<u64>, f64)>| -> HistogramsSnapshot {
+                hs.into_iter()
+                    .map(|(name, queue, buckets, sum)| {
+                        (labels.resolve(name), labels.resolve(queue), buckets, sum)
+                    })
+                    .collect()
+            };
+            (
+                tasks
+                    .into_iter()
+                    .map(|(name, state, queue, cnt)| {
+                        (
+                            labels.resolve(name),
+                            state.as_str(),
+                            labels.resolve(queue),
+                            cnt,
+                        )
+                    })
+                    .collect(),
+                resolve(runtime),
+                resolve(latency),
+                resolve(broker_wait),
+                resolve(end_to_end),
+                resolve(retries),
+            )
+        })
+    }
+}
+
+impl CeleryState {
+    /// Parses a task event, returning it along with the task names given or
+    /// released a label meanwhile.
+    fn parse(&self, evt: &PyDict) -> PyResult<Option<(TaskEvent<u32>, Vec<(u32, bool)>)>> {
+        match Event::from_dict(evt, event_type(evt)?)? {
+            Some(Event::Task(task)) => {
+                let mut names = self.names.lock().unwrap();
+                let task = task.intern(&mut self.labels.lock().unwrap(), &mut names);
+                Ok(Some((task, names.changes())))
+            }
+            _ => Ok(None),
+        }
+    }
+}
+
+fn histograms(distribution: &Distribution) -> Vec<(u32, u32, Vec<u64>, f64)> {
+    distribution
+        .histograms
+        .iter()
+        .map(|((name, queue), h)| (*name, *queue, h.cumulative(), h.sum))
+        .collect()
+}
+
+impl Inner {
+    /// Applies the changes of the names labelled by a TopK, folding the
+    /// series of the names whose label was released into OTHER.
+    fn relabel(&mut self, changes: &[(u32, bool)]) {
+        for (name, labelled) in changes.iter() {
+            if *labelled {
+                self.released.remove(name);
+            } else {
+                self.released.insert(*name);
+                self.metrics.fold(*name);
+            }
+        }
+    }
+
+    /// The label a task known by name is reported under.
+    fn shown(&self, name: u32) -> u32 {
+        if self.released.contains(&name) {
+            OTHER
+        } else {
+            name
+        }
+    }
+
+    fn process(&mut self, task: &TaskEvent<u32>) {
+        if let Some(worker) = task.hostname.and_then(|h| self.workers.get_mut(&h)) {
+            worker.task_event = worker.task_event.max(task.local_received);
+        }
+        if !self.shard.owns(task.uuid) {
+            // Other shards count this task, only learn where it is routed.
+            if let (Some(name), Some(queue)) = (task.name, task.queue) {
+                self.queue_by_task.insert(name, queue);
+            }
+            return;
+        }
+        let shift = match self.tasks.peek(&task.uuid) {
+            Some(t) => t.shift,
+            None if self.sampler.samples(task.uuid) => self.sampler.shift,
+            None => {
+                // Sampled out, only learn where it is routed.
+                if let (Some(name), Some(queue)) = (task.name, task.queue) {
+                    self.queue_by_task.insert(name, queue);
+                }
+                return;
+            }
+        };
+        let weight = 1 << shift;
+        if let Some((name, queue, latency)) = self.task_latency(task) {
+            let ln_gamma = self.metrics.ln_gamma;
+            self.metrics
+                .latency
+                .observe(ln_gamma, (name, queue), latency, weight);
+        }
+        let outcome = self.collect_task(task, shift);
+        self.metrics.observe(&outcome, weight);
+    }
+
+    /// Drops the tasks whose first event is older than the TTL according
+    /// to the latest event seen. The wheel is compacted once it holds twice
+    /// as many entries as the LRU can hold tasks, dropping the entries of
+    /// the tasks no longer tracked or tracked again since, so that it stays
+    /// within the memory budget of the tasks.
+    fn expire(&mut self) {
+        let wheel = match self.wheel.as_mut() {
+            Some(wheel) => wheel,
+            None => return,
+        };
+        if wheel.entries > 2 * self.tasks.cap() {
+            let tasks = &self.tasks;
+            wheel.compact(|uuid, slot| {
+                tasks
+                    .peek(&uuid)
+                    .map_or(false, |t| slot >= t.local_received.floor() as i64)
+            });
+        }
+        let ttl = wheel.ttl;
+        for uuid in wheel.due(self.clock) {
+            // tasks ended or evicted meanwhile are no longer there
+            let expired = match self.tasks.peek(&uuid) {
+                Some(t) => self.clock - t.local_received > ttl,
+                None => false,
+            };
+            if expired {
+                self.tasks.pop(&uuid);
+                self.stats.expirations += 1;
+            }
+        }
+    }
+
+    fn process_worker(&mut self, evt: &WorkerEvent<u32>) {
+        let worker = self.workers.entry(evt.hostname).or_insert_with(Worker::new);
+        worker.online = evt.online;
+        // A late event doesn't take the liveness of the worker back.
+        worker.last_seen = worker.last_seen.max(evt.local_received);
+        if let Some(freq) = evt.freq {
+            worker.freq = freq;
+        }
+        if evt.active.is_some() {
+            worker.active = evt.active;
+        }
+        if evt.processed.is_some() {
+            worker.processed = evt.processed;
         }
+        if evt.loadavg.is_some() {
+            worker.loadavg = evt.loadavg;
+        }
+    }
 
+    fn queue_of(&self, name: u32) -> u32 {
+        *self.queue_by_task.get(&name).unwrap_or(&MISSING)
+    }
+
+    /// Records a task event, tracking the tasks first seen with the given
+    /// sampling shift.
+    fn collect_task(&mut self, task: &TaskEvent<u32>, shift: u8) -> Outcome {
         match task.state {
-            TaskState::RECEIVED => self.task_count += 1,
-            _ => {}
+            TaskState::SUCCESS | TaskState::FAILURE | TaskState::REVOKED => {
+                let popped = self.tasks.pop(&task.uuid);
+                let name = match popped {
+                    Some(t) => t.name,
+                    None => task.name.unwrap_or(MISSING),
+                };
+                let (end_to_end, retries) = match popped {
+                    Some(t) if task.state != TaskState::REVOKED => (
+                        t.at(t.sent).map(|sent| task.local_received - sent),
+                        Some(t.retries),
+                    ),
+                    _ => (None, None),
+                };
+                Outcome {
+                    name: self.shown(name),
+                    state: task.state,
+                    queue: self.queue_of(name),
+                    runtime: task.runtime,
+                    broker_wait: None,
+                    end_to_end,
+                    retries,
+                }
+            }
+            _ => {
+                let (name, broker_wait) = self.event(task, shift);
+                if let Some(q) = task.queue {
+                    self.queue_by_task.insert(name, q);
+                }
+                Outcome {
+                    name: self.shown(name),
+                    state: task.state,
+                    queue: self.queue_of(name),
+                    runtime: None,
+                    broker_wait,
+                    end_to_end: None,
+                    retries: None,
+                }
+            }
+        }
+    }
+
+    fn task_latency(&mut self, task: &TaskEvent<u32>) -> Option<(u32, u32, f64)> {
+        if let TaskState::STARTED = task.state {
+            if let Some(p) = self.tasks.get(&task.uuid) {
+                if let TaskState::RECEIVED = p.state {
+                    let received = p.at(p.received).unwrap_or(p.local_received);
+                    let (name, latency) = (p.name, task.local_received - received);
+                    return Some((self.shown(name), self.queue_of(name), latency));
+                }
+            }
+        }
+        None
+    }
+
+    /// Records a non terminal event of a task, tracking the task in the LRU
+    /// if unknown. Returns the name the task is known by and the time it
+    /// waited in the broker, when the event tells it.
+    fn event(&mut self, task: &TaskEvent<u32>, shift: u8) -> (u32, Option<f64>) {
+        self.event_count += 1;
+
+        if let TaskState::RECEIVED = task.state {
+            self.task_count += 1;
+        }
+
+        match self.tasks.get_mut(&task.uuid) {
+            Some(t) => (t.name, t.mark(task.state, task.local_received)),
+            None => {
+                let name = task.name.unwrap_or(MISSING);
+                if self.tasks.len() == self.tasks.cap() {
+                    self.stats.evictions += 1;
+                }
+                if let Some(wheel) = self.wheel.as_mut() {
+                    wheel.insert(task.uuid, task.local_received);
+                }
+                let mut t = Task::new(name, task.local_received, task.state);
+                t.shift = shift;
+                t.mark(task.state, task.local_received);
+                self.tasks.put(task.uuid, t);
+                (name, None)
+            }
+        }
+    }
+}
+
+/// Splits the batches of events of a sharded ingestion between the shards
+/// before they are parsed in full, for each shard to only parse its share of
+/// the stream: an item goes to the shard owning the task of its events, as
+/// CeleryState would tell, the items of worker events to every shard, and
+/// those that can't be parsed to the first one. Only the fields telling
+/// where an event goes are read from the raw bodies.
+///
+/// The queues the tasks are routed to are reported apart, for every shard
+/// to learn those of the tasks of the others.
+#[pyclass]
+struct EventRouter {
+    shard_count: u32,
+    queues: HashMap<String, String>, // latest queue reported by task name
+}
+
+#[pymethods]
+impl EventRouter {
+    #[new]
+    fn new(shard_count: u32) -> PyResult<Self> {
+        if shard_count == 0 {
+            return Err(PyValueError::new_err("Invalid shard count 0"));
+        }
+        Ok(EventRouter {
+            shard_count,
+            queues: HashMap::new(),
+        })
+    }
+
+    /// Splits a batch as given to CeleryState.process_batch into a batch
+    /// per shard, returned along with the (name, queue) routes of the task
+    /// names first seen with a queue, or with another one, since the last
+    /// call.
+    fn route(&mut self, events: &PyList) -> PyResult<(Vec<Vec<PyObject>>, Vec<(String, String)>)> {
+        let mut batches: Vec<Vec<PyObject>> = (0..self.shard_count).map(|_| Vec::new()).collect();
+        let mut routes = Vec::new();
+        let mut shards = vec![false; self.shard_count as usize];
+        for item in events.iter() {
+            shards.iter_mut().for_each(|s| *s = false);
+            if let Ok(evt) = item.downcast::<PyDict>() {
+                let kind = event_type(evt)?;
+                if is_task_event(kind) {
+                    let uuid = match evt.get_item("uuid") {
+                        Some(u) => Some(u.str()?.to_str()?),
+                        None => None,
+                    };
+                    let name = match evt.get_item("name") {
+                        Some(n) => Some(n.extract()?),
+                        None => None,
+                    };
+                    let queue = match evt.get_item("queue") {
+                        Some(q) => Some(q.extract()?),
+                        None => None,
+                    };
+                    self.mark(kind, uuid, name, queue, &mut shards, &mut routes);
+                } else {
+                    self.mark(kind, None, None, None, &mut shards, &mut routes);
+                }
+            } else {
+                let (body, _): (&PyBytes, f64) = item.extract()?;
+                match parse_body::<RoutedEvent>(body.as_bytes()) {
+                    Ok(raw) => {
+                        for evt in raw.iter() {
+                            self.mark(
+                                evt.kind.as_str(),
+                                evt.uuid.as_ref().map(RawStr::as_str),
+                                evt.name.as_ref().map(RawStr::as_str),
+                                evt.queue.as_ref().map(RawStr::as_str),
+                                &mut shards,
+                                &mut routes,
+                            );
+                        }
+                    }
+                    // counted as malformed by the first shard
+                    Err(_) => shards[0] = true,
+                }
+            }
+            for (batch, _) in batches.iter_mut().zip(shards.iter()).filter(|(_, s)| **s) {
+                batch.push(item.into());
+            }
+        }
+        Ok((batches, routes))
+    }
+}
+
+impl EventRouter {
+    /// Marks the shards an event goes to, recording the route of a task
+    /// event if new.
+    fn mark(
+        &mut self,
+        kind: &str,
+        uuid: Option<&str>,
+        name: Option<&str>,
+        queue: Option<&str>,
+        shards: &mut [bool],
+        routes: &mut Vec<(String, String)>,
+    ) {
+        if is_worker_event(kind) {
+            shards.iter_mut().for_each(|s| *s = true);
+            return;
+        }
+        if !is_task_event(kind) {
+            shards[0] = true;
+            return;
+        }
+        let uuid = uuid.map_or(MISSING_UUID, parse_uuid);
+        shards[shard_of(uuid, self.shard_count) as usize] = true;
+        if let (Some(name), Some(queue)) = (name, queue) {
+            if self.queues.get(name).map(String::as_str) != Some(queue) {
+                if self.queues.len() >= NAME_CACHE_CAPACITY {
+                    self.queues.clear();
+                }
+                self.queues.insert(name.to_string(), queue.to_string());
+                routes.push((name.to_string(), queue.to_string()));
+            }
         }
     }
 }
@@ -235,5 +2667,7 @@ impl CeleryState {
 #[pymodule]
 fn celery_exporter(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_class::<CeleryState>()?;
+    m.add_class::<EventRouter>()?;
+    m.add_class::<TaskNames>()?;
     Ok(())
 }
@@ -0,0 +1,299 @@
+"""
+Generates, records and replays synthetic Celery event streams, and measures
+how fast the exporter ingests them.
+
+Recording a stream of a million tasks and replaying it:
+
+    python test/event_stream.py record events.jsonl.gz --tasks 1000000
+    python test/event_stream.py replay events.jsonl.gz
+"""
+
+import argparse
+import gzip
+import heapq
+import json
+import random
+import resource
+import sys
+import time
+import uuid
+from itertools import islice
+
+TERMINAL_STATES = ("task-succeeded", "task-failed", "task-retried")
+
+
+def generate(
+    tasks,
+    names=50,
+    queues=5,
+    concurrency=100,
+    failed=0.05,
+    retried=0.05,
+    out_of_order=0.01,
+    dropped=0.01,
+    seed=0,
+    start=None,
+    payload=100,
+):
+    """
+    Yields the events of tasks tasks going through their sent, received,
+    started and terminal events, concurrency of them in flight at once.
+    Task names are drawn among names and routed to one of queues queues,
+    their received events carrying args of payload characters.
+    Retried tasks go through received and started again. A fraction
+    out_of_order of the events is swapped with the following one, and a
+    fraction dropped of them is never emitted.
+    """
+    rnd = random.Random(seed)
+    now = time.time() if start is None else start
+    task_names = ["app.tasks.task_{}".format(i) for i in range(names)]
+    task_queues = ["queue_{}".format(i) for i in range(queues)]
+
+    started, seq = 0, 0
+    in_flight = []  # heap of (timestamp, seq, task)
+    held = None
+
+    while started < tasks or in_flight:
+        while started < tasks and len(in_flight) < concurrency:
+            i = rnd.randrange(names)
+            task = {
+                "uuid": str(uuid.UUID(int=rnd.getrandbits(128), version=4)),
+                "name": task_names[i],
+                "queue": task_queues[i % queues],
+                "next": "task-sent",
+            }
+            now += rnd.expovariate(1000)
+            heapq.heappush(in_flight, (now, seq, task))
+            started += 1
+            seq += 1
+
+        timestamp, _, task = heapq.heappop(in_flight)
+        evt = _event(task, timestamp, rnd, failed, retried, payload)
+        if task["next"] is not None:
+            delay = rnd.expovariate(20 if task["next"] in TERMINAL_STATES else 200)
+            heapq.heappush(in_flight, (timestamp + delay, seq, task))
+            seq += 1
+
+        if rnd.random() < dropped:
+            continue
+        if held is not None:
+            yield evt
+            yield held
+            held = None
+        elif rnd.random() < out_of_order:
+            held = evt
+        else:
+            yield evt
+
+    if held is not None:
+        yield held
+
+
+def _event(task, timestamp, rnd, failed, retried, payload):
+    """
+    Builds the next event of task, advancing it to the following one.
+    """
+    kind = task["next"]
+    evt = {
+        "type": kind,
+        "uuid": task["uuid"],
+        "timestamp": timestamp,
+        "local_received": timestamp + 0.001,
+    }
+    if kind == "task-sent":
+        evt.update(name=task["name"], queue=task["queue"])
+        task["next"] = "task-received"
+    elif kind == "task-received":
+        evt.update(
+            name=task["name"],
+            hostname="celery@worker",
+            args="({!r},)".format("x" * payload),
+            kwargs="{}",
+        )
+        task["next"] = "task-started"
+    elif kind == "task-started":
+        evt.update(hostname="celery@worker")
+        draw = rnd.random()
+        if draw < failed:
+            task["next"] = "task-failed"
+        elif draw < failed + retried:
+            task["next"] = "task-retried"
+        else:
+            task["next"] = "task-succeeded"
+    elif kind == "task-succeeded":
+        evt.update(runtime=rnd.expovariate(10), result="None")
+        task["next"] = None
+    elif kind == "task-failed":
+        evt.update(exception="ValueError()", traceback="")
+        task["next"] = None
+    elif kind == "task-retried":
+        evt.update(exception="ValueError()", traceback="")
+        task["next"] = "task-received"
+    return evt
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def record(events, path):
+    """
+    Writes events to path as JSON lines, gzip-compressed if path ends with
+    .gz, and returns the number of events written.
+    """
+    count = 0
+    with _open(path, "w") as f:
+        for evt in events:
+            f.write(json.dumps(evt))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def replay(path):
+    """
+    Yields the events recorded in path.
+    """
+    with _open(path, "r") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def raw_bodies(events):
+    """
+    Yields events as the JSON bodies of their messages along with their
+    reception time, as handed over by the RawEventReceiver.
+    """
+    for evt in events:
+        body = {k: v for k, v in evt.items() if k != "local_received"}
+        yield json.dumps(body).encode(), evt["local_received"]
+
+
+def measure(process, events, batch_size=1):
+    """
+    Feeds events to process in batches of batch_size, returning the
+    events per second, the p99 latency of the events in microseconds, the
+    latency of an event being the processing time of the batch it is part
+    of, and the peak RSS of the whole process so far in MiB, including what
+    the targets measured before took.
+    """
+    events = iter(events)
+    durations = []  # of the batches, with their sizes
+    count = 0
+    total = 0.0
+    while True:
+        batch = list(islice(events, batch_size))
+        if not batch:
+            break
+        start = time.perf_counter()
+        process(batch)
+        elapsed = time.perf_counter() - start
+        durations.append((elapsed, len(batch)))
+        total += elapsed
+        count += len(batch)
+
+    p99 = 0.0
+    rank = int(count * 0.99)
+    for elapsed, size in sorted(durations):
+        p99 = elapsed
+        rank -= size
+        if rank < 0:
+            break
+    return {
+        "events": count,
+        "events_per_sec": count / total if total else 0.0,
+        "event_p99_us": p99 * 1e6,
+        "process_peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / 1024,
+    }
+
+
+def targets(max_tasks_in_memory=10000):
+    """
+    Returns the processing functions to benchmark, by name, each taking a
+    batch of events, along with their batch size and the function encoding
+    the events they take, if any.
+    """
+    import celery
+
+    from celery_exporter.celery_exporter import CeleryState
+    from celery_exporter.monitor import TaskThread
+
+    def collect_and_latency():
+        state = CeleryState(max_tasks_in_memory)
+
+        def process(batch):
+            for evt in batch:
+                state.latency(evt)
+                state.collect(evt)
+
+        return process
+
+    def process_batch():
+        return CeleryState(max_tasks_in_memory).process_batch
+
+    def task_thread():
+        return TaskThread(
+            app=celery.Celery(broker="memory://"),
+            namespace="benchmark",
+            max_tasks_in_memory=max_tasks_in_memory,
+        )._process_batch
+
+    return {
+        "CeleryState.collect/latency": (collect_and_latency, 1, None),
+        "CeleryState.process_batch": (process_batch, 512, None),
+        "CeleryState.process_batch/raw": (process_batch, 512, raw_bodies),
+        "TaskThread._process_batch/raw": (task_thread, 512, raw_bodies),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    rec = commands.add_parser("record", help="Record a synthetic event stream.")
+    rec.add_argument("path")
+    rec.add_argument("--tasks", type=int, default=100000)
+    rec.add_argument("--names", type=int, default=50)
+    rec.add_argument("--queues", type=int, default=5)
+    rec.add_argument("--out-of-order", type=float, default=0.01)
+    rec.add_argument("--dropped", type=float, default=0.01)
+    rec.add_argument("--seed", type=int, default=0)
+    rec.add_argument("--payload", type=int, default=100)
+    rep = commands.add_parser("replay", help="Benchmark a recorded event stream.")
+    rep.add_argument("path")
+    rep.add_argument("--max-tasks", type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        events = generate(
+            args.tasks,
+            names=args.names,
+            queues=args.queues,
+            out_of_order=args.out_of_order,
+            dropped=args.dropped,
+            seed=args.seed,
+            payload=args.payload,
+        )
+        print("Recorded {} events".format(record(events, args.path)))
+    elif args.command == "replay":
+        events = list(replay(args.path))
+        for name, (factory, batch_size, encode) in targets(args.max_tasks).items():
+            inputs = list(encode(events)) if encode else events
+            result = measure(factory(), inputs, batch_size)
+            print(
+                "{:<30} {events:>10} events {events_per_sec:>12.0f} events/s "
+                "event p99 {event_p99_us:>10.1f}us "
+                "process peak rss {process_peak_rss_mib:>8.1f}MiB".format(
+                    name, **result
+                )
+            )
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
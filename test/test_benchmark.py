@@ -0,0 +1,209 @@
+import json
+import os
+import time
+from collections import Counter
+from itertools import chain
+
+import pytest
+from event_stream import generate, measure, raw_bodies, record, replay, targets
+
+from celery_exporter.utils import CELERY_DEFAULT_QUEUE, RouteIndex, resolve_routes
+
+
+def legacy_wildcards(name):
+    chunked = name.split(".")
+    res = [name]
+    for elem in reversed(chunked):
+        chunked.pop()
+        res.append(".".join(chunked + ["*"]))
+    return res
+
+
+def legacy_resolve_routes(registered_tasks, confs):
+    """
+    Routing resolution as implemented before RouteIndex, probing every
+    wildcard of every task against every worker conf.
+    """
+    res = dict()
+    default_queues = []
+    for task_name in set(chain.from_iterable(registered_tasks)):
+        for conf in confs.values():
+            default = conf.get("task_default_queue", CELERY_DEFAULT_QUEUE)
+            default_queues.append(default)
+            if task_name in res and res[task_name] not in default_queues:
+                break
+
+            task_wildcard_names = legacy_wildcards(task_name)
+            if "task_routes" in conf:
+                routes = conf["task_routes"]
+                res[task_name] = default
+                for i in task_wildcard_names:
+                    if i in routes and "queue" in routes[i]:
+                        res[task_name] = routes[i]["queue"]
+                        break
+            else:
+                res[task_name] = default
+    return res
+
+
+def synthetic_config(tasks, workers):
+    names = [
+        "app{}.module{}.tasks.task_{}".format(i % 7, i % 31, i) for i in range(tasks)
+    ]
+    routes = {"app{}.*".format(i): {"queue": "app{}".format(i)} for i in range(3)}
+    routes.update(
+        {"app3.module{}.*".format(i): {"queue": "m{}".format(i)} for i in range(5)}
+    )
+    routes.update({name: {"queue": "exact"} for name in names[::11]})
+    routes.update({name: {} for name in names[1::13]})
+    variants = [
+        {"task_routes": routes},
+        {"task_routes": dict(routes, **{"*": {"queue": CELERY_DEFAULT_QUEUE}})},
+        {},
+    ]
+    confs = {
+        "celery@worker{}".format(i): variants[i % len(variants)] for i in range(workers)
+    }
+    registered = {worker: names for worker in confs}
+    return registered.values(), confs
+
+
+# the timings are only asserted on demand, being too noisy for the default run
+benchmark = pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="set BENCHMARK=1 to run the benchmarks"
+)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+@pytest.mark.parametrize(
+    "routes,task,queue",
+    [
+        ({"a.b.c": {"queue": "exact"}, "a.b.*": {"queue": "ab"}}, "a.b.c", "exact"),
+        ({"a.b.*": {"queue": "ab"}, "a.*": {"queue": "a"}}, "a.b.c", "ab"),
+        ({"a.b.*": {"queue": "ab"}, "a.*": {"queue": "a"}}, "a.b", "a"),
+        ({"a.*": {"queue": "a"}, "*": {"queue": "all"}}, "b.c", "all"),
+        ({"a.b.c": {}, "a.*": {"queue": "a"}}, "a.b.c", "a"),
+        ({"a.b": {"queue": "ab"}}, "a.b.c", None),
+        ({}, "a", None),
+    ],
+)
+def test_route_index(routes, task, queue):
+    assert RouteIndex(routes).resolve(task) == queue
+    legacy = legacy_resolve_routes([[task]], {"w": {"task_routes": routes}})
+    assert legacy[task] == (queue or CELERY_DEFAULT_QUEUE)
+
+
+def test_resolve_routes_equivalence():
+    registered, confs = synthetic_config(tasks=500, workers=100)
+
+    assert resolve_routes(registered, confs) == legacy_resolve_routes(registered, confs)
+
+
+@benchmark
+def test_resolve_routes_benchmark():
+    registered, confs = synthetic_config(tasks=500, workers=100)
+
+    expected, legacy_time = timed(legacy_resolve_routes, registered, confs)
+    result, index_time = timed(resolve_routes, registered, confs)
+
+    assert result == expected
+    assert index_time * 5 < legacy_time
+
+
+@benchmark
+def test_resolve_routes_large_config():
+    registered, confs = synthetic_config(tasks=2000, workers=300)
+
+    result, index_time = timed(resolve_routes, registered, confs)
+
+    assert len(result) == 2000
+    assert index_time < 1
+
+
+BENCHMARK_TASKS = int(os.environ.get("BENCHMARK_TASKS", 20000))
+
+
+def test_event_stream():
+    events = list(generate(2000, names=10, queues=3, seed=1, start=1.6e9))
+    kinds = Counter(evt["type"] for evt in events)
+
+    assert 1900 < kinds["task-sent"] <= 2000
+    assert kinds["task-received"] > kinds["task-sent"] * 0.9
+    assert kinds["task-succeeded"] > kinds["task-failed"] + kinds["task-retried"]
+    assert len({evt["name"] for evt in events if "name" in evt}) == 10
+    assert len({evt["queue"] for evt in events if "queue" in evt}) == 3
+    assert any(a["timestamp"] > b["timestamp"] for a, b in zip(events, events[1:]))
+    assert events == list(generate(2000, names=10, queues=3, seed=1, start=1.6e9))
+
+
+def test_event_stream_ordered():
+    events = list(generate(2000, out_of_order=0, dropped=0))
+    kinds = Counter(evt["type"] for evt in events)
+
+    assert kinds["task-sent"] == 2000
+    assert kinds["task-succeeded"] + kinds["task-failed"] == 2000
+    assert all(a["timestamp"] <= b["timestamp"] for a, b in zip(events, events[1:]))
+
+
+@pytest.mark.parametrize("filename", ["events.jsonl", "events.jsonl.gz"])
+def test_event_stream_record_replay(tmp_path, filename):
+    path = str(tmp_path / filename)
+    events = list(generate(100))
+
+    assert record(iter(events), path) == len(events)
+    assert list(replay(path)) == events
+
+
+def test_raw_bodies():
+    events = list(generate(100, payload=1000))
+    bodies = list(raw_bodies(events))
+
+    for evt, (body, local_received) in zip(events, bodies):
+        assert isinstance(body, bytes)
+        assert dict(json.loads(body), local_received=local_received) == evt
+    assert any(len(body) > 1000 for body, _ in bodies)
+
+
+def test_measure(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(time, "perf_counter", lambda: clock[0])
+
+    def process(batch):
+        # the first batch of ten events is a hundred times slower
+        clock[0] += 100e-6 if batch[0] == 0 else 1e-6
+
+    result = measure(process, range(1000), batch_size=10)
+    assert result["events"] == 1000
+    # the events of the slow batch are the slowest 1%
+    assert result["event_p99_us"] == pytest.approx(100)
+
+
+@pytest.fixture(scope="module")
+def benchmark_events():
+    return list(generate(BENCHMARK_TASKS))
+
+
+@benchmark
+@pytest.mark.parametrize(
+    "target,min_events_per_sec",
+    [
+        ("CeleryState.collect/latency", 50000),
+        ("CeleryState.process_batch", 100000),
+        ("CeleryState.process_batch/raw", 100000),
+        ("TaskThread._process_batch/raw", 100000),
+    ],
+)
+def test_ingestion_benchmark(benchmark_events, target, min_events_per_sec):
+    pytest.importorskip("celery_exporter.celery_exporter")
+    events = benchmark_events
+    factory, batch_size, encode = targets()[target]
+
+    result = measure(factory(), list(encode(events)) if encode else events, batch_size)
+
+    assert result["events"] == len(events)
+    assert result["events_per_sec"] > min_events_per_sec
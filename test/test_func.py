@@ -1,25 +1,25 @@
 from unittest.mock import patch, MagicMock
 from celery_test_utils import BaseTest
 
-import celery
 import celery_exporter.monitor
-from celery_exporter.core import CeleryExporter
+from celery_exporter.core import CeleryExporter, ExporterGroup
 
 prom_http_server_mock = MagicMock(return_value=None)
 setup_metrics_mock = MagicMock(return_value=None)
 task_thread_mock = MagicMock(spec=celery_exporter.monitor.TaskThread)
-worker_thread_mock = MagicMock(spec=celery_exporter.monitor.WorkerMonitoringThread)
-event_thread_mock = MagicMock(spec=celery_exporter.monitor.EnableEventsThread)
+control_plane_mock = MagicMock(spec=celery_exporter.monitor.ControlPlane)
+sharded_thread_mock = MagicMock(spec=celery_exporter.monitor.ShardedIngestionThread)
+queue_thread_mock = MagicMock(spec=celery_exporter.monitor.QueueLengthThread)
+periodic_jobs_mock = MagicMock(spec=celery_exporter.monitor.PeriodicJobs)
 
 
-@patch("celery.task.control.inspect.registered_tasks", {"worker1": [BaseTest.task]})
-@patch(
-    "celery_exporter.core.prometheus_client.start_http_server", prom_http_server_mock
-)
+@patch("celery_exporter.core.start_http_server", prom_http_server_mock)
 @patch("celery_exporter.core.setup_metrics", setup_metrics_mock)
 @patch("celery_exporter.core.TaskThread", task_thread_mock)
-@patch("celery_exporter.core.WorkerMonitoringThread", worker_thread_mock)
-@patch("celery_exporter.core.EnableEventsThread", event_thread_mock)
+@patch("celery_exporter.core.ControlPlane", control_plane_mock)
+@patch("celery_exporter.core.ShardedIngestionThread", sharded_thread_mock)
+@patch("celery_exporter.core.QueueLengthThread", queue_thread_mock)
+@patch("celery_exporter.core.PeriodicJobs", periodic_jobs_mock)
 class TestCeleryExporter(BaseTest):
     def setUp(self):
         self.cel_exp = CeleryExporter(
@@ -32,13 +32,28 @@ class TestCeleryExporter(BaseTest):
 
     def test_setup_metrics(self):
         self.cel_exp.start()
-        setup_metrics_mock.assert_called_with(
-            self.cel_exp._app, TestCeleryExporter.namespace
-        )
+        setup_metrics_mock.assert_called_with(TestCeleryExporter.namespace, {})
 
     def test_http_server(self):
         self.cel_exp.start()
-        prom_http_server_mock.assert_called_with(9090, "127.0.0.1")
+        prom_http_server_mock.assert_called_with(
+            9090, "127.0.0.1", self.cel_exp._exposition_cache, self.cel_exp.ready
+        )
+
+    def test_shutdown(self):
+        self.cel_exp.start()
+        self.cel_exp.shutdown()
+        task_thread_mock.return_value.shutdown.assert_called_with()
+
+    def test_ready(self):
+        assert not self.cel_exp.ready()
+        self.cel_exp.start()
+        task_thread_mock.return_value.connected.is_set.return_value = True
+        assert not self.cel_exp.ready()
+        self.cel_exp._config_cache.refreshed.set()
+        assert self.cel_exp.ready()
+        task_thread_mock.return_value.connected.is_set.return_value = False
+        assert not self.cel_exp.ready()
 
     def test_task_thread(self):
         self.cel_exp.start()
@@ -46,14 +61,113 @@ class TestCeleryExporter(BaseTest):
             self.cel_exp._app,
             TestCeleryExporter.namespace,
             TestCeleryExporter.max_tasks,
+            config_cache=self.cel_exp._config_cache,
+            task_ttl=None,
+            max_bytes=None,
+            checkpoint_path=None,
+            checkpoint_interval=60,
+            task_names=None,
+            runtime_buckets=None,
+            latency_buckets=None,
+            sketch_accuracy=None,
+            event_buffer_size=None,
+            overflow_policy="drop-oldest",
+            sample_rate=None,
+            sample_max_lag=None,
+            redis_consumer=False,
         )
 
-    def test_worker_thread(self):
+    def test_control_plane(self):
         self.cel_exp.start()
-        worker_thread_mock.assert_called_with(
-            self.cel_exp._app, TestCeleryExporter.namespace
+        control_plane_mock.assert_called_with(
+            self.cel_exp._app,
+            TestCeleryExporter.namespace,
+            self.cel_exp._config_cache,
+            state=task_thread_mock.return_value.state,
+            enable_events=True,
         )
+        control_plane_mock.return_value.start.assert_called_with()
 
-    def test_event_thread(self):
+    def test_queue_thread(self):
         self.cel_exp.start()
-        event_thread_mock.assert_called_with(self.cel_exp._app)
+        queue_thread_mock.assert_called_with(
+            self.cel_exp._app, TestCeleryExporter.namespace, self.cel_exp._config_cache
+        )
+        queue_thread_mock.return_value.start.assert_called_with()
+
+    def test_sharded_ingestion(self):
+        cel_exp = CeleryExporter(
+            broker_url="memory://",
+            listen_address="127.0.0.1:9090",
+            max_tasks=TestCeleryExporter.max_tasks,
+            namespace=TestCeleryExporter.namespace,
+            ingestion_processes=4,
+            max_tasks_bytes=1 << 20,
+        )
+        cel_exp.start()
+        sharded_thread_mock.assert_called_with(
+            cel_exp._app,
+            TestCeleryExporter.namespace,
+            TestCeleryExporter.max_tasks // 4,
+            4,
+            config_cache=cel_exp._config_cache,
+            task_ttl=None,
+            max_bytes=1 << 18,
+            checkpoint_path=None,
+            checkpoint_interval=60,
+            task_names=None,
+            runtime_buckets=None,
+            latency_buckets=None,
+            sketch_accuracy=None,
+            event_buffer_size=None,
+            overflow_policy="drop-oldest",
+            sample_rate=None,
+            sample_max_lag=None,
+            redis_consumer=False,
+        )
+        sharded_thread_mock.return_value.start_processes.assert_called_with()
+
+    def test_exporter_group(self):
+        exporters = [
+            CeleryExporter(
+                broker_url="memory://",
+                listen_address="127.0.0.1:9090",
+                namespace=namespace,
+            )
+            for namespace in ("first", "second")
+        ]
+        group = ExporterGroup(exporters, "127.0.0.1:9090", control_workers=2)
+        prom_http_server_mock.reset_mock()
+        group.start()
+
+        periodic_jobs_mock.assert_called_with(workers=2)
+        prom_http_server_mock.assert_called_once_with(
+            9090, "127.0.0.1", group._exposition_cache, group.ready
+        )
+        jobs = periodic_jobs_mock.return_value
+        jobs.start.assert_called_with()
+        jobs.schedule.assert_any_call(control_plane_mock.return_value.step)
+        jobs.schedule.assert_any_call(queue_thread_mock.return_value.step)
+        for exporter in exporters:
+            control_plane_mock.assert_any_call(
+                exporter._app,
+                exporter.namespace,
+                exporter._config_cache,
+                state=task_thread_mock.return_value.state,
+                enable_events=False,
+            )
+
+        assert not group.ready()
+        task_thread_mock.return_value.connected.is_set.return_value = True
+        exporters[0]._config_cache.refreshed.set()
+        assert not group.ready()
+        exporters[1]._config_cache.refreshed.set()
+        assert group.ready()
+
+    def test_exporter_group_namespaces(self):
+        exporters = [
+            CeleryExporter(broker_url="memory://", listen_address="127.0.0.1:9090")
+            for _ in range(2)
+        ]
+        with self.assertRaises(ValueError):
+            ExporterGroup(exporters, "127.0.0.1:9090")
@@ -1,42 +1,50 @@
-from time import time
+import json
+import os
+import socket
+import tempfile
+import threading
+from time import monotonic, time
 
 import celery
 import celery.states
+import kombu
+import kombu.compression
 
 from celery.events import Event
 from celery.utils import uuid
 from prometheus_client import REGISTRY
-from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+from celery_exporter.celery_exporter import CeleryState, EventRouter, TaskNames
+from celery_exporter.metrics import TASK_METRICS, WORKERS, ShardedState
 from celery_exporter.monitor import (
-    WorkerMonitoringThread,
+    RawEventReceiver,
+    ControlPlane,
+    ShardedIngestionThread,
     TaskThread,
-    EnableEventsThread,
+    QueueLengthThread,
+    PeriodicJobs,
     setup_metrics,
 )
 
-from celery_exporter.utils import CELERY_MISSING_DATA, get_config, _gen_wildcards
+from celery_exporter.utils import CELERY_MISSING_DATA, ConfigCache, ControlChannel
 
 from celery_test_utils import BaseTest, get_celery_app
 
 
+def drain_until(conn, stop):
+    while not stop.is_set():
+        try:
+            conn.drain_events(timeout=0.05)
+        except socket.timeout:
+            pass
+
+
 class TestMockedCelery(BaseTest):
     def setUp(self):
         self.app = get_celery_app()
-        with patch("celery.task.control.inspect.conf") as tasks:
-            with patch("celery.task.control.inspect.registered_tasks") as registered:
-                tasks.return_value = {
-                    "celery@d6f95e9e24fc": {
-                        "task_routes": {"my_task": {}, "trial": {"queue": "deadbeef"}}
-                    },
-                    "celery@adsqas78e891": {
-                        "task_routes": {"my_task": {}, "trial": {"queue": "deadbeef"}}
-                    },
-                    "celery@12311847jsa2": {},
-                }
-                registered.return_value = {"celery@d6f95e9e24fc": [self.task, "trial"]}
-                setup_metrics(self.app, self.namespace)  # reset metrics
+        # reset metrics
+        setup_metrics(self.namespace, {self.task: self.queue, "trial": "deadbeef"})
 
     def test_initial_metric_values(self):
         self._assert_task_states(celery.states.ALL_STATES, 0)
@@ -61,6 +69,33 @@ class TestMockedCelery(BaseTest):
             == 0
         )
 
+    def test_setup_metrics_incremental(self):
+        namespace = "incremental"
+
+        def seeded(name, queue):
+            return REGISTRY.get_sample_value(
+                "celery_tasks_total",
+                labels=dict(
+                    namespace=namespace,
+                    name=name,
+                    state=celery.states.PENDING,
+                    queue=queue,
+                ),
+            )
+
+        routes = {self.task: self.queue, "trial": "deadbeef"}
+        assert TASK_METRICS.seed(namespace, routes) == (2, 0)
+        assert TASK_METRICS.seed(namespace, dict(routes)) == (0, 0)
+
+        setup_metrics(namespace, {self.task: "rerouted", "new": "celery"})
+        assert seeded(self.task, "rerouted") == 0
+        assert seeded("new", "celery") == 0
+        assert seeded("trial", "deadbeef") is None
+
+        # no worker replied, the seeded tasks are kept
+        setup_metrics(namespace, {})
+        assert seeded("new", "celery") == 0
+
     def test_workers_count(self):
         assert (
             REGISTRY.get_sample_value(
@@ -69,11 +104,11 @@ class TestMockedCelery(BaseTest):
             == 0
         )
 
-        with patch.object(self.app.control, "ping") as mock_ping:
-            w = WorkerMonitoringThread(app=self.app, namespace=self.namespace)
+        with patch.object(ControlChannel, "broadcast") as mock_broadcast:
+            w = ControlPlane(app=self.app, namespace=self.namespace)
 
-            mock_ping.return_value = []
-            w.update_workers_count()
+            mock_broadcast.return_value = [([], 2)]
+            w.tick()
             assert (
                 REGISTRY.get_sample_value(
                     "celery_workers", labels=dict(namespace=self.namespace)
@@ -81,8 +116,8 @@ class TestMockedCelery(BaseTest):
                 == 0
             )
 
-            mock_ping.return_value = [0]  # 1 worker
-            w.update_workers_count()
+            mock_broadcast.return_value = [([0], 0.1)]  # 1 worker
+            w.tick()
             assert (
                 REGISTRY.get_sample_value(
                     "celery_workers", labels=dict(namespace=self.namespace)
@@ -90,8 +125,8 @@ class TestMockedCelery(BaseTest):
                 == 1
             )
 
-            mock_ping.return_value = [0, 0]  # 2 workers
-            w.update_workers_count()
+            mock_broadcast.return_value = [([0, 0], 0.1)]  # 2 workers
+            w.tick()
             assert (
                 REGISTRY.get_sample_value(
                     "celery_workers", labels=dict(namespace=self.namespace)
@@ -99,8 +134,8 @@ class TestMockedCelery(BaseTest):
                 == 2
             )
 
-            mock_ping.return_value = []
-            w.update_workers_count()
+            mock_broadcast.return_value = [([], 2)]
+            w.tick()
             assert (
                 REGISTRY.get_sample_value(
                     "celery_workers", labels=dict(namespace=self.namespace)
@@ -108,6 +143,94 @@ class TestMockedCelery(BaseTest):
                 == 0
             )
 
+    def test_workers_heartbeats(self):
+        now = time()
+        m = TaskThread(
+            app=self.app, namespace=self.namespace, max_tasks_in_memory=self.max_tasks
+        )
+        m._process_batch(
+            [
+                Event("worker-online", hostname="w1", freq=2.0, local_received=now),
+                Event(
+                    "worker-heartbeat",
+                    hostname="w2",
+                    freq=2.0,
+                    active=3,
+                    processed=10,
+                    loadavg=[0.1, 0.2, 0.3],
+                    local_received=now,
+                ),
+            ]
+        )
+        w2_labels = dict(namespace=self.namespace, hostname="w2")
+        assert (
+            REGISTRY.get_sample_value("celery_worker_tasks_active", labels=w2_labels)
+            == 3
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_worker_tasks_processed_total", labels=w2_labels
+            )
+            == 10
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_worker_load_average", labels=dict(w2_labels, period="5m")
+            )
+            == 0.2
+        )
+
+        with patch.object(ControlChannel, "broadcast") as mock_broadcast:
+            w = ControlPlane(app=self.app, namespace=self.namespace, state=m.state)
+            w.tick()
+            mock_broadcast.assert_not_called()
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_workers", labels=dict(namespace=self.namespace)
+                )
+                == 2
+            )
+
+            # a late heartbeat doesn't make w1 look gone
+            m._process_batch(
+                [Event("worker-heartbeat", hostname="w1", local_received=now - 60)]
+            )
+            w.tick()
+            mock_broadcast.assert_not_called()
+
+            # w1 missed its heartbeats: ping to confirm it is gone
+            mock_broadcast.return_value = [([{"w2": {"ok": "pong"}}], 0.1)]
+            with patch("time.time", return_value=now + 60):
+                w.tick()
+            mock_broadcast.assert_called_once_with(
+                [("ping", {}, None, True)], timeout=w.reply_timeout_seconds
+            )
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_workers", labels=dict(namespace=self.namespace)
+                )
+                == 1
+            )
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_worker_up",
+                    labels=dict(namespace=self.namespace, hostname="w1"),
+                )
+                == 0
+            )
+
+            w.tick()
+            mock_broadcast.assert_called_once()
+
+        w.tick()
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_workers", labels=dict(namespace=self.namespace)
+            )
+            == 1
+        )
+        WORKERS.labels(namespace=self.namespace).set(0)
+
     def test_tasks_events(self):
         task_uuid = uuid()
         hostname = "myhost"
@@ -135,63 +258,71 @@ class TestMockedCelery(BaseTest):
             == 0
         )
 
-        m._process_event(
-            Event(
-                "task-sent",
-                uuid=task_uuid,
-                name=self.task,
-                queue=self.queue,
-                args="()",
-                kwargs="{}",
-                retries=0,
-                eta=None,
-                hostname=hostname,
-                clock=0,
-                local_received=local_received,
-            )
+        m._process_batch(
+            [
+                Event(
+                    "task-sent",
+                    uuid=task_uuid,
+                    name=self.task,
+                    queue=self.queue,
+                    args="()",
+                    kwargs="{}",
+                    retries=0,
+                    eta=None,
+                    hostname=hostname,
+                    clock=0,
+                    local_received=local_received,
+                )
+            ]
         )
         self._assert_all_states({celery.states.PENDING})
 
-        m._process_event(
-            Event(
-                "task-received",
-                uuid=task_uuid,
-                name=self.task,
-                args="()",
-                kwargs="{}",
-                retries=0,
-                eta=None,
-                hostname=hostname,
-                clock=0,
-                local_received=local_received,
-            )
+        m._process_batch(
+            [
+                Event(
+                    "task-received",
+                    uuid=task_uuid,
+                    name=self.task,
+                    args="()",
+                    kwargs="{}",
+                    retries=0,
+                    eta=None,
+                    hostname=hostname,
+                    clock=0,
+                    local_received=local_received,
+                )
+            ]
         )
         self._assert_all_states({celery.states.PENDING, celery.states.RECEIVED})
 
-        m._process_event(
-            Event(
-                "task-started",
-                uuid=task_uuid,
-                hostname=hostname,
-                clock=1,
-                name=self.task,
-                local_received=local_received + latency_before_started,
-            )
+        m._process_batch(
+            [
+                Event(
+                    "task-started",
+                    uuid=task_uuid,
+                    hostname=hostname,
+                    clock=1,
+                    name=self.task,
+                    local_received=local_received + latency_before_started,
+                )
+            ]
         )
         self._assert_all_states(
             {celery.states.PENDING, celery.states.RECEIVED, celery.states.STARTED}
         )
 
-        m._process_event(
-            Event(
-                "task-succeeded",
-                uuid=task_uuid,
-                result="42",
-                runtime=runtime,
-                hostname=hostname,
-                clock=2,
-                local_received=local_received + latency_before_started + runtime,
-            )
+        m._process_batch(
+            [
+                Event(
+                    "task-succeeded",
+                    uuid=task_uuid,
+                    result="42",
+                    runtime=runtime,
+                    hostname=hostname,
+                    clock=2,
+                    local_received=local_received + latency_before_started + runtime,
+                )
+            ]
         )
         self._assert_all_states(
             {
@@ -202,32 +333,36 @@ class TestMockedCelery(BaseTest):
             }
         )
 
-        m._process_event(
-            Event(
-                "task-started",
-                uuid=task_uuid,
-                result="42",
-                runtime=runtime,
-                hostname=hostname,
-                clock=2,
-                local_received=local_received + latency_before_started + runtime,
-            )
+        m._process_batch(
+            [
+                Event(
+                    "task-started",
+                    uuid=task_uuid,
+                    result="42",
+                    runtime=runtime,
+                    hostname=hostname,
+                    clock=2,
+                    local_received=local_received + latency_before_started + runtime,
+                )
+            ]
         )
         self._assert_task_states({celery.states.STARTED}, 1)
 
-        m._process_event(
-            Event(
-                "notatask-sent",
-                uuid=task_uuid,
-                name=self.task,
-                args="()",
-                kwargs="{}",
-                retries=0,
-                eta=None,
-                hostname=hostname,
-                clock=0,
-                local_received=local_received,
-            )
+        m._process_batch(
+            [
+                Event(
+                    "notatask-sent",
+                    uuid=task_uuid,
+                    name=self.task,
+                    args="()",
+                    kwargs="{}",
+                    retries=0,
+                    eta=None,
+                    hostname=hostname,
+                    clock=0,
+                    local_received=local_received,
+                )
+            ]
         )
         self._assert_task_states({celery.states.PENDING}, 1)
 
@@ -260,16 +395,18 @@ class TestMockedCelery(BaseTest):
             == 234.5
         )
 
-        m._process_event(
-            Event(
-                "task-succeeded",
-                uuid=uuid(),
-                result="42",
-                runtime=runtime,
-                hostname=hostname,
-                clock=2,
-                local_received=local_received + latency_before_started + runtime,
-            )
+        m._process_batch(
+            [
+                Event(
+                    "task-succeeded",
+                    uuid=uuid(),
+                    result="42",
+                    runtime=runtime,
+                    hostname=hostname,
+                    clock=2,
+                    local_received=local_received + latency_before_started + runtime,
+                )
+            ]
         )
 
         assert (
@@ -285,27 +422,1244 @@ class TestMockedCelery(BaseTest):
             == 1
         )
 
-    def test_enable_events(self):
-        with patch.object(self.app.control, "enable_events") as mock_enable_events:
-            e = EnableEventsThread(app=self.app)
-            e.enable_events()
-            mock_enable_events.assert_called_once_with()
-
-    def test_gen_wildcards(self):
-        strings = {
-            "aaa.bbb.ccc.ddd": [
-                "aaa.bbb.ccc.ddd",
-                "aaa.bbb.ccc.*",
-                "aaa.bbb.*",
-                "aaa.*",
-                "*",
+    def test_tasks_events_batch(self):
+        task_uuid = uuid()
+        task_name = "my_batched_task"
+        local_received = time()
+
+        m = TaskThread(
+            app=self.app, namespace=self.namespace, max_tasks_in_memory=self.max_tasks
+        )
+        m._process_batch(
+            [
+                Event(
+                    "task-sent",
+                    uuid=task_uuid,
+                    name=task_name,
+                    queue=self.queue,
+                    local_received=local_received,
+                ),
+                Event(
+                    "task-received",
+                    uuid=task_uuid,
+                    name=task_name,
+                    local_received=local_received,
+                ),
+                Event("worker-heartbeat", local_received=local_received),
+                Event(
+                    "task-started", uuid=task_uuid, local_received=local_received + 12.5
+                ),
+                Event(
+                    "task-succeeded",
+                    uuid=task_uuid,
+                    runtime=3.5,
+                    local_received=local_received + 16,
+                ),
+                Event("task-received", uuid=uuid(), name=task_name, local_received=0),
+            ]
+        )
+
+        labels = dict(namespace=self.namespace, name=task_name, queue=self.queue)
+        for state, cnt in (
+            (celery.states.PENDING, 1),
+            (celery.states.RECEIVED, 2),
+            (celery.states.STARTED, 1),
+            (celery.states.SUCCESS, 1),
+        ):
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_tasks_total", labels=dict(labels, state=state)
+                )
+                == cnt
+            )
+        assert (
+            REGISTRY.get_sample_value("celery_tasks_latency_seconds_sum", labels=labels)
+            == 12.5
+        )
+        assert (
+            REGISTRY.get_sample_value("celery_tasks_runtime_seconds_sum", labels=labels)
+            == 3.5
+        )
+
+    def test_tasks_events_raw(self):
+        namespace = "raw"
+        task_uuid = uuid()
+        task_name = "my_r\u00e4w_task"
+        local_received = time()
+
+        def raw(*events, received=local_received):
+            body = events[0] if len(events) == 1 else list(events)
+            return json.dumps(body).encode(), received
+
+        m = TaskThread(
+            app=self.app, namespace=namespace, max_tasks_in_memory=self.max_tasks
+        )
+        m._process_batch(
+            [
+                raw(
+                    Event(
+                        "task-sent",
+                        uuid=task_uuid,
+                        name=task_name,
+                        queue=self.queue,
+                        args="({!r},)".format("x" * 10000),
+                        kwargs={"nested": [{"a": "]}"}]},
+                    )
+                ),
+                raw(
+                    Event(
+                        "task-received",
+                        uuid=task_uuid,
+                        name=task_name,
+                        hostname="celery@worker",
+                    ),
+                    Event("worker-heartbeat", hostname="celery@worker", active=1),
+                ),
+                raw(
+                    Event("task-started", uuid=task_uuid),
+                    received=local_received + 12.5,
+                ),
+                Event(
+                    "task-succeeded",
+                    uuid=task_uuid,
+                    runtime=3.5,
+                    local_received=local_received + 16,
+                ),
+                (b'{"type": "task-failed", "uuid": ', local_received),
+            ]
+        )
+
+        labels = dict(namespace=namespace, name=task_name, queue=self.queue)
+        for state in (
+            celery.states.PENDING,
+            celery.states.RECEIVED,
+            celery.states.STARTED,
+            celery.states.SUCCESS,
+        ):
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_tasks_total", labels=dict(labels, state=state)
+                )
+                == 1
+            )
+        assert (
+            REGISTRY.get_sample_value("celery_tasks_latency_seconds_sum", labels=labels)
+            == 12.5
+        )
+        assert (
+            REGISTRY.get_sample_value("celery_tasks_runtime_seconds_sum", labels=labels)
+            == 3.5
+        )
+        assert m.state.alive_workers(local_received) == 1
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_exporter_events_malformed_total",
+                labels=dict(namespace=namespace),
+            )
+            == 1
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_exporter_events_dropped_total", labels=dict(namespace=namespace)
+            )
+            == 0
+        )
+
+    def test_raw_event_receiver(self):
+        received = []
+        kombu.serialization.register(
+            "test", json.dumps, json.loads, content_type="application/x-test"
+        )
+        try:
+            with self.app.connection() as conn:
+                recv = RawEventReceiver(conn, received.append, app=self.app)
+                recv._on_message(
+                    kombu.Message(
+                        body='{"type": "task-sent"}',
+                        content_type="application/json",
+                        content_encoding="utf-8",
+                    )
+                )
+                recv._on_message(
+                    kombu.Message(
+                        body='{"type": "worker-heartbeat"}',
+                        content_type="application/x-test",
+                        content_encoding="utf-8",
+                    )
+                )
+                body, compression = kombu.compression.compress(
+                    b'{"type": "worker-online"}', "zlib"
+                )
+                recv._on_message(
+                    kombu.Message(
+                        body=body,
+                        content_type="application/json",
+                        content_encoding="utf-8",
+                        headers={"compression": compression},
+                    )
+                )
+        finally:
+            kombu.serialization.unregister("test")
+
+        (body, local_received), evt, compressed = received
+        assert body == b'{"type": "task-sent"}'
+        assert abs(local_received - time()) < 5
+        assert evt["type"] == "worker-heartbeat"
+        assert "local_received" in evt
+        assert compressed["type"] == "worker-online"
+
+    def test_connected_after_read(self):
+        m = TaskThread(app=self.app, namespace="read", max_tasks_in_memory=2)
+        m._backoff.next()
+        m._on_iteration()
+        assert not m.connected.is_set()
+        assert m._backoff._delay == 2
+        m._on_iteration()
+        assert m.connected.is_set()
+        assert m._backoff._delay == 1
+
+    def test_ingestion_stats(self):
+        namespace = "stats"
+        now = time()
+        m = TaskThread(app=self.app, namespace=namespace, max_tasks_in_memory=2)
+        m._process_batch(
+            [
+                Event(
+                    "task-received",
+                    uuid=uuid(),
+                    name=self.task,
+                    timestamp=now - 2,
+                    local_received=now - 1.5,
+                )
+                for _ in range(3)
+            ]
+            + [Event("worker-heartbeat", timestamp=now, local_received=now)]
+            + [Event("worker-custom", timestamp=now)]
+        )
+
+        for kind, cnt in (
+            ("task-received", 3),
+            ("worker-heartbeat", 1),
+            ("worker-custom", 1),
+        ):
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_exporter_events_total",
+                    labels=dict(namespace=namespace, type=kind),
+                )
+                == cnt
+            )
+        broker = dict(namespace=namespace, stage="broker")
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_exporter_event_lag_seconds_count", labels=broker
+            )
+            == 4
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_exporter_event_lag_seconds_bucket",
+                labels=dict(broker, le="0.1"),
+            )
+            == 1
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_exporter_event_lag_seconds_bucket",
+                labels=dict(broker, le="1.0"),
+            )
+            == 4
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_exporter_event_lag_seconds_bucket",
+                labels=dict(namespace=namespace, stage="exporter", le="1.0"),
+            )
+            == 1
+        )
+        for kind, value in (("size", 2), ("capacity", 2)):
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_exporter_tasks_in_memory",
+                    labels=dict(namespace=namespace, kind=kind),
+                )
+                == value
+            )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_exporter_tasks_evicted_total", labels=dict(namespace=namespace)
+            )
+            == 1
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_exporter_batch_processing_seconds_count",
+                labels=dict(namespace=namespace),
+            )
+            == 1
+        )
+
+    def test_tasks_expiry(self):
+        namespace = "expiry"
+        now = time()
+        m = TaskThread(
+            app=self.app,
+            namespace=namespace,
+            max_tasks_in_memory=self.max_tasks,
+            task_ttl=60,
+        )
+        lost, started = uuid(), uuid()
+        m._process_batch(
+            [
+                Event("task-received", uuid=lost, name=self.task, local_received=now),
+                Event(
+                    "task-received",
+                    uuid=started,
+                    name=self.task,
+                    local_received=now + 30,
+                ),
+            ]
+        )
+        # the lost task never starts and expires, the other one still starts
+        m._process_batch([Event("task-started", uuid=started, local_received=now + 75)])
+
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(
+                name, labels=dict(labels, namespace=namespace)
+            )
+
+        assert sample("celery_exporter_tasks_expired_total") == 1
+        assert sample("celery_exporter_tasks_evicted_total") == 0
+        assert sample("celery_exporter_tasks_in_memory", kind="size") == 1
+        assert (
+            sample(
+                "celery_tasks_latency_seconds_sum", name=self.task, queue="undefined"
+            )
+            == 45
+        )
+
+        m._process_batch([Event("task-started", uuid=lost, local_received=now + 80)])
+        assert (
+            sample(
+                "celery_tasks_latency_seconds_count", name=self.task, queue="undefined"
+            )
+            == 1
+        )
+
+    def test_tasks_memory_budget(self):
+        m = TaskThread(
+            app=self.app,
+            namespace="budget",
+            max_tasks_in_memory=self.max_tasks,
+            max_bytes=100 * 1024,
+        )
+        size, capacity = m.state.stats()[3:5]
+        assert size == 0
+        assert 0 < capacity < 100 * 1024 // 64
+
+        with self.assertRaises(ValueError):
+            TaskThread(
+                app=self.app, namespace="budget", max_tasks_in_memory=10, max_bytes=1
+            )
+        with self.assertRaises(ValueError):
+            TaskThread(
+                app=self.app, namespace="budget", max_tasks_in_memory=10, task_ttl=0
+            )
+
+    def test_event_buffer_overflow(self):
+        namespace = "overflow"
+        now = time()
+        m = TaskThread(
+            app=self.app,
+            namespace=namespace,
+            max_tasks_in_memory=self.max_tasks,
+            event_buffer_size=4,
+        )
+        for _ in range(6):
+            m._on_event(
+                Event("task-received", uuid=uuid(), name=self.task, local_received=now)
+            )
+        assert m._drain() == 4
+        assert m._drain(timeout=0.01) == 0
+
+        assert m.state.stats()[3] == 4
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_exporter_events_dropped_total", labels=dict(namespace=namespace)
+            )
+            == 2
+        )
+
+    def test_sampling(self):
+        namespace = "sampling"
+        now = time()
+        m = TaskThread(
+            app=self.app,
+            namespace=namespace,
+            max_tasks_in_memory=self.max_tasks,
+            sample_rate=0.25,
+        )
+        assert m.state.sample_rate == 0.25
+        task_uuids = [uuid() for _ in range(2000)]
+        m._process_batch(
+            [
+                Event("task-received", uuid=u, name=self.task, local_received=now)
+                for u in task_uuids
+            ]
+        )
+        # the events of a task are sampled together
+        m._process_batch(
+            [
+                Event("task-succeeded", uuid=u, runtime=1.0, local_received=now)
+                for u in task_uuids
+            ]
+        )
+
+        tasks = {st: cnt for _, st, _, cnt in m.state.snapshot()[0]}
+        assert tasks[celery.states.RECEIVED] == tasks[celery.states.SUCCESS]
+        assert tasks[celery.states.SUCCESS] % 4 == 0
+        assert 1600 < tasks[celery.states.SUCCESS] < 2400
+        assert m.state.stats()[3] == 0
+        ((_, _, cumulative, total),) = m.state.snapshot()[1]
+        assert cumulative[-1] == total == tasks[celery.states.SUCCESS]
+
+    def test_adaptive_sampling(self):
+        now = time()
+        m = TaskThread(
+            app=self.app,
+            namespace="adaptive",
+            max_tasks_in_memory=self.max_tasks,
+            sample_max_lag=1.0,
+        )
+        assert m.state.sample_rate == 1
+        m._process_batch(
+            [
+                Event(
+                    "task-received",
+                    uuid=uuid(),
+                    name=self.task,
+                    local_received=now - 10,
+                )
+            ]
+        )
+        assert m.state.sample_rate == 0.5
+        m._process_batch(
+            [
+                Event(
+                    "task-received", uuid=uuid(), name=self.task, local_received=now + 2
+                )
+            ]
+        )
+        assert m.state.sample_rate == 1
+
+        with self.assertRaises(ValueError):
+            TaskThread(
+                app=self.app,
+                namespace="adaptive",
+                max_tasks_in_memory=self.max_tasks,
+                sample_rate=0,
+            )
+
+    def test_task_names(self):
+        now = time()
+
+        def received(name):
+            return Event("task-received", uuid=uuid(), name=name, local_received=now)
+
+        m = TaskThread(
+            app=self.app,
+            namespace="task_names",
+            max_tasks_in_memory=self.max_tasks,
+            task_names=dict(
+                deny=[r"^internal\."],
+                groups=[(r"^reports\.build_(\w+?)_\d+$", "reports.build_$1")],
+            ),
+        )
+        m._process_batch(
+            [
+                received("internal.cleanup"),
+                received("reports.build_pdf_1"),
+                received("reports.build_pdf_2"),
+                received(self.task),
+            ]
+        )
+        tasks = {(name, queue): cnt for name, _, queue, cnt in m.state.snapshot()[0]}
+        assert tasks == {
+            ("other", "undefined"): 1,
+            ("reports.build_pdf", "undefined"): 2,
+            (self.task, "undefined"): 1,
+        }
+        assert m.state.task_label("internal.cleanup") is None
+        assert m.state.task_label("reports.build_csv_3") == "reports.build_csv"
+
+        # seeded tasks are folded as their events
+        setup_metrics(
+            "task_names",
+            {"internal.cleanup": "celery", "reports.build_csv_3": "reports"},
+        )
+        pending = dict(namespace="task_names", state=celery.states.PENDING)
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_tasks_total",
+                labels=dict(pending, name="reports.build_csv", queue="reports"),
+            )
+            == 0
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_tasks_total",
+                labels=dict(pending, name="internal.cleanup", queue="celery"),
+            )
+            is None
+        )
+
+        with self.assertRaises(ValueError):
+            TaskNames(allow=["("])
+
+    def test_top_task_names(self):
+        now = time()
+        m = TaskThread(
+            app=self.app,
+            namespace="top_task_names",
+            max_tasks_in_memory=self.max_tasks,
+            task_names=dict(top_k=1),
+        )
+        m._process_batch(
+            [
+                Event("task-received", uuid=uuid(), name=name, local_received=now)
+                for name in [self.task] * 3 + ["rare"]
+            ]
+        )
+        tasks = {name: cnt for name, _, _, cnt in m.state.snapshot()[0]}
+        assert tasks == {self.task: 3, "other": 1}
+        assert m.state.task_label(self.task) == self.task
+        assert m.state.task_label("rare") is None
+
+        # only the names kept as labels are seeded
+        setup_metrics("top_task_names", {self.task: self.queue, "rare": "celery"})
+        pending = dict(namespace="top_task_names", state=celery.states.PENDING)
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_tasks_total",
+                labels=dict(pending, name=self.task, queue=self.queue),
+            )
+            == 0
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_tasks_total", labels=dict(pending, name="rare", queue="celery")
+            )
+            is None
+        )
+
+        # a flood of one-off names doesn't take the label of the busiest one
+        m._process_batch(
+            [
+                Event("task-received", uuid=uuid(), name=str(i), local_received=now)
+                for i in range(10)
+            ]
+        )
+        assert m.state.task_label(self.task) == self.task
+        tasks = {name: cnt for name, _, _, cnt in m.state.snapshot()[0]}
+        assert tasks == {self.task: 3, "other": 11}
+
+    def test_top_task_names_promotion(self):
+        now = time()
+        m = TaskThread(
+            app=self.app,
+            namespace="top_task_names_promotion",
+            max_tasks_in_memory=self.max_tasks,
+            task_names=dict(top_k=1),
+        )
+        # the busy name takes the label of the rare one seen first once it is
+        # seen more often, the series of the rare one being folded into other
+        m._process_batch(
+            [
+                Event("task-received", uuid=uuid(), name=name, local_received=now)
+                for name in ["rare"] + [self.task] * 3
+            ]
+        )
+        assert m.state.task_label(self.task) == self.task
+        assert m.state.task_label("rare") is None
+        tasks = {name: cnt for name, _, _, cnt in m.state.snapshot()[0]}
+        assert tasks == {self.task: 2, "other": 2}
+
+    def test_buckets(self):
+        m = TaskThread(
+            app=self.app,
+            namespace="buckets",
+            max_tasks_in_memory=self.max_tasks,
+            runtime_buckets=[60.0, 600.0],
+            latency_buckets=[0.001, 0.01],
+        )
+        assert m.state.buckets == [60.0, 600.0]
+        assert m.state.latency_buckets == [0.001, 0.01]
+        assert m.state.sketch_accuracy is None
+
+        with self.assertRaises(ValueError):
+            TaskThread(
+                app=self.app,
+                namespace="buckets",
+                max_tasks_in_memory=self.max_tasks,
+                runtime_buckets=[2.0, 1.0],
+            )
+
+    def test_sketches(self):
+        namespace = "sketches"
+        now = time()
+        m = TaskThread(
+            app=self.app,
+            namespace=namespace,
+            max_tasks_in_memory=self.max_tasks,
+            sketch_accuracy=0.01,
+        )
+        m._process_batch(
+            [
+                Event(
+                    "task-succeeded",
+                    uuid=uuid(),
+                    name=self.task,
+                    runtime=i / 100,
+                    local_received=now,
+                )
+                for i in range(1, 101)
+            ]
+        )
+        assert m.state.snapshot()[1] == []
+        (runtime,), latency, broker_wait, end_to_end = m.state.summaries()
+        assert latency == broker_wait == end_to_end == []
+        name, queue, quantiles, count, total = runtime
+        assert count == 100
+        assert abs(total - 50.5) < 1e-6
+        for (quantile, value), expected in zip(quantiles, (0.5, 0.9, 0.99)):
+            assert abs(value - expected) <= 0.01 * expected
+
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_tasks_runtime_summary_seconds",
+                labels=dict(
+                    namespace=namespace, name=self.task, queue=queue, quantile="0.9"
+                ),
+            )
+            == quantiles[1][1]
+        )
+
+    def test_task_timings(self):
+        namespace = "timings"
+        task_uuid = uuid()
+        now = time()
+        m = TaskThread(
+            app=self.app, namespace=namespace, max_tasks_in_memory=self.max_tasks
+        )
+        m._process_batch(
+            [
+                Event(
+                    "task-sent",
+                    uuid=task_uuid,
+                    name=self.task,
+                    queue="timings",
+                    local_received=now,
+                ),
+                Event("task-received", uuid=task_uuid, local_received=now + 2),
+                Event("task-started", uuid=task_uuid, local_received=now + 3),
+                Event("task-retried", uuid=task_uuid, local_received=now + 4),
+                Event("task-received", uuid=task_uuid, local_received=now + 10),
+                Event("task-started", uuid=task_uuid, local_received=now + 11),
+                Event(
+                    "task-succeeded",
+                    uuid=task_uuid,
+                    runtime=1.0,
+                    local_received=now + 12,
+                ),
+            ]
+        )
+
+        labels = dict(namespace=namespace, name=self.task, queue="timings")
+        for metric, count, total in (
+            ("celery_tasks_broker_wait_seconds", 1, 2),
+            ("celery_tasks_latency_seconds", 2, 2),
+            ("celery_tasks_end_to_end_seconds", 1, 12),
+            ("celery_tasks_retries", 1, 1),
+        ):
+            for suffix, expected in (("_count", count), ("_sum", total)):
+                value = REGISTRY.get_sample_value(metric + suffix, labels=labels)
+                assert abs(value - expected) < 1e-3, metric + suffix
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_tasks_retries_bucket", labels=dict(labels, le="0.0")
+            )
+            == 0
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_tasks_retries_bucket", labels=dict(labels, le="1.0")
+            )
+            == 1
+        )
+
+    def test_checkpoint(self):
+        namespace = "checkpoint"
+        task_uuid = uuid()
+        local_received = time()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "tasks.checkpoint")
+            m = TaskThread(
+                app=self.app,
+                namespace=namespace,
+                max_tasks_in_memory=self.max_tasks,
+                checkpoint_path=path,
+            )
+            m._process_batch(
+                [
+                    Event(
+                        "task-sent",
+                        uuid=task_uuid,
+                        name=self.task,
+                        queue="restored",
+                        local_received=local_received,
+                    ),
+                    Event(
+                        "task-received",
+                        uuid=task_uuid,
+                        name=self.task,
+                        local_received=local_received,
+                    ),
+                ]
+            )
+            m.shutdown()
+            assert os.listdir(tmp) == ["tasks.checkpoint"]
+
+            # a restarted exporter still knows the task in flight
+            m = TaskThread(
+                app=self.app,
+                namespace=namespace,
+                max_tasks_in_memory=self.max_tasks,
+                checkpoint_path=path,
+            )
+            assert m.state.stats()[3] == 1
+            m._process_batch(
+                [
+                    Event(
+                        "task-started",
+                        uuid=task_uuid,
+                        local_received=local_received + 2,
+                    ),
+                    Event(
+                        "task-succeeded",
+                        uuid=task_uuid,
+                        runtime=1.5,
+                        local_received=local_received + 3.5,
+                    ),
+                ]
+            )
+            labels = dict(namespace=namespace, name=self.task, queue="restored")
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_tasks_latency_seconds_sum", labels=labels
+                )
+                == 2
+            )
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_tasks_total",
+                    labels=dict(labels, state=celery.states.SUCCESS),
+                )
+                == 1
+            )
+
+            with open(path, "r+b") as f:
+                f.truncate(30)
+            m = TaskThread(
+                app=self.app,
+                namespace=namespace,
+                max_tasks_in_memory=self.max_tasks,
+                checkpoint_path=path,
+            )
+            assert m.state.stats()[3] == 0
+
+    def test_checkpoint_evictions(self):
+        m = TaskThread(
+            app=self.app,
+            namespace="checkpoint_evictions",
+            max_tasks_in_memory=self.max_tasks,
+        )
+        m._process_batch(
+            [
+                Event(
+                    "task-received", uuid=uuid(), name=self.task, local_received=time()
+                )
+                for _ in range(3)
+            ]
+        )
+        state = CeleryState(2)
+        assert state.restore(m.state.checkpoint()) == 3
+        stats = state.stats()
+        assert stats[3] == 2
+        assert stats[5] == 1
+
+    def test_sharded_state(self):
+        now = time()
+        state = ShardedState(2, [1.0, 2.0, float("inf")])
+        state.record_dropped(3)
+        state.update(
+            0,
+            (
+                [(self.task, celery.states.SUCCESS, self.queue, 2)],
+                [(self.task, self.queue, [1, 2, 2], 2.5)],
+                [],
+                [],
+                [],
+                [(self.task, self.queue, [1, 1, 1, 1, 1, 1, 1], 0)],
+            ),
+            [
+                ("celery@busy", True, True, 1, 10, None, False),
+                ("celery@idle", True, True, 0, 10, None, False),
             ],
-            "aaa.bbb": ["aaa.bbb", "aaa.*", "*"],
-            "aaa": ["aaa", "*"],
+            (
+                [("task-succeeded", 3), ("worker-heartbeat", 2)],
+                [1.0],
+                [("broker", [2, 3], 1.5)],
+                2,
+                10,
+                1,
+                4,
+                0,
+                1,
+                1.0,
+            ),
+        )
+        state.update(
+            1,
+            (
+                [(self.task, celery.states.SUCCESS, self.queue, 1)],
+                [(self.task, self.queue, [0, 1, 1], 1.5)],
+                [(self.task, self.queue, [1, 1, 1], 0.5)],
+                [],
+                [],
+                [(self.task, self.queue, [0, 1, 1, 1, 1, 1, 1], 1)],
+            ),
+            [
+                ("celery@busy", True, True, 1, 10, None, True),
+                ("celery@idle", True, True, 0, 10, None, False),
+            ],
+            (
+                [("task-succeeded", 3)],
+                [1.0],
+                [("broker", [1, 3], 2.0)],
+                1,
+                10,
+                0,
+                1,
+                2,
+                1,
+                0.5,
+            ),
+        )
+
+        assert state.buckets == [1.0, 2.0]
+        # the shards count distinct events
+        assert state.stats() == (
+            [("task-succeeded", 6), ("worker-heartbeat", 2)],
+            [1.0],
+            [("broker", [3, 6], 3.5)],
+            3,
+            20,
+            1,
+            5,
+            5,
+            2,
+            0.75,
+        )
+        # a worker emits task events if any shard saw some
+        assert state.workers(now) == [
+            ("celery@busy", True, True, 1, 10, None, True),
+            ("celery@idle", True, True, 0, 10, None, False),
+        ]
+        assert state.silent_workers(now) == ["celery@idle"]
+        assert state.snapshot() == (
+            [(self.task, celery.states.SUCCESS, self.queue, 3)],
+            [(self.task, self.queue, [1, 3, 3], 4.0)],
+            [(self.task, self.queue, [1, 1, 1], 0.5)],
+            [],
+            [],
+            [(self.task, self.queue, [1, 2, 2, 2, 2, 2, 2], 1)],
+        )
+
+    def test_sharded_workers_pinged(self):
+        # the replies to a ping are handed over to every shard
+        now = time()
+        t = ShardedIngestionThread(
+            app=self.app,
+            namespace="sharded",
+            max_tasks_in_memory=self.max_tasks,
+            processes=2,
+        )
+        t._events_conns = [MagicMock(), MagicMock()]
+        t.state.workers_pinged(["celery@worker"], now)
+        t._drain(0)
+        for conn in t._events_conns:
+            conn.send.assert_called_once_with(([], [], [(["celery@worker"], now)]))
+        assert t.state.take_pings() == []
+
+        # so that the shards no longer see the worker stale
+        shards = [
+            CeleryState(self.max_tasks, shard_index=shard, shard_count=2)
+            for shard in range(2)
+        ]
+        for shard, shard_state in enumerate(shards):
+            shard_state.process_batch(
+                [
+                    Event(
+                        "worker-heartbeat",
+                        hostname="celery@worker",
+                        local_received=now - 60,
+                    )
+                ]
+            )
+            t.state.update(shard, ([],) * 6, shard_state.workers(now))
+        assert t.state.workers_stale(now)
+        ((_, _, pings),) = t._events_conns[0].send.call_args[0]
+        for shard, shard_state in enumerate(shards):
+            for hostnames, pinged in pings:
+                shard_state.workers_pinged(hostnames, pinged)
+            t.state.update(shard, ([],) * 6, shard_state.workers(now))
+        assert not t.state.workers_stale(now)
+        assert t.state.alive_workers(now) == 1
+
+    def test_event_router(self):
+        # the shards fed by a router add up to a single state
+        now = time()
+        hostname = "celery@worker"
+        events = [
+            (json.dumps(Event("worker-heartbeat", hostname=hostname)).encode(), now),
+            (b'{"type": "task-failed", "uuid": ', now),
+        ]
+        for _ in range(50):
+            task_uuid = uuid()
+            events.append(
+                (
+                    json.dumps(
+                        Event(
+                            "task-sent",
+                            uuid=task_uuid,
+                            name=self.task,
+                            queue=self.queue,
+                            args=[{"a": "]}"}],
+                        )
+                    ).encode(),
+                    now,
+                )
+            )
+            events.append(
+                Event(
+                    "task-received",
+                    uuid=task_uuid,
+                    name=self.task,
+                    hostname=hostname,
+                    local_received=now,
+                )
+            )
+        single = CeleryState(self.max_tasks)
+        single.process_batch(events)
+
+        router = EventRouter(2)
+        batches, routes = router.route(events)
+        assert routes == [(self.task, self.queue)]
+        assert router.route(events)[1] == []
+        state = ShardedState(2, [1.0])
+        for shard, batch in enumerate(batches):
+            assert 0 < len(batch) < len(events)
+            shard_state = CeleryState(self.max_tasks, shard_index=shard, shard_count=2)
+            shard_state.learn_routes(routes)
+            shard_state.process_batch(batch)
+            state.update(
+                shard,
+                shard_state.snapshot(),
+                shard_state.workers(now),
+                shard_state.stats(),
+            )
+
+        assert sorted(state.snapshot()[0]) == sorted(single.snapshot()[0])
+        assert sorted(state.stats()[0]) == sorted(single.stats()[0])
+        assert state.stats()[3] == 50
+        assert state.stats()[8] == 1
+        assert state.workers(now) == single.workers(now)
+
+    def test_sharded_summaries(self):
+        state = ShardedState(2, [1.0], sketch_accuracy=0.01)
+        sketches = [
+            ([(self.task, self.queue, [(10, 1), (20, 2)], 0, 3, 6.0)], [], [], []),
+            ([(self.task, self.queue, [(10, 1)], 1, 2, 2.0)], [], [], []),
+        ]
+        for shard, shard_sketches in enumerate(sketches):
+            state.update(shard, ([],) * 6, [], None, shard_sketches)
+
+        # merged bins: 1 zero, 2 in bin 10 and 2 in bin 20
+        gamma = 1.01 / 0.99
+        ((name, queue, quantiles, count, total),), *others = state.summaries()
+        assert (name, queue, count, total) == (self.task, self.queue, 5, 8.0)
+        assert others == [[], [], []]
+        for (quantile, value), index in zip(quantiles, (10, 20, 20)):
+            self.assertAlmostEqual(value, 2 * gamma ** index / (gamma + 1))
+
+    def test_sharded_sketches(self):
+        # the sketches merged from the shards are the ones of a single state
+        now = time()
+        events = [
+            Event(
+                "task-succeeded",
+                uuid=uuid(),
+                name=self.task,
+                runtime=i / 100,
+                local_received=now,
+            )
+            for i in range(1, 201)
+        ]
+        single = CeleryState(self.max_tasks, sketch_accuracy=0.01)
+        single.process_batch(events)
+        state = ShardedState(2, [1.0], sketch_accuracy=0.01)
+        for shard in range(2):
+            shard_state = CeleryState(
+                self.max_tasks, shard_index=shard, shard_count=2, sketch_accuracy=0.01
+            )
+            shard_state.process_batch(events)
+            state.update(shard, ([],) * 6, [], None, shard_state.sketches())
+
+        (merged,), *_ = state.summaries()
+        (expected,), *_ = single.summaries()
+        assert merged[:2] == expected[:2]
+        assert merged[3] == expected[3]
+        self.assertAlmostEqual(merged[4], expected[4])
+        for (q, value), (_, expected_value) in zip(merged[2], expected[2]):
+            self.assertAlmostEqual(value, expected_value)
+
+    def test_config_cache(self):
+        cache = ConfigCache(self.app, ttl=30)
+        assert cache.get() == {}
+
+        assert not cache.refreshed.is_set()
+
+        # no worker replied
+        assert cache.update([], {}) == {}
+        assert not cache.refreshed.is_set()
+
+        config = cache.update(
+            [[self.task, "trial"]],
+            {
+                "celery@d6f95e9e24fc": {
+                    "task_routes": {"trial": {"queue": "deadbeef"}}
+                },
+                "celery@12311847jsa2": {},
+            },
+        )
+        assert config == {self.task: self.queue, "trial": "deadbeef"}
+        assert cache.get() == config
+        assert cache.refreshed.is_set()
+
+        # the last known table is kept until some worker replies
+        assert cache.update([], {}) == config
+        assert cache.get() == config
+
+    def test_queue_lengths(self):
+        cache = ConfigCache(self.app)
+        cache._config = {self.task: self.queue, "trial": "deadbeef"}
+        with self.app.producer_or_acquire() as producer:
+            for _ in range(3):
+                producer.publish(
+                    {}, routing_key=self.queue, declare=[kombu.Queue(self.queue)]
+                )
+
+        t = QueueLengthThread(
+            app=self.app, namespace=self.namespace, config_cache=cache
+        )
+        t.update_queue_lengths()
+        for queue, length in ((self.queue, 3), ("deadbeef", 0)):
+            assert (
+                REGISTRY.get_sample_value(
+                    "celery_queue_length",
+                    labels=dict(namespace=self.namespace, queue=queue),
+                )
+                == length
+            )
+
+        cache._config = {self.task: self.queue}
+        t.update_queue_lengths()
+        assert (
+            REGISTRY.get_sample_value(
+                "celery_queue_length",
+                labels=dict(namespace=self.namespace, queue="deadbeef"),
+            )
+            is None
+        )
+
+    def test_periodic_jobs(self):
+        jobs = PeriodicJobs(workers=1)
+        step = MagicMock(side_effect=[30, Exception("timeout")])
+        jobs._run_step(step)
+        jobs._run_step(step)
+        assert step.call_count == 2
+        due = sorted(job[0] for job in jobs._jobs)
+        assert len(due) == 2
+        assert due[1] - due[0] > 20
+
+    def test_enable_events(self):
+        now = time()
+        m = TaskThread(
+            app=self.app, namespace=self.namespace, max_tasks_in_memory=self.max_tasks
+        )
+        with patch.object(ControlChannel, "broadcast") as mock_broadcast:
+            w = ControlPlane(
+                app=self.app,
+                namespace=self.namespace,
+                state=m.state,
+                enable_events=True,
+            )
+
+            # no worker known yet, enable the events of all of them
+            mock_broadcast.return_value = [([], 2), (None, None)]
+            w.tick()
+            mock_broadcast.assert_called_with(
+                [("ping", {}, None, True), ("enable_events", {}, None, False)],
+                timeout=w.reply_timeout_seconds,
+            )
+
+            # w2 sends task events, w1 was just asked to
+            m._process_batch(
+                [
+                    Event("worker-online", hostname="w1", freq=2.0, local_received=now),
+                    Event("worker-online", hostname="w2", freq=2.0, local_received=now),
+                    Event(
+                        "task-started", uuid=uuid(), hostname="w2", local_received=now
+                    ),
+                ]
+            )
+            assert m.state.silent_workers(now) == ["w1"]
+            mock_broadcast.reset_mock()
+            w.tick()
+            mock_broadcast.assert_not_called()
+
+            # w1 stays silent, it is asked again once per interval
+            mock_broadcast.return_value = [(None, None)]
+            later = monotonic() + w.enable_events_interval_seconds
+            with patch("time.monotonic", return_value=later):
+                w.tick()
+                mock_broadcast.assert_called_once_with(
+                    [("enable_events", {}, ["w1"], False)],
+                    timeout=w.reply_timeout_seconds,
+                )
+                w.tick()
+                mock_broadcast.assert_called_once()
+
+            # both send task events, nothing to send
+            m._process_batch(
+                [Event("task-started", uuid=uuid(), hostname="w1", local_received=now)]
+            )
+            mock_broadcast.reset_mock()
+            w.tick()
+            mock_broadcast.assert_not_called()
+        WORKERS.labels(namespace=self.namespace).set(0)
+
+    def test_control_plane_config(self):
+        def timed():
+            return tuple(
+                REGISTRY.get_sample_value(metric, labels=dict(namespace=self.namespace))
+                or 0
+                for metric in (
+                    "celery_exporter_ping_seconds_sum",
+                    "celery_exporter_get_config_seconds_sum",
+                )
+            )
+
+        cache = ConfigCache(self.app, ttl=30)
+        with patch.object(ControlChannel, "broadcast") as mock_broadcast, patch(
+            "celery_exporter.monitor.setup_metrics"
+        ) as mock_setup_metrics:
+            w = ControlPlane(app=self.app, namespace=self.namespace, config_cache=cache)
+            mock_broadcast.return_value = [
+                ([{"celery@d6f95e9e24fc": {"ok": "pong"}}], 0.1),
+                ([{"celery@d6f95e9e24fc": [self.task]}], 0.2),
+                ([{"celery@d6f95e9e24fc": {}}], 0.3),
+            ]
+            ping_time, config_time = timed()
+            w.tick()
+            mock_broadcast.assert_called_with(
+                [
+                    ("ping", {}, None, True),
+                    ("registered", {"taskinfoitems": []}, None, True),
+                    ("conf", {"with_defaults": False}, None, True),
+                ],
+                timeout=w.reply_timeout_seconds,
+            )
+            assert cache.get() == {self.task: self.queue}
+            assert cache.refreshed.is_set()
+            mock_setup_metrics.assert_called_once_with(
+                self.namespace, {self.task: self.queue}
+            )
+            # each command is timed until its latest reply
+            new_ping_time, new_config_time = timed()
+            self.assertAlmostEqual(new_ping_time - ping_time, 0.1)
+            self.assertAlmostEqual(new_config_time - config_time, 0.3)
+
+            # the config is only inspected again after its ttl
+            mock_broadcast.return_value = [
+                ([{"celery@d6f95e9e24fc": {"ok": "pong"}}], 0.1)
+            ]
+            w.tick()
+            mock_broadcast.assert_called_with(
+                [("ping", {}, None, True)], timeout=w.reply_timeout_seconds
+            )
+
+            # on errors, the connection is reset and the config retried
+            mock_broadcast.side_effect = Exception("timeout")
+            w._config_due = 0
+            with patch.object(ControlChannel, "close") as mock_close:
+                assert w.step() == w.periodicity_seconds
+                mock_close.assert_called_once_with()
+            assert w._config_due == 0
+            assert cache.get() == {self.task: self.queue}
+        WORKERS.labels(namespace=self.namespace).set(0)
+
+    def test_control_channel(self):
+        app = get_celery_app()
+        app.conf.broker_transport_options = {"polling_interval": 0.01}
+        enabled = []
+        handlers = {
+            "ping": lambda state, **kwargs: {"ok": "pong"},
+            "enable_events": lambda state, **kwargs: enabled.append(True),
         }
-        for case, expectation in strings.items():
-            result = _gen_wildcards(case)
-            assert result == expectation
+        stop = threading.Event()
+        connections = []
+        for hostname in ("w1", "w2"):
+            conn = app.connection()
+            conn.connect()
+            node = app.control.mailbox(conn).Node(
+                hostname, handlers=handlers, channel=conn.channel()
+            )
+            node.listen()
+            connections.append(conn)
+            threading.Thread(target=drain_until, args=(conn, stop), daemon=True).start()
+
+        channel = ControlChannel(app)
+        try:
+            (pings, ping_time), events = channel.broadcast(
+                [("ping", {}, None, True), ("enable_events", {}, ["w2"], False)],
+                timeout=1,
+            )
+            assert sorted(h for reply in pings for h in reply) == ["w1", "w2"]
+            assert ping_time < 0.5
+            assert events == (None, None)
+            assert enabled == [True]
+
+            # every destination replied, no need to wait for the timeout
+            start = monotonic()
+            ((pings, _),) = channel.broadcast([("ping", {}, ["w1"], True)], timeout=5)
+            assert pings == [{"w1": {"ok": "pong"}}]
+            assert monotonic() - start < 1
+        finally:
+            stop.set()
+            channel.close()
+            for conn in connections:
+                conn.release()
 
     def _assert_task_states(self, states, cnt):
         for state in states:
@@ -1,7 +1,27 @@
+import gzip
 import ssl
+from http.client import HTTPConnection
+from unittest.mock import patch
+from urllib.request import Request, urlopen
+
 import pytest
+from kombu import Connection, Exchange, Queue
+from prometheus_client import CollectorRegistry, Counter
 
-from celery_exporter.utils import get_transport_scheme, generate_broker_use_ssl
+from celery_exporter.exposition import (
+    ExpositionCache,
+    start_asyncio_http_server,
+    start_http_server,
+)
+from celery_exporter.utils import (
+    Backoff,
+    EventBuffer,
+    QueueSampler,
+    RedisEventConsumer,
+    get_transport_scheme,
+    generate_broker_use_ssl,
+    parse_buckets,
+)
 
 
 @pytest.mark.parametrize("brokers", [("redis://foo", "redis"), ("amqp://bar", "amqp")])
@@ -9,6 +29,66 @@ def test_get_transport_scheme(brokers):
     assert get_transport_scheme(brokers[0]) == brokers[1]
 
 
+@pytest.mark.parametrize(
+    "spec,bounds",
+    [
+        ("0.1,0.5,1", [0.1, 0.5, 1.0]),
+        ("exp:0.5:2:4", [0.5, 1.0, 2.0, 4.0]),
+        ("lin:30:60:3", [30.0, 90.0, 150.0]),
+    ],
+)
+def test_parse_buckets(spec, bounds):
+    assert parse_buckets(spec) == bounds
+
+
+@pytest.mark.parametrize(
+    "spec", ["1,0.5", "exp:0:2:4", "exp:1:1:4", "lin:0:1", "lin:0:-1:3", "a,b"]
+)
+def test_parse_buckets_invalid(spec):
+    with pytest.raises(ValueError):
+        parse_buckets(spec)
+
+
+def test_event_buffer():
+    buffer = EventBuffer(4)
+    for i in range(3):
+        buffer.push(i)
+    assert buffer.pop(2) == [0, 1]
+    # wraps around the end of the slots
+    for i in range(3, 6):
+        buffer.push(i)
+    assert len(buffer) == 4
+    assert buffer.pop(10) == [2, 3, 4, 5]
+    assert buffer.pop(10, timeout=0.01) == []
+    assert buffer.take_dropped() == 0
+
+
+def test_event_buffer_drop_oldest():
+    buffer = EventBuffer(3, "drop-oldest")
+    for i in range(5):
+        buffer.push(i)
+    assert buffer.take_dropped() == 2
+    assert buffer.take_dropped() == 0
+    assert buffer.pop(10) == [2, 3, 4]
+
+
+def test_event_buffer_sample():
+    buffer = EventBuffer(100, "sample")
+    for i in range(1000):
+        buffer.push(i)
+    assert buffer.take_dropped() == 900
+    events = buffer.pop(100)
+    assert len(events) == 100
+    # a uniform sample keeps events from all along the burst
+    assert sum(1 for evt in events if evt >= 100) > 50
+
+
+@pytest.mark.parametrize("capacity,policy", [(0, "sample"), (10, "drop-newest")])
+def test_event_buffer_invalid(capacity, policy):
+    with pytest.raises(ValueError):
+        EventBuffer(capacity, policy)
+
+
 def test_generate_broker_use_ssl_no_ssl():
     assert (
         generate_broker_use_ssl(
@@ -62,3 +142,153 @@ def test_generate_broker_use_ssl():
         "ca_certs": "path/ca.pem",
         "cert_reqs": ssl.CERT_REQUIRED,
     }
+
+
+def test_exposition_cache():
+    registry = CollectorRegistry()
+    counter = Counter("scrapes", "Scrapes.", registry=registry)
+    cache = ExpositionCache(registry, max_age=60)
+
+    output = cache.get()
+    assert b"scrapes_total 0.0" in output
+    assert gzip.decompress(cache.get(accept_gzip=True)) == output
+
+    counter.inc()
+    assert cache.get() is output
+
+    cache.max_age = 0
+    assert b"scrapes_total 1.0" in cache.get()
+
+
+def test_exposition_http_server():
+    registry = CollectorRegistry()
+    Counter("scrapes", "Scrapes.", registry=registry)
+    httpd = start_http_server(0, "127.0.0.1", ExpositionCache(registry))
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(httpd.server_address[1])
+        with urlopen(Request(url, headers={"Accept-Encoding": "gzip"})) as resp:
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert b"scrapes_total 0.0" in gzip.decompress(resp.read())
+        with urlopen(url) as resp:
+            assert resp.headers["Content-Encoding"] is None
+            assert b"scrapes_total 0.0" in resp.read()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_exposition_asyncio_http_server():
+    registry = CollectorRegistry()
+    Counter("scrapes", "Scrapes.", registry=registry)
+    ready = [False]
+    server = start_asyncio_http_server(
+        0, "127.0.0.1", ExpositionCache(registry), lambda: ready[0]
+    )
+    try:
+        conn = HTTPConnection(*server.server_address[:2])
+        conn.request("GET", "/metrics", headers={"Accept-Encoding": "gzip"})
+        resp = conn.getresponse()
+        assert resp.status == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert b"scrapes_total 0.0" in gzip.decompress(resp.read())
+
+        # the connection is kept alive between requests
+        sock = conn.sock
+        conn.request("GET", "/healthz")
+        resp = conn.getresponse()
+        assert (resp.status, resp.read()) == (200, b"ok\n")
+        conn.request("GET", "/ready")
+        resp = conn.getresponse()
+        assert (resp.status, resp.read()) == (503, b"not ready\n")
+        ready[0] = True
+        conn.request("GET", "/ready")
+        resp = conn.getresponse()
+        assert (resp.status, resp.read()) == (200, b"ready\n")
+        assert conn.sock is sock
+
+        conn.request("POST", "/metrics", body=b"GET /healthz HTTP/1.1\r\n\r\n")
+        resp = conn.getresponse()
+        assert resp.status == 405
+        assert resp.headers["Connection"] == "close"
+        assert resp.read() == b""
+        assert resp.will_close
+        conn.close()
+    finally:
+        server.shutdown()
+
+
+def test_queue_sampler_memory():
+    with Connection("memory://") as conn:
+        producer = conn.Producer()
+        for _ in range(3):
+            producer.publish({}, routing_key="q1", declare=[Queue("q1")])
+        assert QueueSampler(conn).lengths(["q1", "missing"]) == {"q1": 3, "missing": 0}
+
+
+def test_queue_sampler_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeStrictRedis()
+    with patch(
+        "kombu.transport.redis.Channel._create_client",
+        lambda self, asynchronous=False: client,
+    ):
+        with Connection("redis://") as conn:
+            producer = conn.Producer()
+            queue = Queue("q1", queue_arguments={"x-max-priority": 9})
+            for priority in (0, 0, 3, 9):
+                producer.publish(
+                    {}, routing_key="q1", declare=[queue], priority=priority
+                )
+            assert client.llen("q1\x06\x163") == 1
+
+            sampler = QueueSampler(conn)
+            with patch.object(client, "pipeline", wraps=client.pipeline) as pipeline:
+                assert sampler.lengths(["q1", "missing"]) == {"q1": 4, "missing": 0}
+                pipeline.assert_called_once_with(transaction=False)
+
+
+def test_redis_event_consumer():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeStrictRedis()
+    exchange = Exchange("celeryev", type="fanout")
+    with patch(
+        "kombu.transport.redis.Channel._create_client",
+        lambda self, asynchronous=False: client,
+    ):
+        with Connection("redis://") as conn:
+            messages = []
+            consumer = RedisEventConsumer(
+                conn.default_channel, "celeryev", messages.append
+            )
+            consumer.batch_size = 2
+            consumer.subscribe()
+            assert consumer.drain(0.01) == 0
+
+            producer = conn.Producer()
+            for i in range(3):
+                producer.publish(
+                    {"type": "task-sent", "i": i},
+                    exchange=exchange,
+                    routing_key="task.sent",
+                    serializer="json",
+                    declare=[exchange],
+                )
+            assert consumer.drain(1) == 2
+            assert consumer.drain(1) == 1
+            assert consumer.drain(0.01) == 0
+            consumer.close()
+
+    assert consumer.topic.endswith("celeryev/*")
+    assert [m.content_type for m in messages] == ["application/json"] * 3
+    assert [m.decode()["i"] for m in messages] == [0, 1, 2]
+
+
+def test_backoff():
+    backoff = Backoff(initial=1, maximum=5, jitter=0)
+    assert [backoff.next() for _ in range(5)] == [1, 2, 4, 5, 5]
+    backoff.reset()
+    assert backoff.next() == 1
+
+    backoff = Backoff(initial=1, maximum=8, jitter=0.5)
+    for expected in (1, 2, 4, 8, 8):
+        assert expected / 2 <= backoff.next() <= expected